@@ -2,4 +2,5 @@ import pandas as pd
 phonemes_pkn = pd.read_csv('../phonemesPKN.csv')
 phonemes_ksn = pd.read_csv('../phonemesKSN.csv')
 phonemes_pkn_ksn = pd.concat([phonemes_pkn, phonemes_ksn]).drop_duplicates()
-phonemes_pkn_ksn.to_csv('../phonemes_PKN_KSN.csv', index=False)
\ No newline at end of file
+phonemes_pkn_ksn.to_csv('../phonemes_PKN_KSN.csv', index=False)
+# Recompile the reference data afterwards (from the flask_server directory): python -m modules.reference_db.reference_db
@@ -32,10 +32,13 @@ adjacency_matrix = pd.pivot_table(ptms_omnipath_phospho, values='value', index='
 id_mapping = pd.read_csv('../id_conversion.txt')
 fr = 'uniprot'
 to = 'gene_name'
-mapped_column_names = [id_mapping.loc[np.where(id_mapping[fr] == s)[0], to].values.tolist()[0]
-                       if len(id_mapping.loc[np.where(id_mapping[fr] == s)[0], to].values.tolist()) == 1 else np.nan
-                       for s in adjacency_matrix.columns]
+# Only identifiers with exactly one mapping are used, the others become NaN
+mapping_counts = id_mapping[fr].value_counts()
+unique_mapping = id_mapping[id_mapping[fr].isin(mapping_counts.index[mapping_counts == 1])].set_index(fr)[to]
+mapped_column_names = [unique_mapping.get(s, np.nan) for s in adjacency_matrix.columns]
 adjacency_matrix.columns = mapped_column_names
 with open('../psp_kinase_substrate_adjacency_matrix.csv', 'w') as f:
     f.write(f'### Database Version: {date.today()}\n')
     adjacency_matrix.to_csv(f)
+# The server reads the compiled version, recompile it (from the flask_server directory):
+# python -m modules.reference_db.reference_db
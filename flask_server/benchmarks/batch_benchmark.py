@@ -0,0 +1,67 @@
+# Throughput in datasets per minute of a cohort sent to the batch routes (/batch/...) in one request, compared to one
+# request per dataset at a given concurrency. The datasets are random subsets of the fixture of each route, the
+# result cache is off, so every dataset is computed. Also checks that both paths return the same results.
+# Needs the dependencies of the routes (kinact, R for RoKAI, psite_annotation and the kinase library for motifs).
+# Run from the flask_server directory: python -m benchmarks.batch_benchmark [n_datasets] [concurrency]
+import sys
+import json
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+from benchmarks.load_replay import PORT, FIXTURE_INPUTS, start_server
+
+ROUTES = ['/ksea', '/ksea/rokai', '/motif_enrichment']
+# Share of the fixture rows in each dataset
+SUBSET_FRACTION = 0.8
+
+
+def get_cohort(route: str, n_datasets: int, rng: random.Random) -> dict[str, list]:
+    fixture = json.load(open(FIXTURE_INPUTS[route]))
+    return {f'dataset{i:03}': rng.sample(fixture, int(len(fixture) * SUBSET_FRACTION)) for i in range(n_datasets)}
+
+
+def post(url: str, files: list, dataset_name: str) -> dict:
+    response = requests.post(url, data={'session_id': 'BATCHBENCHMARK', 'dataset_name': dataset_name},
+                             files=files, timeout=None)
+    response.raise_for_status()
+    return response.json()['Result']
+
+
+def run_single(url: str, route: str, cohort: dict[str, list], concurrency: int) -> tuple[float, dict]:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = executor.map(lambda name: post(f'{url}{route}', [('file', ('input.json', json.dumps(cohort[name])))],
+                                                 name), cohort)
+        results = dict(zip(cohort, results))
+    return time.perf_counter() - start, results
+
+
+def run_batch(url: str, route: str, cohort: dict[str, list]) -> tuple[float, dict]:
+    start = time.perf_counter()
+    files = [('dataset', (f'{name}.json', json.dumps(records))) for name, records in cohort.items()]
+    results = post(f'{url}/batch{route}', files, 'cohort')
+    return time.perf_counter() - start, results
+
+
+def main(n_datasets=20, concurrency=4):
+    url = f'http://127.0.0.1:{PORT}'
+    server = start_server({'RESULT_CACHE': '0'})
+    rng = random.Random(0)
+    try:
+        print(f'{n_datasets} datasets, {concurrency} concurrent single requests')
+        print(f'{"route":20} {"single/min":>10} {"batch/min":>10} {"speedup":>8} {"same":>5}')
+        for route in ROUTES:
+            cohort = get_cohort(route, n_datasets, rng)
+            single_seconds, single_results = run_single(url, route, cohort, concurrency)
+            batch_seconds, batch_results = run_batch(url, route, cohort)
+            print(f'{route:20} {n_datasets / single_seconds * 60:10.1f} {n_datasets / batch_seconds * 60:10.1f} '
+                  f'{single_seconds / batch_seconds:7.2f}x {str(single_results == batch_results):>5}')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,41 @@
+# Compression ratio and CPU cost of each coding and level on the expected outputs of the fixtures, to choose
+# COMPRESSION_GZIP_LEVEL / COMPRESSION_ZSTD_LEVEL. The responses are compressed in chunks, as send_file streams them.
+# Run from the flask_server directory: python -m benchmarks.compression_benchmark [chunk_kb]
+import sys
+import time
+from pathlib import Path
+
+from modules.compression import compression
+
+FIXTURES = ['ssgsea/expected_output/output_gc.json', 'ptm-sea/expected_output/output_flanking.json',
+            'ksea/expected_output/output_ksea.json', 'motif_enrichment/expected_output/output.json',
+            'kea3/expected_output/output.json']
+LEVELS = {'gzip': [1, 3, 6, 9], 'zstd': [1, 3, 9, 19]}
+
+
+def compress_in_chunks(body: bytes, coding: str, level: int, chunk_size: int) -> tuple[int, float]:
+    start = time.thread_time()
+    compressor = compression.get_compressor(coding, level)
+    compressed_size = sum(len(compressor.compress(body[position:position + chunk_size]))
+                          for position in range(0, len(body), chunk_size))
+    compressed_size += len(compressor.flush())
+    return compressed_size, time.thread_time() - start
+
+
+def main(chunk_kb=8):
+    bodies = {fixture: (Path('../fixtures') / fixture).read_bytes() for fixture in FIXTURES}
+    print(f'{"fixture":48} {"coding":>6} {"level":>5} {"size":>9} {"saved":>6} {"CPU ms":>7} {"MB/s":>6}')
+    for fixture, body in bodies.items():
+        for coding in compression.get_codings():
+            for level in LEVELS[coding]:
+                # Best of three, the bodies are small
+                compressed_size, cpu_seconds = min(compress_in_chunks(body, coding, level, chunk_kb * 1024)
+                                                   for _ in range(3))
+                print(f'{fixture:48} {coding:>6} {level:5} {compressed_size:9} '
+                      f'{1 - compressed_size / len(body):6.1%} {cpu_seconds * 1000:7.1f} '
+                      f'{len(body) / 1e6 / max(cpu_seconds, 1e-9):6.0f}')
+        print(f'{fixture:48} {"-":>6} {"-":>5} {len(body):9}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,74 @@
+# Compares the GCT parser in modules/gct with cmapPy on a scaled-up ssGSEA output.
+# Run from the flask_server directory: python -m benchmarks.gct_benchmark [row_factor] [column_factor]
+import sys
+import time
+import tempfile
+from pathlib import Path
+import pandas as pd
+from cmapPy.pandasGEXpress import parse_gct
+
+from modules.gct import gct
+
+FIXTURE = Path('../fixtures/ptm-sea/expected_output/out-combined.gct')
+
+
+def scale_combined_gct(row_factor: int, column_factor: int, output_gct: Path) -> list[str]:
+    fixture = gct.read_gct(FIXTURE, read_col_metadata=False)
+    experiments = list(fixture.data_df.columns)
+
+    data_dfs, row_metadata_dfs = [], []
+    for copy in range(column_factor):
+        renamed = {exp: f'{exp}_{copy}' for exp in experiments}
+        data_dfs.append(fixture.data_df.rename(columns=renamed))
+        row_metadata_dfs.append(fixture.row_metadata_df.rename(
+            columns={col: col.replace(exp, new) for col in fixture.row_metadata_df for exp, new in renamed.items()
+                     if col.endswith(f'.{exp}')}))
+    data_df = pd.concat(data_dfs, axis=1)
+    shared_columns = ['Signature.set.description', 'Signature.set.size', 'No.columns.scored']
+    row_metadata_df = pd.concat([row_metadata_dfs[0][shared_columns]]
+                                + [df.drop(columns=shared_columns) for df in row_metadata_dfs], axis=1)
+
+    data_df = pd.concat([data_df.rename(index=lambda rid: f'{rid}_{copy}') for copy in range(row_factor)])
+    row_metadata_df = pd.concat([row_metadata_df.rename(index=lambda rid: f'{rid}_{copy}')
+                                 for copy in range(row_factor)])
+    gct.write_gct(output_gct, data_df, row_metadata_df)
+    return [gct.sanitize_r_name(exp) for exp in data_df.columns]
+
+
+def postprocess_columns(experiment_names: list[str]) -> list[str]:
+    return ([f'Signature.set.overlap.percent.{exp}' for exp in experiment_names]
+            + [f'fdr.pvalue.{exp}' for exp in experiment_names]
+            + [f'Signature.set.overlap.{exp}' for exp in experiment_names])
+
+
+def time_it(function, repeats=3) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(row_factor=3000, column_factor=10):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        scaled_gct = Path(tmpdir) / 'scaled-combined.gct'
+        experiment_names = scale_combined_gct(row_factor, column_factor, scaled_gct)
+        columns = postprocess_columns(experiment_names)
+
+        def with_cmappy():
+            parsed = parse_gct.parse(str(scaled_gct))
+            return parsed.row_metadata_df[columns].join(parsed.data_df)
+
+        def with_gct_module():
+            parsed = gct.read_gct(scaled_gct, row_metadata_columns=columns, read_col_metadata=False)
+            return parsed.row_metadata_df.join(parsed.data_df)
+
+        size_mb = scaled_gct.stat().st_size / 1e6
+        print(f'{row_factor * 3} signatures x {len(experiment_names)} experiments ({size_mb:.1f} MB)')
+        print(f'cmapPy:      {time_it(with_cmappy):.3f} s')
+        print(f'modules/gct: {time_it(with_gct_module):.3f} s')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,317 @@
+# Replays recorded traffic (TRAFFIC_LOG, see modules/traffic_recorder) or a synthetic mix of requests against a local
+# server at a given concurrency and arrival rate. Reports throughput, latency percentiles and error rates per route and
+# the peak memory, CPU time and route class occupancy of the server.
+# Runs offline: Unless --url is given, the server is started with local stand-ins for KEA3 and the UniProt ID mapping.
+# Run from the flask_server directory:
+#   python -m benchmarks.load_replay --log ../traffic/traffic.jsonl --concurrency 8 --rate 2
+#   python -m benchmarks.load_replay --mix ksea=5,kea3=3,motif_enrichment=1 --requests 50
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+import numpy as np
+import requests
+
+PORT = 4398
+STAND_IN_PORT = 4397
+MONITOR_INTERVAL = 0.2
+STARTUP_TIMEOUT = 120
+# Inputs for synthetic requests and for recorded requests without payload, per route
+FIXTURE_INPUTS = {
+    '/ssgsea/ssc/flanking': Path('../fixtures/ptm-sea/input/input_flanking.json'),
+    '/ssgsea/ssc/uniprot': Path('../fixtures/ptm-sea/input/input_uniprot.json'),
+    '/ssgsea/gc': Path('../fixtures/ssgsea/input/input.json'),
+    '/ssgsea/gcr': Path('../fixtures/ssgsea/input/input.json'),
+    '/ksea': Path('../fixtures/ksea/input/input.json'),
+    '/ksea/rokai': Path('../fixtures/ksea/input/input.json'),
+    '/motif_enrichment': Path('../fixtures/motif_enrichment/input/input.json'),
+    '/kea3': Path('../fixtures/kea3/input/input.json'),
+    '/kstar': Path('../fixtures/kstar/input/input.json'),
+    '/phonemes': Path('../fixtures/phonemes/input/input.json'),
+}
+KEA3_FIXTURE_RESULT = Path('../fixtures/kea3/input/kea3_result.json')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    KEA3 enrichment API and UniProt ID mapping, answered locally with canned results
+    """
+    kea3_result = None
+    mapping_jobs = {}
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/kea3/'):
+            query_name = json.loads(body).get('query_name', '')
+            ranks = next(iter(self.kea3_result.values()))
+            self.send_json({'Integrated--meanRank': [{**rank, 'Query Name': query_name} for rank in ranks['MeanRank']],
+                            'Integrated--topRank': [{**rank, 'Query Name': query_name} for rank in ranks['TopRank']]})
+        elif self.path.startswith('/uniprot/idmapping/run'):
+            job_id = str(len(self.mapping_jobs))
+            self.mapping_jobs[job_id] = parse_qs(body.decode()).get('ids', [''])[0].split(',')
+            self.send_json({'jobId': job_id})
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        if self.path.startswith('/uniprot/idmapping/stream/'):
+            gene_names = self.mapping_jobs.get(self.path.rsplit('/', 1)[1], [])
+            self.send_json({'results': [{'from': gene_name, 'to': f'STANDIN_{gene_name}'} for gene_name in gene_names]})
+        else:
+            self.send_error(404)
+
+    def send_json(self, content):
+        body = json.dumps(content).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_ins() -> ThreadingHTTPServer:
+    StandInHandler.kea3_result = json.load(open(KEA3_FIXTURE_RESULT))
+    server = ThreadingHTTPServer(('127.0.0.1', STAND_IN_PORT), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_server(server_env: dict[str, str]) -> subprocess.Popen:
+    env = {**os.environ, 'PRODUCTION': '1', 'PORT': str(PORT), 'LOG_FILE': os.devnull,
+           'KEA3_URL': f'http://127.0.0.1:{STAND_IN_PORT}/kea3/api/enrich/',
+           'UNIPROT_URL': f'http://127.0.0.1:{STAND_IN_PORT}/uniprot', **server_env}
+    server = subprocess.Popen([sys.executable, 'enrichment_server.py'], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    start = time.perf_counter()
+    while True:
+        try:
+            requests.get(f'http://127.0.0.1:{PORT}/', timeout=1)
+            return server
+        except requests.ConnectionError:
+            if time.perf_counter() - start > STARTUP_TIMEOUT or server.poll() is not None:
+                server.kill()
+                raise RuntimeError('Server did not start')
+            time.sleep(0.1)
+
+
+def get_process_tree(pid: int) -> list[int]:
+    pids = [pid]
+    for tid_dir in Path(f'/proc/{pid}/task').glob('*'):
+        try:
+            children = (tid_dir / 'children').read_text().split()
+        except OSError:
+            continue
+        for child in children:
+            pids += get_process_tree(int(child))
+    return pids
+
+
+def get_usage(pid: int) -> tuple[float, float]:
+    """
+    RSS (MB) of the process tree, CPU seconds of the tree including reaped children
+    """
+    rss_mb, cpu_seconds = 0, 0
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+    for tree_pid in get_process_tree(pid):
+        try:
+            stat = Path(f'/proc/{tree_pid}/stat').read_text().rsplit(')', 1)[1].split()
+            rss_mb += int(stat[21]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+            # utime, stime and, for the server itself, cutime and cstime of its reaped children
+            cpu_fields = stat[11:15] if tree_pid == pid else stat[11:13]
+            cpu_seconds += sum(int(ticks) for ticks in cpu_fields) / clock_ticks
+        except (OSError, IndexError):
+            continue
+    return rss_mb, cpu_seconds
+
+
+def get_route_class_metrics(url: str) -> dict[str, float]:
+    metrics = defaultdict(float)
+    for line in requests.get(f'{url}/metrics', timeout=5).text.splitlines():
+        name, value = line.rsplit(' ', 1)
+        metric = name.split('{')[0].removeprefix('enrichment_server_route_class_')
+        route_class = name.split('route_class="')[1].split('"')[0]
+        # Summed over the worker processes
+        metrics[f'{route_class}_{metric}'] += float(value)
+    return metrics
+
+
+class Monitor:
+    """
+    Samples the server during the replay: Peak RSS of the server process tree and CPU time (if started here),
+    peak running and waiting requests per route class (from /metrics)
+    """
+
+    def __init__(self, url: str, server_pid: int = None):
+        self.url = url
+        self.server_pid = server_pid
+        self.peaks = defaultdict(float)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self.start_cpu = get_usage(self.server_pid)[1] if self.server_pid else 0
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        if self.server_pid:
+            self.peaks['server_cpu_seconds'] = get_usage(self.server_pid)[1] - self.start_cpu
+
+    def _sample(self):
+        while not self._stop.wait(MONITOR_INTERVAL):
+            if self.server_pid:
+                self.peaks['server_rss_mb'] = max(self.peaks['server_rss_mb'], get_usage(self.server_pid)[0])
+            try:
+                metrics = get_route_class_metrics(self.url)
+            except (requests.RequestException, ValueError, IndexError):
+                continue
+            for metric, value in metrics.items():
+                if metric.endswith(('_running', '_waiting')):
+                    self.peaks[f'{metric}_peak'] = max(self.peaks[f'{metric}_peak'], value)
+                elif metric.endswith('_rejected_total'):
+                    self.peaks[metric] = value
+
+
+def load_recording(log_file: Path) -> list[dict]:
+    with open(log_file) as infile:
+        return [json.loads(line) for line in infile if line.strip()]
+
+
+def get_synthetic_mix(mix: str, n_requests: int, rng: random.Random) -> list[dict]:
+    # 'ksea=5,kea3=1': Routes with relative weights
+    routes, weights = zip(*((f'/{route.strip().strip("/")}', float(weight))
+                            for route, weight in (part.split('=') for part in mix.split(','))))
+    for route in routes:
+        if route not in FIXTURE_INPUTS:
+            raise ValueError(f'No input for {route}, known routes: {", ".join(FIXTURE_INPUTS)}')
+    return [{'route': route, 'parameters': {}} for route in rng.choices(routes, weights, k=n_requests)]
+
+
+_payloads = {}
+
+
+def get_payload(entry: dict) -> bytes:
+    """
+    The recorded payload, or the fixture of the route scaled to the recorded number of rows
+    """
+    if entry.get('payload') and Path(entry['payload']).exists():
+        return Path(entry['payload']).read_bytes()
+    key = (entry['route'], entry.get('rows'))
+    if key not in _payloads:
+        fixture = json.load(open(FIXTURE_INPUTS[entry['route']]))
+        if isinstance(fixture, list) and entry.get('rows'):
+            fixture = [fixture[i % len(fixture)] for i in range(entry['rows'])]
+        _payloads[key] = json.dumps(fixture).encode()
+    return _payloads[key]
+
+
+def send(url: str, entry: dict, replay_id: int) -> dict:
+    form = {**entry.get('parameters', {}), 'session_id': 'REPLAY', 'dataset_name': f'replay{replay_id}'}
+    start = time.perf_counter()
+    try:
+        response = requests.post(f'{url}{entry["route"]}', data=form,
+                                 files={'file': ('input.json', get_payload(entry))}, timeout=None)
+        # Most handlers report input errors with status 200 and a plain text message
+        error = not response.ok or not response.content.startswith((b'{', b'['))
+        status = response.status_code
+    except requests.RequestException:
+        error, status = True, None
+    return {'route': entry['route'], 'latency': time.perf_counter() - start, 'error': error, 'status': status}
+
+
+def replay(url: str, entries: list[dict], concurrency: int, rate: float, rng: random.Random) -> tuple[list, float]:
+    """
+    rate > 0: Open loop, requests arrive as a Poisson process with this many requests per second
+    (at most `concurrency` in flight, the others wait in the client). rate == 0: Closed loop with `concurrency` clients.
+    """
+    results = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        arrival = 0
+        for replay_id, entry in enumerate(entries):
+            if rate > 0:
+                arrival += rng.expovariate(rate)
+                time.sleep(max(0, start + arrival - time.perf_counter()))
+            futures.append(executor.submit(send, url, entry, replay_id))
+        results = [future.result() for future in futures]
+    return results, time.perf_counter() - start
+
+
+def report(results: list[dict], duration: float, peaks: dict[str, float]):
+    print(f'{len(results)} requests in {duration:.1f} s, {len(results) / duration:.2f} requests/s')
+    print(f'{"route":<22}{"n":>6}{"errors":>8}{"p50 (s)":>10}{"p95 (s)":>10}{"p99 (s)":>10}')
+    by_route = defaultdict(list)
+    for result in results:
+        by_route[result['route']].append(result)
+    for route, route_results in sorted(by_route.items()):
+        latencies = np.array([result['latency'] for result in route_results])
+        error_rate = sum(result['error'] for result in route_results) / len(route_results)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f'{route:<22}{len(route_results):>6}{error_rate:>8.1%}{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}')
+    statuses = defaultdict(int)
+    for result in results:
+        statuses[result['status']] += 1
+    print(f'Status codes: {dict(statuses)}')
+    print('Server:')
+    for metric, value in sorted(peaks.items()):
+        print(f'  {metric}: {value:.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded or synthetic traffic against a local server')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--log', type=Path, help='JSONL file written by the traffic recorder (TRAFFIC_LOG)')
+    source.add_argument('--mix', help='Synthetic mix of routes with weights, e.g. ksea=5,kea3=3,motif_enrichment=1')
+    parser.add_argument('--requests', type=int, help='Number of requests (default: all recorded ones, 20 for --mix)')
+    parser.add_argument('--concurrency', type=int, default=4, help='Requests in flight at most (default: 4)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Arrivals per second, Poisson distributed (default: 0, closed loop)')
+    parser.add_argument('--url', help='Use a running server instead of starting one with the local stand-ins')
+    parser.add_argument('--server-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Environment of the started server, e.g. --server-env RESULT_CACHE=0')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.log:
+        entries = load_recording(args.log)
+        if args.requests:
+            entries = [entries[i % len(entries)] for i in range(args.requests)]
+    else:
+        entries = get_synthetic_mix(args.mix, args.requests or 20, rng)
+
+    stand_ins, server = None, None
+    url = args.url
+    if url is None:
+        stand_ins = start_stand_ins()
+        server = start_server(dict(env.split('=', 1) for env in args.server_env))
+        url = f'http://127.0.0.1:{PORT}'
+    try:
+        with Monitor(url, server.pid if server else None) as monitor:
+            results, duration = replay(url, entries, args.concurrency, args.rate, rng)
+        report(results, duration, monitor.peaks)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if stand_ins is not None:
+            stand_ins.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Compares the latency of ssGSEA with mode=preview and mode=full on the gene-centric fixture, scaled up to more
+# experiments, and how far the preview p-values are from the full ones. Needs R and ssGSEA2.0.
+# Run from the flask_server directory: python -m benchmarks.ssgsea_preview_benchmark [experiment_factor]
+import sys
+import json
+import time
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from modules.ssgsea import ssgsea
+
+FIXTURE = Path('../fixtures/ssgsea/input/input.json')
+
+
+def scale_input(experiment_factor: int, input_json: Path):
+    fixture = pd.read_json(FIXTURE).set_index('id')
+    # Each copy of an experiment gets a little noise, so the copies are not scored identically
+    rng = np.random.default_rng(0)
+    scaled = pd.concat([fixture.add_suffix(f'_{copy}') + rng.normal(0, 0.5, fixture.shape)
+                        for copy in range(experiment_factor)], axis=1)
+    input_json.write_text(scaled.reset_index().to_json(orient='records'))
+
+
+def run(input_json: Path, mode: str) -> tuple[float, pd.DataFrame]:
+    start = time.perf_counter()
+    ssgsea_input = ssgsea.preprocess_ssgsea(input_json, True)
+    output_gct = ssgsea.run_ssgsea(ssgsea_input, 'gc', 'flanking', mode)
+    result = pd.DataFrame(json.loads(ssgsea.postprocess_ssgsea(output_gct).read_text()))
+    return time.perf_counter() - start, result
+
+
+def main(experiment_factor=10):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = {}
+        for mode in ssgsea.MODES:
+            # Separate directories, the intermediate files of both runs have the same names
+            input_json = Path(tmpdir) / mode / 'input.json'
+            input_json.parent.mkdir()
+            scale_input(experiment_factor, input_json)
+            results[mode] = run(input_json, mode)
+
+    print(f'{experiment_factor * 2} experiments')
+    for mode, (seconds, _) in results.items():
+        print(f'{mode:8} {ssgsea.get_permutations(mode):5} permutations: {seconds:.1f} s')
+    full, preview = results['full'][1], results['preview'][1]
+    p_value_columns = [column for column in full if column.startswith('adj p-val (')]
+    merged = full.merge(preview, on='Signature ID', suffixes=('', '.preview'))
+    differences = np.abs(merged[p_value_columns].to_numpy(float)
+                         - merged[[f'{column}.preview' for column in p_value_columns]].to_numpy(float))
+    print(f'Adjusted p-values, preview vs full: median difference {np.nanmedian(differences):.4f}, '
+          f'max {np.nanmax(differences):.4f}')
+    significant = merged[p_value_columns].to_numpy(float) < 0.05
+    preview_significant = merged[[f'{column}.preview' for column in p_value_columns]].to_numpy(float) < 0.05
+    print(f'Same call at FDR 0.05 for {np.mean(significant == preview_significant):.1%} of signature scores')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
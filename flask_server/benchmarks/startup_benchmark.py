@@ -0,0 +1,78 @@
+# Measures how fast a freshly started server answers GET / and how much memory the worker needs,
+# with lazy module loading only (WARMUP_MODULES=0) and with the background warm-up (default).
+# Run from the flask_server directory: python -m benchmarks.startup_benchmark [repetitions]
+import os
+import sys
+import json
+import time
+import subprocess
+import urllib.request
+from pathlib import Path
+
+PORT = 4399
+POLL_INTERVAL = 0.01
+TIMEOUT = 120
+
+
+def get(path: str):
+    with urllib.request.urlopen(f'http://127.0.0.1:{PORT}{path}', timeout=1) as response:
+        return json.load(response)
+
+
+def get_rss_mb(pid: int) -> float:
+    for line in Path(f'/proc/{pid}/status').read_text().splitlines():
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) / 1024
+    return float('nan')
+
+
+def measure(warmup: bool) -> dict[str, float]:
+    env = {**os.environ, 'PRODUCTION': '1', 'PORT': str(PORT), 'WARMUP_MODULES': '1' if warmup else '0',
+           'LOG_FILE': os.devnull}
+    try:
+        get('/')
+        raise RuntimeError(f'Port {PORT} is already in use')
+    except OSError:
+        pass
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, 'enrichment_server.py'], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                get('/')
+                break
+            except OSError:
+                if time.perf_counter() - start > TIMEOUT or server.poll() is not None:
+                    raise RuntimeError('Server did not start')
+                time.sleep(POLL_INTERVAL)
+        result = {'time_to_first_response': time.perf_counter() - start, 'rss_first_response_mb': get_rss_mb(server.pid)}
+        if warmup:
+            # Wait until the warm-up thread is done (modules that cannot be imported stay None)
+            previous = None
+            while (import_times := get('/modules')) != previous:
+                previous = import_times
+                time.sleep(1)
+            result['time_to_warm'] = time.perf_counter() - start
+            result['rss_warm_mb'] = get_rss_mb(server.pid)
+            result['import_times'] = import_times
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for warmup in [False, True]:
+        results = [measure(warmup) for _ in range(repetitions)]
+        print(f"WARMUP_MODULES={'1' if warmup else '0'}")
+        for key in results[0]:
+            if key == 'import_times':
+                print(f'  import times (s): {results[-1][key]}')
+            else:
+                print(f'  {key}: {min(result[key] for result in results):.2f}')
+
+
+if __name__ == '__main__':
+    main()
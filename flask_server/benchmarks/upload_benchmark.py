@@ -0,0 +1,63 @@
+# Compares peak memory and time of parsing a record-oriented input with json.load + pd.DataFrame.from_dict
+# and with the incremental parser in modules/json_records. Each parser runs in a fresh process.
+# Run from the flask_server directory: python -m benchmarks.upload_benchmark [n_rows] [n_experiments]
+import sys
+import json
+import time
+import tempfile
+import subprocess
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from modules.json_records import json_records
+
+
+def write_input(input_json: Path, n_rows: int, n_experiments: int):
+    rng = np.random.default_rng(0)
+    input_df = pd.DataFrame(rng.normal(size=(n_rows, n_experiments)).round(6),
+                            columns=[f'Experiment{i:02d}' for i in range(n_experiments)])
+    input_df.insert(0, 'Site', [f'P{i:05d}_S{i % 700}' for i in range(n_rows)])
+    input_df.to_json(input_json, orient='records')
+
+
+def get_peak_rss_mb() -> float:
+    # VmHWM starts fresh with each exec, unlike ru_maxrss which is inherited from the parent
+    for line in Path('/proc/self/status').read_text().splitlines():
+        if line.startswith('VmHWM:'):
+            return int(line.split()[1]) / 1024
+    return float('nan')
+
+
+def parse(parser: str, input_json: Path):
+    baseline = get_peak_rss_mb()
+    start = time.perf_counter()
+    if parser == 'json.load':
+        input_df = pd.DataFrame.from_dict(json.load(open(input_json)))
+    else:
+        input_df = json_records.read_records(input_json)
+    elapsed = time.perf_counter() - start
+    peak = get_peak_rss_mb() - baseline
+    print(json.dumps({'seconds': elapsed, 'peak_mb': peak, 'frame_mb': input_df.memory_usage(deep=True).sum() / 2**20}))
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    n_experiments = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_json = Path(tmp_dir) / 'input.json'
+        write_input(input_json, n_rows, n_experiments)
+        print(f'Input: {n_rows} rows x {n_experiments} experiments, {input_json.stat().st_size / 2**20:.0f} MB')
+        for parser in ['json.load', 'json_records']:
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.upload_benchmark', '--parse', parser,
+                                     str(input_json)], capture_output=True, text=True, check=True).stdout
+            result = json.loads(output)
+            print(f"{parser:>12}: {result['seconds']:.2f} s, peak memory +{result['peak_mb']:.0f} MB "
+                  f"(DataFrame {result['frame_mb']:.0f} MB)")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--parse':
+        parse(sys.argv[2], Path(sys.argv[3]))
+    else:
+        main()
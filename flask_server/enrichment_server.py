@@ -2,61 +2,61 @@
 # curl -X POST -F file=@<input_file> -F session_id=ABCDEF12345  -F dataset_name=FooBar http://127.0.0.1:1234/<route>
 import os
 from pathlib import Path
-import shutil
 import json
 from urllib.parse import urlparse
 import werkzeug.wrappers
 from werkzeug.utils import secure_filename
-from flask import Flask, request, send_file, jsonify, make_response
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
+from flask import Flask, request, send_file, jsonify, make_response, g
 import flask.wrappers
 import logging
-import sys
-
-from modules.ssgsea import ssgsea
-from modules.ksea import ksea
-from modules.phonemes import phonemes
-from modules.motif_enrichment import motif_enrichment
-from modules.kea3 import kea3
-from modules.k_star import k_star
+import uuid
+
+from modules.lazy_import import lazy_import
+from modules.profiling import profiling
+from modules.route_classes import route_classes
+from modules.job_budget import job_budget
+from modules.cancellation import cancellation
+from modules.job_queue import job_queue
+from modules.server_logging import server_logging
+from modules.workspace import workspace
+from modules.compression import compression
+from modules.result_etag import result_etag
+from modules.uploads import uploads
+
+# The analysis modules are imported on first use or by the warm-up thread (see create_app)
+ssgsea = lazy_import.LazyModule('modules.ssgsea.ssgsea')
+ksea = lazy_import.LazyModule('modules.ksea.ksea')
+phonemes = lazy_import.LazyModule('modules.phonemes.phonemes')
+motif_enrichment = lazy_import.LazyModule('modules.motif_enrichment.motif_enrichment')
+kea3 = lazy_import.LazyModule('modules.kea3.kea3')
+k_star = lazy_import.LazyModule('modules.k_star.k_star')
+# Needs pandas, which is not imported at startup either
+result_filter = lazy_import.LazyModule('modules.result_filter.result_filter')
+traffic_recorder = lazy_import.LazyModule('modules.traffic_recorder.traffic_recorder')
+result_encoding = lazy_import.LazyModule('modules.result_encoding.result_encoding')
 
 VERSION = '0.1.3'
+# Larger request bodies are rejected with 413 before they are read
+MAX_UPLOAD_MB = int(os.getenv('MAX_UPLOAD_MB', '512'))
 
 
 def setup_logger():
     global LOGGER
     LOGGER = logging.getLogger('enrichment_server')
     LOGGER.setLevel(logging.INFO)
-
-    file_handler = logging.FileHandler('enrichment_server_logfile.log')
-    file_handler.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(message)s')
-    file_handler.setFormatter(formatter)
-    LOGGER.addHandler(file_handler)
-
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    LOGGER.addHandler(console_handler)
-
-    # Redirect print statements to the logger
-    class LoggerWriter:
-        def __init__(self, level):
-            self.level = level
-
-        def write(self, message):
-            if message.strip():  # Avoid logging empty messages
-                self.level(message)
-
-        def flush(self):
-            pass  # No-op for compatibility with sys.stdout/err
-
-    # Replace stdout and stderr with logger
-    sys.stdout = LoggerWriter(LOGGER.info)
-    sys.stderr = LoggerWriter(LOGGER.error)
+    # Records go through a queue to a background writer (JSON file + console), print statements are redirected
+    server_logging.setup_logging(LOGGER)
 
 
 def create_app():
     setup_logger()
     app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
+    # Every gunicorn worker does this, the workspaces of running workers are kept
+    workspace.reap_orphans()
+    lazy_import.start_warmup()
     print('App created.')
     return app
 
@@ -69,9 +69,28 @@ def get_status() -> flask.wrappers.Response:
     return send_response(jsonify(status=200, version=VERSION))
 
 
+@app.route('/modules', methods=['GET'])
+def get_module_status() -> flask.wrappers.Response:
+    # Import time in seconds per analysis module, None if it has not been imported yet
+    return send_response(jsonify(lazy_import.get_import_times()))
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics() -> flask.wrappers.Response:
+    # Prometheus text format, the values belong to the worker process that answers
+    metrics = (route_classes.get_prometheus_metrics() + job_queue.get_prometheus_metrics()
+               + compression.get_prometheus_metrics() + cancellation.get_prometheus_metrics())
+    return send_response(make_response(metrics, 200, {'Content-Type': 'text/plain; version=0.0.4'}))
+
+
 # TODO: In the second route, the ssgsea_type actually can only be ssc. Can I enforce this?
 @app.route('/ssgsea/<string:ssgsea_type>', methods=['POST'])
 @app.route('/ssgsea/<string:ssgsea_type>/<string:ssc_input_type>', methods=['POST'])
+@job_queue.queued('medium', request)
+@route_classes.limited('medium')
+@job_budget.budgeted('medium')
+@cancellation.cancellable('ssGSEA', request)
+@profiling.profiled('ssGSEA', request)
 def handle_ssgsea_request(ssgsea_type, ssc_input_type='flanking') -> werkzeug.wrappers.Response | str:
     valid_ssgsea_types = ['ssc', 'gc', 'gcr']
 
@@ -82,9 +101,17 @@ def handle_ssgsea_request(ssgsea_type, ssc_input_type='flanking') -> werkzeug.wr
     if ssc_input_type not in valid_ssc_input_types:
         return f"Invalid 'ssc_input_type'. Allowed values are {', '.join(valid_ssc_input_types)}"
 
+    try:
+        # mode=preview: Fewer permutations, a queued async job is refined to a full run afterwards
+        mode = ssgsea.parse_mode(request.form)
+        output_filter = result_filter.parse_filter(request.form)
+    except ValueError as error:
+        return f'Error: {error}.\n'
+
     post_request_processed = process_post_request(request, f'ssGSEA ({ssgsea_type.upper()})')
 
-    if type(post_request_processed) is str:
+    # An error message, or 304 if the client already has the result
+    if not isinstance(post_request_processed, Path):
         return post_request_processed
 
     filepath = post_request_processed
@@ -92,38 +119,57 @@ def handle_ssgsea_request(ssgsea_type, ssc_input_type='flanking') -> werkzeug.wr
     # Preprocess the json input into a gct file
     ssgsea_input = ssgsea.preprocess_ssgsea(filepath, ssgsea_type != 'gcr')
 
-    ssgsea_combined_output = ssgsea.run_ssgsea(ssgsea_input, ssgsea_type, ssc_input_type)
+    ssgsea_combined_output = ssgsea.run_ssgsea(ssgsea_input, ssgsea_type, ssc_input_type, mode)
 
-    return send_response(postprocess_request_response(ssgsea.postprocess_ssgsea(ssgsea_combined_output),
-                                                      f'ssGSEA ({ssgsea_type.upper()})', request.form),
-                         filepath.parent)
+    ssgsea_result = ssgsea.postprocess_ssgsea(ssgsea_combined_output, output_filter)
+
+    response = send_response(postprocess_request_response(ssgsea_result, f'ssGSEA ({ssgsea_type.upper()})',
+                                                          request.form))
+    response.headers[job_queue.RESULT_STAGE_HEADER] = mode
+    return response
 
 
 @app.route('/ksea', methods=['POST'])
 @app.route('/ksea/<string:ksea_type>', methods=['POST'])
+@job_queue.queued('fast', request)
+@route_classes.limited('fast')
+@job_budget.budgeted('fast')
+@cancellation.cancellable('KSEA', request)
+@profiling.profiled('KSEA', request)
 def handle_ksea_request(ksea_type=None) -> werkzeug.wrappers.Response | str:
+    try:
+        output_filter = result_filter.parse_filter(request.form)
+    except ValueError as error:
+        return f'Error: {error}.\n'
+
     post_request_processed = process_post_request(request, 'KSEA' if not ksea_type else 'RoKAI+KSEA')
 
-    if type(post_request_processed) is str:
+    # An error message, or 304 if the client already has the result
+    if not isinstance(post_request_processed, Path):
         return post_request_processed
 
     filepath = post_request_processed
 
     preprocessed_filepath = ksea.preprocess_ksea(filepath)
     if ksea_type == 'rokai':
-        preprocessed_filepath = ksea.run_rokai(preprocessed_filepath)
-
-    ksea_result = ksea.perform_ksea(preprocessed_filepath)
+        ksea_result = ksea.perform_rokai_ksea(preprocessed_filepath, output_filter)
+    else:
+        ksea_result = ksea.perform_ksea(preprocessed_filepath, output_filter)
     return send_response(postprocess_request_response(
-        ksea_result, 'KSEA' if not ksea_type else 'RoKAI+KSEA', request.form),
-        filepath.parent)
+        ksea_result, 'KSEA' if not ksea_type else 'RoKAI+KSEA', request.form))
 
 
 @app.route('/phonemes', methods=['POST'])
+@job_queue.queued('heavy', request)
+@route_classes.limited('heavy')
+@job_budget.budgeted('heavy')
+@cancellation.cancellable('PHONEMeS', request)
+@profiling.profiled('PHONEMeS', request)
 def handle_phonemes_request() -> werkzeug.wrappers.Response | str:
     post_request_processed = process_post_request(request, 'PHONEMeS')
 
-    if type(post_request_processed) is str:
+    # An error message, or 304 if the client already has the result
+    if not isinstance(post_request_processed, Path):
         return post_request_processed
 
     filepath = post_request_processed
@@ -134,51 +180,200 @@ def handle_phonemes_request() -> werkzeug.wrappers.Response | str:
     cytoscape_result = phonemes.run_cytoscape(phonemes_result)
     pathway_skeletons_json = phonemes.create_pathway_skeleton(cytoscape_result)
 
-    return send_response(postprocess_request_response(pathway_skeletons_json, 'PHONEMeS', request.form),
-                         filepath.parent)
+    return send_response(postprocess_request_response(pathway_skeletons_json, 'PHONEMeS', request.form))
 
 
 @app.route('/motif_enrichment', methods=['POST'])
+@job_queue.queued('medium', request)
+@route_classes.limited('medium')
+@job_budget.budgeted('medium')
+@cancellation.cancellable('Motif Enrichment', request)
+@profiling.profiled('Motif Enrichment', request)
 def handle_motif_enrichment_request() -> werkzeug.wrappers.Response | str:
+    # Optional form fields top_n, threshold, threshold_type and sort_type, comma-separated values are swept
+    try:
+        motif_settings = motif_enrichment.parse_settings(request.form)
+        output_filter = result_filter.parse_filter(request.form)
+    except ValueError as error:
+        return f'Error: {error}.\n'
+
     post_request_processed = process_post_request(request, 'Motif Enrichment')
 
-    if type(post_request_processed) is str:
+    # An error message, or 304 if the client already has the result
+    if not isinstance(post_request_processed, Path):
         return post_request_processed
 
     filepath = post_request_processed
-    motif_enrichment_result = motif_enrichment.run_motif_enrichment(filepath)
+    motif_enrichment_result = motif_enrichment.run_motif_enrichment(filepath, motif_settings, output_filter)
 
-    return send_response(postprocess_request_response(motif_enrichment_result, 'Motif Enrichment', request.form),
-                         filepath.parent)
+    return send_response(postprocess_request_response(motif_enrichment_result, 'Motif Enrichment', request.form))
 
 
 @app.route('/kea3', methods=['POST'])
+@job_queue.queued('fast', request)
+@route_classes.limited('fast')
+@job_budget.budgeted('fast')
+@cancellation.cancellable('KEA3', request)
+@profiling.profiled('KEA3', request)
 def handle_kea3_request() -> werkzeug.wrappers.Response | str:
     post_request_processed = process_post_request(request, 'KEA3')
 
-    if type(post_request_processed) is str:
+    # An error message, or 304 if the client already has the result
+    if not isinstance(post_request_processed, Path):
         return post_request_processed
 
     filepath = post_request_processed
     kea3_result = kea3.run_kea3_api(filepath)
 
-    return send_response(postprocess_request_response(kea3_result, 'KEA3', request.form), filepath.parent)
+    return send_response(postprocess_request_response(kea3_result, 'KEA3', request.form))
 
 
 @app.route('/kstar', methods=['POST'])
+@job_queue.queued('heavy', request)
+@route_classes.limited('heavy')
+@job_budget.budgeted('heavy')
+@cancellation.cancellable('KSTAR', request)
+@profiling.profiled('KSTAR', request)
 def handle_kstar_request() -> werkzeug.wrappers.Response | str:
+    try:
+        output_filter = result_filter.parse_filter(request.form)
+    except ValueError as error:
+        return f'Error: {error}.\n'
+
     post_request_processed = process_post_request(request, 'KSTAR')
 
-    if type(post_request_processed) is str:
+    # An error message, or 304 if the client already has the result
+    if not isinstance(post_request_processed, Path):
         return post_request_processed
 
     filepath = post_request_processed
-    kstar_result = k_star.run_kstar(filepath)
+    kstar_result = k_star.run_kstar(filepath, output_filter)
+
+    return send_response(postprocess_request_response(kstar_result, 'KSTAR', request.form))
+
+
+# Cohorts: Many datasets in one request, the result has the records of each dataset under its name
+# (see modules/uploads)
+@app.route('/batch/ksea', methods=['POST'])
+@app.route('/batch/ksea/<string:ksea_type>', methods=['POST'])
+@job_queue.queued('medium', request)
+@route_classes.limited('medium')
+@job_budget.budgeted('medium')
+@cancellation.cancellable('Batch KSEA', request)
+@profiling.profiled('Batch KSEA', request)
+def handle_ksea_batch_request(ksea_type=None) -> werkzeug.wrappers.Response | str:
+    valid_ksea_types = ['rokai']
+    if ksea_type is not None and ksea_type not in valid_ksea_types:
+        return f"Invalid 'ksea_type'. Allowed values are {', '.join(valid_ksea_types)}"
+    try:
+        output_filter = result_filter.parse_filter(request.form)
+    except ValueError as error:
+        return f'Error: {error}.\n'
+
+    method = 'Batch KSEA' if not ksea_type else 'Batch RoKAI+KSEA'
+    post_request_processed = process_post_request(request, method)
+
+    # An error message, or 304 if the client already has the result
+    if not isinstance(post_request_processed, Path):
+        return post_request_processed
 
-    return send_response(postprocess_request_response(kstar_result, 'KSTAR', request.form), filepath.parent)
+    filepath = post_request_processed
+    try:
+        ksea_result = ksea.perform_ksea_batch(filepath, ksea_type, output_filter)
+    except ValueError as error:
+        return f'Error: {error}.\n'
+    return send_response(postprocess_request_response(ksea_result, method, request.form))
+
+
+@app.route('/batch/motif_enrichment', methods=['POST'])
+@job_queue.queued('heavy', request)
+@route_classes.limited('heavy')
+@job_budget.budgeted('heavy')
+@cancellation.cancellable('Batch Motif Enrichment', request)
+@profiling.profiled('Batch Motif Enrichment', request)
+def handle_motif_enrichment_batch_request() -> werkzeug.wrappers.Response | str:
+    try:
+        motif_settings = motif_enrichment.parse_settings(request.form)
+        output_filter = result_filter.parse_filter(request.form)
+    except ValueError as error:
+        return f'Error: {error}.\n'
+
+    post_request_processed = process_post_request(request, 'Batch Motif Enrichment')
+
+    # An error message, or 304 if the client already has the result
+    if not isinstance(post_request_processed, Path):
+        return post_request_processed
+
+    filepath = post_request_processed
+    try:
+        motif_enrichment_result = motif_enrichment.run_motif_enrichment_batch(filepath, motif_settings,
+                                                                              output_filter)
+    except ValueError as error:
+        return f'Error: {error}.\n'
+
+    return send_response(postprocess_request_response(motif_enrichment_result, 'Batch Motif Enrichment',
+                                                      request.form))
+
+
+@app.route('/jobs/<string:job_id>', methods=['GET'])
+def get_job(job_id) -> tuple[bytes | str, int, dict[str, str]]:
+    # State or result of a queued job, from any replica (see modules/job_queue)
+    queue = job_queue.get_queue()
+    if queue is None:
+        return 'Error: The job queue is not enabled.\n', 404
+    return job_queue.get_response(queue, secure_filename(job_id))
+
+
+@app.route('/jobs/<string:job_id>', methods=['DELETE'])
+def cancel_job(job_id) -> tuple[str, int, dict[str, str]]:
+    # A running job is stopped by its worker with the next heartbeat, on any replica (see modules/cancellation)
+    queue = job_queue.get_queue()
+    if queue is None:
+        return 'Error: The job queue is not enabled.\n', 404, job_queue.CORS_HEADERS
+    job_id = secure_filename(job_id)
+    if queue.get(job_id) is None:
+        return f'Error: Job {job_id} not found.\n', 404, job_queue.CORS_HEADERS
+    queue.delete(job_id)
+    print(f'Job {job_id} cancelled.')
+    return f'Job {job_id} cancelled.\n', 200, job_queue.CORS_HEADERS
+
+
+@app.route('/profile/<string:profile_id>', methods=['GET'])
+@app.route('/profile/<string:profile_id>/<string:profile_file>', methods=['GET'])
+def get_profile(profile_id, profile_file='profile.json') -> werkzeug.wrappers.Response | str:
+    if not profiling.is_authorized(request):
+        return 'Error: Profiles are only available with a valid admin token.\n', 403
+    valid_profile_files = ['profile.json', 'stacks.collapsed']
+    if profile_file not in valid_profile_files:
+        return f"Invalid 'profile_file'. Allowed values are {', '.join(valid_profile_files)}"
+    profile_path = profiling.PROFILE_DIR / secure_filename(profile_id) / profile_file
+    if not profile_path.exists():
+        return f'Error: Profile {profile_id} not found.\n', 404
+    return send_response(send_file(profile_path.resolve(), as_attachment=False,
+                                   mimetype='application/json' if profile_file.endswith('.json') else 'text/plain'))
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_request_entity_too_large(error: RequestEntityTooLarge) -> tuple[str, int]:
+    return f'Error: The input is too large, the limit is {MAX_UPLOAD_MB} MB.\n', 413
+
+
+@app.errorhandler(cancellation.JobCancelled)
+def handle_job_cancelled(error: cancellation.JobCancelled) -> tuple[str, int]:
+    # Nobody reads the answer, the workspace is released by release_workspace as usual
+    print(f'Job stopped: {error}')
+    return f'Error: {error}.\n', 499
+
+
+@app.errorhandler(job_budget.BudgetExceeded)
+def handle_budget_exceeded(error: job_budget.BudgetExceeded) -> flask.Response:
+    print(f'Job stopped: {error}')
+    response = send_response(jsonify({'Log': {'Version': VERSION}, 'Error': error.to_dict()}))
+    response.status_code = 413
+    return response
 
 
-def process_post_request(post_request: werkzeug.Request, method: str) -> Path | str:
+def process_post_request(post_request: werkzeug.Request, method: str) -> Path | str | flask.Response:
     request_url = urlparse(request.base_url)
 
     form = post_request.form
@@ -187,43 +382,114 @@ def process_post_request(post_request: werkzeug.Request, method: str) -> Path |
         if param not in form:
             return f'Error: parameter {param} not specified.\n'
 
+    server_logging.REQUEST_CONTEXT.set({'request_id': uuid.uuid4().hex, 'session_id': form['session_id'],
+                                        'dataset_name': form['dataset_name'], 'method': method})
     print(f"{method} request received. Session ID: {form['session_id']}, Dataset Name: {form['dataset_name']}.")
-    output_dir = Path('..') / secure_filename(form['session_id']) / secure_filename(
-        form['dataset_name'] + request_url.path.replace('/', '_'))
-    Path.mkdir(output_dir, parents=True, exist_ok=True)
+    # JSON records unless the Accept header asks for one of the compact encodings of modules/result_encoding
+    result_encoding.negotiate(post_request.accept_mimetypes)
+    # A new directory per job, released by release_workspace after the response
+    output_dir = workspace.create(form['session_id'], form['dataset_name'], request_url.path)
+    g.output_dir = output_dir
+    job_budget.set_workspace(output_dir)
     input_filepath = output_dir / 'input.json'
-    # Check if the POST request has the file part, and else if it has the data part
-    if 'file' in post_request.files and post_request.files['file'].filename != '':
-        file = post_request.files['file']
-        file.save(input_filepath)
-    elif 'data' in post_request.form:
-        # TODO: This variant is not tested yet
-        with open(input_filepath, 'w') as o:
-            o.write(post_request.form['data'])
-    else:
+    # The file part, else the data part, or on the batch routes the uploaded datasets of a cohort
+    try:
+        has_input = uploads.save_upload(post_request, input_filepath)
+    except ValueError as error:
+        return f'Error: {error}.\n'
+    if not has_input:
+        if request_url.path.startswith(uploads.COHORT_ROUTE_PREFIX):
+            return "Error: You must provide the datasets as files (-F dataset=@<Filepath> for each dataset), " \
+                   + "as an archive (-F archive=@<Filepath>) or as a cohort file (-F file=@<Filepath>).\n"
         return "Error: You must either provide the input data " \
                + "as a JSON string (-F data=<JSON_String>) or as a file (-F file=@<Filepath>).\n"
 
+    # Only if TRAFFIC_LOG is set, see benchmarks/load_replay.py
+    traffic_recorder.record(post_request, method, input_filepath)
+
+    # The ETag is known before the analysis runs, a client that already has the result gets 304 right away
+    g.etag = result_etag.get_etag(VERSION, request_url.path, form, input_filepath,
+                                  result_encoding.REQUEST_ENCODING.get())
+    # A small result is not compressed, so the client may also hold the ETag without the coding
+    for etag in [compression.get_etag(g.etag, compression.negotiate(post_request.accept_encodings)), g.etag]:
+        if post_request.if_none_match.contains_weak(etag):
+            print(f"{method} result not modified. Session ID: {form['session_id']}, "
+                  f"Dataset Name: {form['dataset_name']}.")
+            response = send_response(make_response('', 304))
+            response.set_etag(etag)
+            return response
     return input_filepath
 
 
 def postprocess_request_response(result_path: Path, method: str, form: dict) -> werkzeug.wrappers.Response:
+    log = {'Version': VERSION}
+    encoded = result_encoding.encode_result(result_path, log)
+    print(f"{method} analysis finished. Session ID: {form['session_id']}, Dataset Name: {form['dataset_name']}.")
+    if encoded is not None:
+        encoded_path, mimetype = encoded
+        return send_file(encoded_path, mimetype=mimetype, as_attachment=False, etag=g.etag)
     result_raw = json.load(open(result_path))
-    result_with_log = {'Log': {'Version': VERSION}, 'Result': result_raw}
+    result_with_log = {'Log': log, 'Result': result_raw}
     with open(result_path, 'w') as outfile:
         json.dump(result_with_log, outfile)
-    print(f"{method} analysis finished. Session ID: {form['session_id']}, Dataset Name: {form['dataset_name']}.")
-    return send_file(result_path, as_attachment=False)
+    return send_file(result_path, as_attachment=False, etag=g.etag)
 
 
-def send_response(result: werkzeug.wrappers.Response, output_folder=None) -> flask.Response:
+def send_response(result: werkzeug.wrappers.Response) -> flask.Response:
     response = make_response(result)
     response.headers.add('Access-Control-Allow-Origin', '*')
-    if output_folder:
-        shutil.rmtree(output_folder)
+    # The encoding of analysis results depends on the Accept header
+    response.headers.add('Vary', 'Accept')
     return response
 
 
+@app.after_request
+def compress_response(response: flask.Response) -> flask.Response:
+    # Streams the body through gzip or zstd if the client accepts it, see modules/compression
+    return compression.compress(response, request.accept_encodings)
+
+
+@app.teardown_request
+def release_workspace(error: BaseException | None):
+    # Runs after every request, also if the handler failed. A result sent with send_file is already open.
+    output_dir = g.pop('output_dir', None)
+    workspace.release(output_dir)
+    if output_dir is not None:
+        # The results kept for encoding belong to the request as well
+        result_encoding.reset()
+
+
+@app.teardown_request
+def reset_request_context(error: BaseException | None):
+    server_logging.reset_request_context()
+
+
+def run_queued_job(job: job_queue.Job) -> job_queue.JobResult:
+    # The job runs through the same handler as on the replica that received it, the environ key skips the queue
+    data = MultiDict(job.form)
+    input_file = open(job.input_path, 'rb') if job.input_path is not None else None
+    if input_file is not None:
+        data.add('file', (input_file, 'input.json'))
+    try:
+        with app.test_request_context(job.route, method='POST', data=data, headers=job.headers,
+                                      environ_base={job_queue.JOB_ENVIRON_KEY: job.job_id}):
+            response = app.full_dispatch_request()
+            # Results are sent with send_file, which streams by default
+            response.direct_passthrough = False
+            result = job_queue.JobResult(response.status_code,
+                                         {key: value for key, value in response.headers.items()
+                                          if key != 'Content-Length'},
+                                         response.get_data())
+            response.close()
+    finally:
+        if input_file is not None:
+            input_file.close()
+    return result
+
+
+job_queue.start_workers(run_queued_job)
+
+
 if __name__ == '__main__':
     # # DEBUG: Limit memory usage
     # import resource
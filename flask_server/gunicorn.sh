@@ -1 +1,3 @@
-poetry run gunicorn enrichment_server:app  -w 4 --threads 1 -b 0.0.0.0:4321 --timeout 4000
+# Threaded workers: The route classes (modules/route_classes) limit how many requests of each class run at once,
+# GUNICORN_THREADS has to be larger than the sum of all <CLASS>_WORKERS and <CLASS>_QUEUE, so GET / always finds a thread
+poetry run gunicorn enrichment_server:app  -w ${GUNICORN_WORKERS:-4} --worker-class gthread --threads ${GUNICORN_THREADS:-16} -b 0.0.0.0:4321 --timeout 4000
@@ -0,0 +1,94 @@
+"""
+Keeps the caches on disk bounded: Entries that were not used for max_age_days are deleted, and if the cache is still
+larger than max_mb, the least recently used entries go first. A cache marks an entry as used by touching it (see
+touch), so the modification time is the time of the last use.
+The caches are shared by all workers, so every worker evicts, but at most once per EVICTION_INTERVAL seconds per
+directory and in a background thread. Entries that another worker deleted in the meantime are skipped.
+"""
+import os
+import time
+import threading
+from pathlib import Path
+
+# Seconds between two evictions of the same directory by one worker
+EVICTION_INTERVAL = float(os.getenv('EVICTION_INTERVAL', '600'))
+# Temporary files of entries that are being written are left alone for this long
+TMP_SUFFIX = '.tmp'
+TMP_GRACE_SECONDS = 3600
+
+_lock = threading.Lock()
+# Per directory: When this worker last started an eviction
+_last_eviction = {}
+
+
+def touch(path: Path):
+    """
+    Marks a cache entry as used
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def list_entries(directory: Path) -> list[tuple[float, int, str]]:
+    # (last use, bytes, path) of each file below directory
+    entries = []
+    for root, _, files in os.walk(directory):
+        for file in files:
+            path = os.path.join(root, file)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+
+def evict(directory: Path, max_mb: float, max_age_days: float, remove_directories: bool = False) -> int:
+    """
+    Deletes the entries of the cache in directory that are too old or do not fit into max_mb, returns how many.
+    With remove_directories, the directories that were emptied are deleted as well.
+    """
+    now = time.time()
+    entries = sorted(list_entries(directory))
+    size = sum(entry_size for _, entry_size, _ in entries)
+    max_bytes = max_mb * 1024 * 1024
+    removed = 0
+    for last_use, entry_size, path in entries:
+        if path.endswith(TMP_SUFFIX):
+            expired = now - last_use > TMP_GRACE_SECONDS
+        else:
+            expired = now - last_use > max_age_days * 24 * 3600 or size > max_bytes
+        if not expired:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            continue
+        size -= entry_size
+        removed += 1
+        if remove_directories and Path(path).parent != Path(directory):
+            try:
+                os.rmdir(Path(path).parent)
+            except OSError:
+                # Not empty yet
+                pass
+    if removed > 0:
+        print(f'Evicted {removed} entries from {directory}, {size / (1024 * 1024):.1f} MB remain.')
+    return removed
+
+
+def schedule(directory: Path, max_mb: float, max_age_days: float, remove_directories: bool = False):
+    """
+    Evicts in a background thread, unless this worker evicted the directory less than EVICTION_INTERVAL ago
+    """
+    now = time.monotonic()
+    with _lock:
+        last_eviction = _last_eviction.get(directory)
+        if last_eviction is not None and now - last_eviction < EVICTION_INTERVAL:
+            return
+        _last_eviction[directory] = now
+    threading.Thread(target=evict, args=(directory, max_mb, max_age_days, remove_directories), daemon=True).start()
@@ -0,0 +1,213 @@
+"""
+Cooperative cancellation of jobs nobody waits for anymore: The client closed the connection (e.g. the PTMNavigator tab
+was closed), or a queued job was cancelled with DELETE /jobs/<job_id> (see modules/job_queue).
+A watcher thread checks the connection of the request. On cancellation, the child processes of the job (Rscript via
+job_budget.run, Cytoscape) are killed with their whole process tree, the loops over experiments stop at their next
+check_cancelled() and JobCancelled ends the request, whose workspace is then released as after any failed request.
+Each cancelled job reports the CPU time it had used and an estimate of the CPU time it would still have used (the
+mean of the completed jobs of its route minus what it had used), the reclaimed CPU seconds in /metrics.
+"""
+import os
+import time
+import signal
+import socket
+import functools
+import threading
+import contextvars
+import subprocess
+from dataclasses import dataclass, field
+import werkzeug
+
+# A job is cancelled when its client disconnects, unless this is 0
+CANCEL_ON_DISCONNECT = os.getenv('CANCEL_ON_DISCONNECT', '1') == '1'
+# Seconds between two checks of the client connection
+CANCEL_CHECK_INTERVAL = float(os.getenv('CANCEL_CHECK_INTERVAL', '1'))
+# Where the WSGI servers put the client socket
+SOCKET_ENVIRON_KEYS = ['gunicorn.socket', 'werkzeug.socket']
+DISCONNECT = 'disconnect'
+CANCELLED = 'cancelled'
+# A queued job whose lease went to another worker, which runs it again
+SUPERSEDED = 'superseded'
+
+# The cancellation of the current job, threads started by the job have to copy the context
+CURRENT_CANCELLATION = contextvars.ContextVar('current_cancellation', default=None)
+
+_stats_lock = threading.Lock()
+# Per method: completed jobs and their CPU seconds, to estimate what a cancelled job would have used
+_completed = {}
+# Per method and reason: cancelled jobs, CPU seconds used before the cancellation, reclaimed CPU seconds, killed
+# process trees
+_cancelled = {}
+
+
+class JobCancelled(Exception):
+    def __init__(self, reason: str):
+        super().__init__(f'The job was cancelled ({reason})')
+        self.reason = reason
+
+
+@dataclass
+class Cancellation:
+    reason: str = None
+    processes: list = field(default_factory=list)
+    killed_processes: int = 0
+    # CPU seconds of the finished child processes
+    child_cpu_seconds: float = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def cancel(self, reason: str):
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            processes = list(self.processes)
+            self.killed_processes += len(processes)
+        for process in processes:
+            kill_process_tree(process)
+
+    def register(self, process: subprocess.Popen):
+        with self._lock:
+            cancelled = self.reason is not None
+            if cancelled:
+                self.killed_processes += 1
+            else:
+                self.processes.append(process)
+        if cancelled:
+            # Started after the cancellation
+            kill_process_tree(process)
+
+    def unregister(self, process: subprocess.Popen, cpu_seconds: float = 0):
+        with self._lock:
+            if process in self.processes:
+                self.processes.remove(process)
+            self.child_cpu_seconds += cpu_seconds
+
+    def check(self):
+        if self.reason is not None:
+            raise JobCancelled(self.reason)
+
+
+def kill_process_tree(process: subprocess.Popen):
+    """
+    Kills the process and everything it started. Children of the job lead their own session and process group (see
+    popen), so grandchildren like CPLEX started by Rscript are killed as well.
+    """
+    try:
+        if os.getpgid(process.pid) == process.pid:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        # Already gone
+        pass
+
+
+def popen(args, popen_class: type = None, **kwargs) -> subprocess.Popen:
+    """
+    Starts a child process of the current job in a new session, whose process group has the pid of the child, so it
+    can be killed with its process tree. The caller unregisters it once it finished.
+    """
+    # subprocess.Popen is looked up on each call, modules/profiling replaces it while a request is profiled
+    process = (popen_class or subprocess.Popen)(args, start_new_session=True, **kwargs)
+    cancellation = CURRENT_CANCELLATION.get()
+    if cancellation is not None:
+        cancellation.register(process)
+    return process
+
+
+def unregister(process: subprocess.Popen, cpu_seconds: float = 0):
+    cancellation = CURRENT_CANCELLATION.get()
+    if cancellation is not None:
+        cancellation.unregister(process, cpu_seconds)
+
+
+def check_cancelled():
+    """
+    Raises JobCancelled if the current job was cancelled. Called between experiments by the analyses.
+    """
+    cancellation = CURRENT_CANCELLATION.get()
+    if cancellation is not None:
+        cancellation.check()
+
+
+def is_disconnected(environ: dict) -> bool:
+    """
+    The request body was read completely, so a readable socket without data means the client closed the connection
+    """
+    client_socket = next((environ[key] for key in SOCKET_ENVIRON_KEYS if key in environ), None)
+    if client_socket is None:
+        return False
+    try:
+        return client_socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except (BlockingIOError, InterruptedError):
+        return False
+    except OSError:
+        return True
+
+
+def watch(cancellation: Cancellation, environ: dict, stop: threading.Event):
+    while not stop.wait(CANCEL_CHECK_INTERVAL):
+        if is_disconnected(environ):
+            cancellation.cancel(DISCONNECT)
+            return
+
+
+def record(method: str, cancellation: Cancellation, cpu_seconds: float):
+    with _stats_lock:
+        completed_jobs, completed_cpu_seconds = _completed.get(method, (0, 0.0))
+        if cancellation.reason is None:
+            _completed[method] = (completed_jobs + 1, completed_cpu_seconds + cpu_seconds)
+            return
+        expected_cpu_seconds = completed_cpu_seconds / completed_jobs if completed_jobs > 0 else 0
+        reclaimed = max(expected_cpu_seconds - cpu_seconds, 0)
+        key = (method, cancellation.reason)
+        jobs, used_total, reclaimed_total, killed_total = _cancelled.get(key, (0, 0.0, 0.0, 0))
+        _cancelled[key] = (jobs + 1, used_total + cpu_seconds, reclaimed_total + reclaimed,
+                           killed_total + cancellation.killed_processes)
+    print(f'{method} job cancelled ({cancellation.reason}) after {cpu_seconds:.1f} CPU seconds, '
+          f'{cancellation.killed_processes} process trees killed, about {reclaimed:.1f} CPU seconds reclaimed.')
+
+
+def cancellable(method: str, request: werkzeug.Request):
+    """
+    Decorator for request handlers: The job can be cancelled while it runs. A job of the queue is cancelled by its
+    queue worker (see job_queue.run_once), which sets CURRENT_CANCELLATION before it runs the handler.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            cancellation = CURRENT_CANCELLATION.get()
+            token = None
+            if cancellation is None:
+                cancellation = Cancellation()
+                token = CURRENT_CANCELLATION.set(cancellation)
+            stop = threading.Event()
+            if CANCEL_ON_DISCONNECT and any(key in request.environ for key in SOCKET_ENVIRON_KEYS):
+                threading.Thread(target=watch, args=(cancellation, request.environ, stop), daemon=True).start()
+            start_cpu = time.thread_time()
+            try:
+                # E.g. the client left while the request waited for a slot of its route class
+                if CANCEL_ON_DISCONNECT and is_disconnected(request.environ):
+                    cancellation.cancel(DISCONNECT)
+                cancellation.check()
+                return handler(*args, **kwargs)
+            finally:
+                stop.set()
+                record(method, cancellation, time.thread_time() - start_cpu + cancellation.child_cpu_seconds)
+                if token is not None:
+                    CURRENT_CANCELLATION.reset(token)
+        return wrapper
+    return decorator
+
+
+def get_prometheus_metrics() -> str:
+    with _stats_lock:
+        cancelled = dict(_cancelled)
+    lines = []
+    for (method, reason), (jobs, used, reclaimed, killed) in cancelled.items():
+        labels = f'method="{method}",reason="{reason}",pid="{os.getpid()}"'
+        lines += [f'enrichment_server_cancelled_jobs{{{labels}}} {jobs}',
+                  f'enrichment_server_cancelled_cpu_seconds{{{labels}}} {used:.3f}',
+                  f'enrichment_server_reclaimed_cpu_seconds{{{labels}}} {reclaimed:.3f}',
+                  f'enrichment_server_killed_process_trees{{{labels}}} {killed}']
+    return '\n'.join(lines) + '\n'
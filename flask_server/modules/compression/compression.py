@@ -0,0 +1,125 @@
+"""
+Compression of responses, negotiated through Accept-Encoding. The body is compressed while it is sent, chunk by chunk
+as it comes from the file that send_file streams, so it is never held in memory as a whole, compressed or not.
+zstd is preferred if the client accepts it and zstandard is installed, otherwise gzip.
+Bytes in and out and the CPU time spent compressing are reported per response and in /metrics.
+"""
+import os
+import time
+import zlib
+import threading
+import werkzeug.datastructures
+import werkzeug.wrappers
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RESPONSE_COMPRESSION = os.getenv('RESPONSE_COMPRESSION', '1') == '1'
+# 1 (fastest) to 9 (smallest), zlib's default is 6
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '6'))
+# 1 (fastest) to 22 (smallest), zstd's default is 3
+COMPRESSION_ZSTD_LEVEL = int(os.getenv('COMPRESSION_ZSTD_LEVEL', '3'))
+# Smaller responses are sent as they are, the headers of the compressed stream would outweigh the savings
+COMPRESSION_MIN_BYTES = int(os.getenv('COMPRESSION_MIN_BYTES', '1024'))
+
+_stats_lock = threading.Lock()
+# Per coding: responses, bytes in, bytes out, CPU seconds
+_stats = {}
+
+
+def get_codings() -> list[str]:
+    return (['zstd'] if zstandard is not None else []) + ['gzip']
+
+
+def negotiate(accept_encodings: werkzeug.datastructures.Accept) -> str | None:
+    """
+    The content coding for the response, None to send it uncompressed
+    """
+    if not RESPONSE_COMPRESSION:
+        return None
+    return accept_encodings.best_match(get_codings())
+
+
+def get_etag(etag: str, coding: str | None) -> str:
+    # Each coding is a different representation, which needs its own strong ETag
+    return etag if coding is None else f'{etag}-{coding}'
+
+
+def get_compressor(coding: str, level: int = None):
+    if coding == 'zstd':
+        return zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL if level is None else level).compressobj()
+    # wbits 31: gzip header and trailer
+    return zlib.compressobj(COMPRESSION_GZIP_LEVEL if level is None else level, zlib.DEFLATED, 31)
+
+
+def record(coding: str, bytes_in: int, bytes_out: int, cpu_seconds: float):
+    with _stats_lock:
+        responses, total_in, total_out, total_cpu_seconds = _stats.get(coding, (0, 0, 0, 0.0))
+        _stats[coding] = (responses + 1, total_in + bytes_in, total_out + bytes_out, total_cpu_seconds + cpu_seconds)
+    saved = 1 - bytes_out / bytes_in if bytes_in > 0 else 0
+    print(f'Compressed response ({coding}): {bytes_in} -> {bytes_out} bytes ({saved:.0%} saved) '
+          f'in {cpu_seconds * 1000:.1f} ms CPU.')
+
+
+def iter_compressed(chunks, coding: str):
+    compressor = get_compressor(coding)
+    bytes_in = bytes_out = 0
+    cpu_seconds = 0.0
+    try:
+        for chunk in chunks:
+            chunk = chunk.encode() if isinstance(chunk, str) else chunk
+            start = time.thread_time()
+            compressed = compressor.compress(chunk)
+            cpu_seconds += time.thread_time() - start
+            bytes_in += len(chunk)
+            bytes_out += len(compressed)
+            if compressed:
+                yield compressed
+        start = time.thread_time()
+        compressed = compressor.flush()
+        cpu_seconds += time.thread_time() - start
+        bytes_out += len(compressed)
+        yield compressed
+        record(coding, bytes_in, bytes_out, cpu_seconds)
+    finally:
+        # Closes the file of send_file, also if the client went away before the end
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress(response: werkzeug.wrappers.Response,
+             accept_encodings: werkzeug.datastructures.Accept) -> werkzeug.wrappers.Response:
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if response.content_length is not None and response.content_length < COMPRESSION_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    coding = negotiate(accept_encodings)
+    if coding is None:
+        return response
+
+    etag, is_weak = response.get_etag()
+    # The original iterable is closed by iter_compressed
+    response.response = iter_compressed(response.response, coding)
+    response.headers['Content-Encoding'] = coding
+    response.headers.pop('Content-Length', None)
+    # Byte ranges would refer to the compressed body
+    response.headers.pop('Accept-Ranges', None)
+    if etag is not None:
+        response.set_etag(get_etag(etag, coding), weak=is_weak)
+    return response
+
+
+def get_prometheus_metrics() -> str:
+    with _stats_lock:
+        stats = dict(_stats)
+    lines = []
+    for coding, (responses, bytes_in, bytes_out, cpu_seconds) in stats.items():
+        labels = f'coding="{coding}",pid="{os.getpid()}"'
+        lines += [f'enrichment_server_compressed_responses{{{labels}}} {responses}',
+                  f'enrichment_server_compression_bytes_in{{{labels}}} {bytes_in}',
+                  f'enrichment_server_compression_bytes_out{{{labels}}} {bytes_out}',
+                  f'enrichment_server_compression_cpu_seconds{{{labels}}} {cpu_seconds:.6f}']
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,31 @@
+import os
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# Matrices that cross the Python/R boundary are exchanged as Arrow IPC files by default.
+# Set DATA_EXCHANGE_FORMAT=text to fall back to plain CSV files, e.g. to inspect intermediate results when debugging.
+DATA_EXCHANGE_FORMAT = os.getenv('DATA_EXCHANGE_FORMAT', 'arrow')
+ARROW_SUFFIX = '.arrow'
+TEXT_SUFFIX = '.csv'
+
+
+def matrix_path(output_dir: Path, stem: str) -> Path:
+    suffix = TEXT_SUFFIX if DATA_EXCHANGE_FORMAT == 'text' else ARROW_SUFFIX
+    return output_dir / f'{stem}{suffix}'
+
+
+def write_matrix(df: pd.DataFrame, path: Path, header=True) -> Path:
+    if path.suffix == ARROW_SUFFIX:
+        # Uncompressed IPC files can be memory-mapped by the reader without any decoding
+        feather.write_feather(pa.Table.from_pandas(df, preserve_index=False), path, compression='uncompressed')
+    else:
+        df.to_csv(path, index=False, header=header)
+    return path
+
+
+def read_matrix(path: Path, header=True) -> pd.DataFrame:
+    if path.suffix == ARROW_SUFFIX:
+        return feather.read_table(path, memory_map=True).to_pandas()
+    return pd.read_csv(path, header=0 if header else None)
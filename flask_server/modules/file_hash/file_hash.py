@@ -0,0 +1,13 @@
+"""
+Content hashes of files. Only uses the standard library, so it can be imported on the startup path of the server.
+"""
+import hashlib
+from pathlib import Path
+
+
+def hash_file(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
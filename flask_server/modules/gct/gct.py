@@ -0,0 +1,151 @@
+from dataclasses import dataclass
+from pathlib import Path
+import pandas as pd
+
+# R (and therefore ssGSEA2.0) turns these characters into dots when it uses a column name as a variable name,
+# e.g. the row metadata of an experiment called 'Exp-01' is named 'pvalue.Exp.01'
+R_SPECIAL_CHARACTERS_MAPPING = str.maketrans({elem: '.' for elem in [
+    " ",  # Space
+    "+",  # Plus
+    "-",  # Minus
+    "*",  # Multiplication
+    "/",  # Division
+    "^",  # Exponentiation
+    "#",  # Pound sign
+    "%",  # Percentage
+    "&",  # Ampersand
+    "!",  # Exclamation mark
+    "?",  # Question mark
+    ",",  # Comma
+    ".",  # Period (when at the start of a name)
+    ";",  # Semicolon
+    ":",  # Colon
+    "@",  # At sign
+    "~",  # Tilde
+    "\\",  # Backslash
+    '"',  # Double quotation mark
+    "'",  # Single quotation mark
+    "(",  # Left parenthesis
+    ")",  # Right parenthesis
+    "<",  # Left angle bracket
+    ">",  # Right angle bracket
+    "{",  # Left curly bracket
+    "}",  # Right curly bracket
+    "[",  # Left square bracket
+    "]",  # Right square bracket
+    "$",  # Dollar sign
+    "=",  # Equal sign
+    "|",  # Pipe
+    "`"  # Backtick
+]})
+
+NA_VALUES = ['', 'NA', 'na', 'NaN', 'nan', '-666']
+# Number of rows that are formatted at once when writing, so the full text never has to exist in memory
+WRITE_CHUNK_SIZE = 5000
+
+
+@dataclass
+class GCTHeader:
+    version: str
+    n_rows: int
+    n_row_metadata: int
+    n_col_metadata: int
+    row_metadata_columns: list[str]
+    data_columns: list[str]
+
+
+@dataclass
+class GCT:
+    data_df: pd.DataFrame
+    row_metadata_df: pd.DataFrame
+    col_metadata_df: pd.DataFrame
+
+
+def sanitize_r_name(name: str) -> str:
+    return name.translate(R_SPECIAL_CHARACTERS_MAPPING)
+
+
+def read_header(gct_file: Path) -> GCTHeader:
+    with open(gct_file) as f:
+        version = f.readline().strip()
+        dims = [int(dim) for dim in f.readline().split('\t')]
+        columns = f.readline().rstrip('\n').split('\t')
+
+    match version:
+        case '#1.2':
+            # 1.2 has a fixed layout: Name, Description, data columns
+            n_rows, _ = dims
+            n_row_metadata, n_col_metadata = 1, 0
+        case '#1.3':
+            n_rows, _, n_row_metadata, n_col_metadata = dims
+        case _:
+            raise ValueError(f'Unsupported GCT version {version} in {gct_file}')
+
+    return GCTHeader(version=version,
+                     n_rows=n_rows,
+                     n_row_metadata=n_row_metadata,
+                     n_col_metadata=n_col_metadata,
+                     row_metadata_columns=columns[1:n_row_metadata + 1],
+                     data_columns=columns[n_row_metadata + 1:])
+
+
+def read_gct(gct_file: Path, row_metadata_columns: list[str] = None, read_col_metadata=True) -> GCT:
+    """
+    Parse a GCT 1.2 or 1.3 file.
+    Only the requested row metadata columns are parsed (all of them if row_metadata_columns is None),
+    numeric metadata gets a numeric dtype and the data matrix is always float64.
+    """
+    header = read_header(gct_file)
+    if row_metadata_columns is None:
+        row_metadata_columns = header.row_metadata_columns
+    missing_columns = set(row_metadata_columns) - set(header.row_metadata_columns)
+    if missing_columns:
+        raise KeyError(f'Row metadata columns {sorted(missing_columns)} not found in {gct_file}')
+
+    all_columns = ['id'] + header.row_metadata_columns + header.data_columns
+    usecols = ['id'] + row_metadata_columns + header.data_columns
+    body = pd.read_csv(gct_file, sep='\t', header=None, names=all_columns, usecols=usecols,
+                       skiprows=3 + header.n_col_metadata, nrows=header.n_rows,
+                       # The identifiers are kept as they are, e.g. the gene 'NA' must not become a missing value
+                       dtype={'id': str, **{col: 'float64' for col in header.data_columns}},
+                       keep_default_na=False, na_values={col: NA_VALUES for col in usecols[1:]},
+                       engine='c')
+    body = body.set_index('id')
+
+    col_metadata_df = pd.DataFrame(index=header.data_columns)
+    if read_col_metadata and header.n_col_metadata > 0:
+        col_metadata_rows = pd.read_csv(gct_file, sep='\t', header=None, names=all_columns,
+                                        usecols=['id'] + header.data_columns,
+                                        skiprows=3, nrows=header.n_col_metadata, dtype=str, keep_default_na=False)
+        col_metadata_df = col_metadata_rows.set_index('id').T
+
+    return GCT(data_df=body[header.data_columns],
+               row_metadata_df=body[row_metadata_columns],
+               col_metadata_df=col_metadata_df)
+
+
+def write_gct(gct_file: Path, data_df: pd.DataFrame, row_metadata_df: pd.DataFrame = None,
+              col_metadata_df: pd.DataFrame = None) -> Path:
+    """
+    Write a GCT 1.3 file. The index of data_df holds the row ids, the index of col_metadata_df the data column names.
+    """
+    if row_metadata_df is None:
+        row_metadata_df = pd.DataFrame(index=data_df.index)
+    if col_metadata_df is None:
+        col_metadata_df = pd.DataFrame(index=data_df.columns)
+
+    with open(gct_file, 'w') as f:
+        f.write("#1.3\n")
+        f.write(f"{data_df.shape[0]}\t{data_df.shape[1]}\t{row_metadata_df.shape[1]}\t{col_metadata_df.shape[1]}\n")
+        f.write('\t'.join(['id'] + list(row_metadata_df.columns) + list(data_df.columns)) + '\n')
+        for field in col_metadata_df.columns:
+            f.write('\t'.join([field] + ['na'] * row_metadata_df.shape[1]
+                              + col_metadata_df.loc[data_df.columns, field].astype(str).tolist()) + '\n')
+        for start in range(0, data_df.shape[0], WRITE_CHUNK_SIZE):
+            chunk = data_df.iloc[start:start + WRITE_CHUNK_SIZE]
+            if row_metadata_df.shape[1] > 0:
+                # Positional concatenation, row ids are not necessarily unique (e.g. gene-centric redundant input)
+                chunk = pd.concat([row_metadata_df.iloc[start:start + WRITE_CHUNK_SIZE].reset_index(drop=True),
+                                   chunk.reset_index(drop=True)], axis=1).set_index(chunk.index)
+            chunk.to_csv(f, sep='\t', header=False)
+    return gct_file
@@ -0,0 +1,261 @@
+import os
+import time
+import ctypes
+import signal
+import shutil
+import resource
+import functools
+import threading
+import contextvars
+import subprocess
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from modules.profiling import profiling
+from modules.cancellation import cancellation
+from modules.workspace import workspace
+
+# Budget per route class (see modules/route_classes): <CLASS>_MEMORY_MB, <CLASS>_CPU_SECONDS and <CLASS>_DISK_MB
+BUDGET_DEFAULTS = {
+    'fast': (4096, 600, 1024),
+    'medium': (8192, 3600, 4096),
+    'heavy': (16384, 14400, 8192),
+}
+# Seconds between two checks of the Python-side usage of a job
+BUDGET_CHECK_INTERVAL = float(os.getenv('BUDGET_CHECK_INTERVAL', '0.5'))
+# R reports failed allocations with this message instead of crashing
+R_ALLOCATION_ERROR = 'cannot allocate'
+# util-linux prlimit sets the rlimits and then execs the child, so they apply from its first instruction on
+PRLIMIT_PATH = shutil.which('prlimit')
+
+# The budget of the current request, threads started by the request have to copy the context
+CURRENT_BUDGET = contextvars.ContextVar('current_budget', default=None)
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, resource_name: str, limit: float, usage: float, source: str):
+        super().__init__(f'{source} exceeded the {resource_name} budget of the job ({usage:.0f} > {limit:.0f})')
+        self.resource_name = resource_name
+        self.limit = limit
+        self.usage = usage
+        self.source = source
+
+    def to_dict(self) -> dict:
+        unit = 'CPU seconds' if self.resource_name == 'cpu' else 'MB'
+        return {'type': 'BudgetExceeded', 'resource': self.resource_name, 'unit': unit, 'limit': self.limit,
+                'usage': round(self.usage, 1), 'source': self.source, 'message': str(self)}
+
+
+class BudgetInterrupt(BaseException):
+    """
+    Raised asynchronously in the request thread by the watchdog, the handler turns it into BudgetExceeded.
+    Like KeyboardInterrupt it is no Exception, so 'except Exception' in the analyses does not swallow it.
+    """
+
+
+@dataclass
+class JobBudget:
+    """
+    Memory, CPU and disk budget of one job. Each child process gets it as rlimits (RLIMIT_AS, RLIMIT_CPU and
+    RLIMIT_FSIZE, so no single file of a child outgrows the disk budget), which are inherited by its own children
+    (e.g. CPLEX started by Rscript).
+    The in-process work is tracked by a watchdog thread: The CPU time of the request thread and the size of the job's
+    workspace. On overrun, the running children are killed with their process trees and BudgetExceeded is raised
+    in the request thread. The memory budget only applies to the
+    children, the threads of a worker share one heap, so the Python memory of a job cannot be told apart from the
+    memory of the other jobs of the worker.
+    """
+    memory_mb: int
+    cpu_seconds: int
+    disk_mb: int
+    workspace: Path = None
+    cpu_time: float = 0
+    peak_disk_mb: float = 0
+    children: list = field(default_factory=list)
+    exceeded: BudgetExceeded = None
+    # Children that are running
+    processes: list = field(default_factory=list)
+
+    def get_rlimits(self, memory_shares: int = 1) -> dict[int, tuple[int, int]]:
+        memory_bytes = self.memory_mb * 1024 * 1024 // memory_shares
+        disk_bytes = self.disk_mb * 1024 * 1024
+        return {resource.RLIMIT_AS: (memory_bytes, memory_bytes),
+                resource.RLIMIT_CPU: (self.cpu_seconds, self.cpu_seconds + 5),
+                resource.RLIMIT_FSIZE: (disk_bytes, disk_bytes)}
+
+    def wrap_args(self, args: list, memory_shares: int = 1) -> list:
+        """
+        The command line that runs args under the rlimits of the budget with prlimit. A preexec_fn would run Python
+        code between fork and exec, which can deadlock in a threaded worker.
+        The processes the child starts inherit the limits.
+        """
+        options = {resource.RLIMIT_AS: '--as', resource.RLIMIT_CPU: '--cpu', resource.RLIMIT_FSIZE: '--fsize'}
+        limits = [f'{options[limit]}={soft}:{hard}' for limit, (soft, hard) in self.get_rlimits(memory_shares).items()]
+        return [PRLIMIT_PATH, *limits, '--', *args]
+
+    def apply_rlimits(self, pid: int, memory_shares: int = 1):
+        # Without prlimit the limits are set right after the start, the child might run briefly without them
+        try:
+            for limit, values in self.get_rlimits(memory_shares).items():
+                resource.prlimit(pid, limit, values)
+        except ProcessLookupError:
+            # Already exited
+            pass
+
+    def kill_processes(self):
+        for process in list(self.processes):
+            cancellation.kill_process_tree(process)
+
+    def measure_workspace(self) -> float:
+        if self.workspace is not None:
+            self.peak_disk_mb = max(self.peak_disk_mb, workspace.get_size(self.workspace) / (1024 * 1024))
+        return self.peak_disk_mb
+
+    def record_child(self, args, rusage: resource.struct_rusage | None):
+        # Without rusage the child was reaped by someone else, e.g. when communicate was interrupted
+        self.children.append({'command': ' '.join(str(arg) for arg in args[:2]),
+                              # Linux reports ru_maxrss in KiB
+                              'peak_memory_mb': None if rusage is None else round(rusage.ru_maxrss / 1024, 1),
+                              'cpu_time': None if rusage is None else round(get_cpu_seconds(rusage), 1)})
+
+
+def get_cpu_seconds(rusage: resource.struct_rusage | None) -> float:
+    return 0 if rusage is None else rusage.ru_utime + rusage.ru_stime
+
+
+class MeasuredPopen(subprocess.Popen):
+    """
+    Popen that reaps the child with wait4 to get its peak memory and CPU time
+    """
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return self.pid, 0
+        if pid == self.pid:
+            self.rusage = rusage
+        return pid, sts
+
+
+def run(args: list, memory_shares: int = 1, **kwargs) -> subprocess.CompletedProcess:
+    """
+    Like subprocess.run, but the child runs under the budget of the current job and is killed with its process tree
+    if the job is cancelled (see modules/cancellation).
+    Children that run at the same time pass their number as memory_shares, each of them gets that share of the memory
+    budget.
+    Raises BudgetExceeded if the child was stopped by its CPU limit or could not allocate memory, JobCancelled if the
+    job was cancelled.
+    """
+    budget = CURRENT_BUDGET.get()
+    if budget is None:
+        return subprocess.run(args, **kwargs)
+
+    if kwargs.pop('capture_output', False):
+        kwargs['stdout'] = kwargs['stderr'] = subprocess.PIPE
+    start_time = time.perf_counter()
+    process = cancellation.popen(args if PRLIMIT_PATH is None else budget.wrap_args(args, memory_shares),
+                                 MeasuredPopen, **kwargs)
+    budget.processes.append(process)
+    try:
+        with process:
+            try:
+                if PRLIMIT_PATH is None:
+                    budget.apply_rlimits(process.pid, memory_shares)
+                stdout, stderr = process.communicate()
+            except BudgetInterrupt:
+                # Popen.__exit__ waits for the child, which must not run to its end
+                cancellation.kill_process_tree(process)
+                raise
+    finally:
+        budget.processes.remove(process)
+        cancellation.unregister(process, get_cpu_seconds(process.rusage))
+    budget.record_child(args, process.rusage)
+    profiler = profiling.ACTIVE_PROFILER.get()
+    if profiler is not None:
+        profiler.record_child(args, time.perf_counter() - start_time, process.rusage)
+    completed_process = subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+    # A child that was killed because the job was cancelled did not fail
+    cancellation.check_cancelled()
+
+    source = str(args[1]) if len(args) > 1 else str(args[0])
+    if process.returncode == -signal.SIGXCPU:
+        raise BudgetExceeded('cpu', budget.cpu_seconds,
+                             get_cpu_seconds(process.rusage) if process.rusage is not None else budget.cpu_seconds,
+                             source)
+    if process.returncode == -signal.SIGXFSZ:
+        raise BudgetExceeded('disk', budget.disk_mb, max(budget.measure_workspace(), budget.disk_mb), source)
+    if process.returncode != 0 and R_ALLOCATION_ERROR in str(stderr):
+        memory_limit = budget.memory_mb / memory_shares
+        raise BudgetExceeded('memory', memory_limit,
+                             process.rusage.ru_maxrss / 1024 if process.rusage is not None else memory_limit, source)
+    return completed_process
+
+
+def interrupt_thread(thread_id: int):
+    # The exception is raised in the request thread the next time it executes Python code
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), ctypes.py_object(BudgetInterrupt))
+
+
+def watch(budget: JobBudget, thread_id: int, stop: threading.Event):
+    cpu_clock = time.pthread_getcpuclockid(thread_id)
+    start_cpu = time.clock_gettime(cpu_clock)
+    while not stop.wait(BUDGET_CHECK_INTERVAL):
+        budget.cpu_time = time.clock_gettime(cpu_clock) - start_cpu
+        budget.measure_workspace()
+        if budget.exceeded is not None:
+            continue
+        if budget.cpu_time > budget.cpu_seconds:
+            budget.exceeded = BudgetExceeded('cpu', budget.cpu_seconds, budget.cpu_time, 'Python')
+        elif budget.peak_disk_mb > budget.disk_mb:
+            budget.exceeded = BudgetExceeded('disk', budget.disk_mb, budget.peak_disk_mb, 'Workspace')
+        else:
+            continue
+        # The request thread might wait for a child in C code, where the interrupt is only delivered once it returns
+        budget.kill_processes()
+        interrupt_thread(thread_id)
+
+
+def get_budget(route_class_name: str) -> JobBudget:
+    memory_mb, cpu_seconds, disk_mb = BUDGET_DEFAULTS[route_class_name]
+    return JobBudget(memory_mb=int(os.getenv(f'{route_class_name.upper()}_MEMORY_MB', str(memory_mb))),
+                     cpu_seconds=int(os.getenv(f'{route_class_name.upper()}_CPU_SECONDS', str(cpu_seconds))),
+                     disk_mb=int(os.getenv(f'{route_class_name.upper()}_DISK_MB', str(disk_mb))))
+
+
+def set_workspace(job_workspace: Path):
+    # The workspace is created after the budget, once the request is validated
+    budget = CURRENT_BUDGET.get()
+    if budget is not None:
+        budget.workspace = job_workspace
+
+
+def budgeted(route_class_name: str):
+    """
+    Decorator for request handlers: The handler runs under the budget of its route class.
+    The peak usage is logged after each job, so the budgets can be tuned.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            budget = get_budget(route_class_name)
+            token = CURRENT_BUDGET.set(budget)
+            stop = threading.Event()
+            watchdog = threading.Thread(target=watch, args=(budget, threading.get_ident(), stop), daemon=True)
+            watchdog.start()
+            try:
+                return handler(*args, **kwargs)
+            except BudgetInterrupt:
+                raise budget.exceeded
+            finally:
+                stop.set()
+                watchdog.join()
+                CURRENT_BUDGET.reset(token)
+                # Jobs shorter than BUDGET_CHECK_INTERVAL are never sampled, the workspace is released after this
+                budget.measure_workspace()
+                print(f'Job usage ({route_class_name}): Python CPU {budget.cpu_time:.1f} s of {budget.cpu_seconds} s, '
+                      f'workspace peak {budget.peak_disk_mb:.1f} MB of {budget.disk_mb} MB, '
+                      f'children {budget.children}')
+        return wrapper
+    return decorator
@@ -0,0 +1,491 @@
+"""
+Optional job queue shared by all replicas (JOB_QUEUE_DIR). The replica that receives an analysis request puts it into
+the queue and waits for the result, while worker threads of every replica claim the jobs of their route class.
+A burst of heavy requests of one user is therefore spread over all replicas, instead of piling up on the replica that
+received them.
+A claimed job is leased: The worker renews the lease with heartbeats, and the job of a replica that died is claimed
+again once its lease expired. Results are stored in the queue, so any replica can serve them (GET /jobs/<job_id>).
+JobQueue is the interface. SQLiteJobQueue keeps the jobs in a SQLite database and inputs and results as files next to
+it, which works for replicas that share a local volume. Other backends are added to BACKENDS.
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import sqlite3
+import functools
+import threading
+import contextlib
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+import werkzeug
+
+from modules.route_classes import route_classes
+from modules.cancellation import cancellation
+from modules.uploads import uploads
+from modules.workspace import workspace
+
+# The queue is off without a directory, then each replica runs the requests it receives
+JOB_QUEUE_DIR = os.getenv('JOB_QUEUE_DIR', '')
+JOB_QUEUE_BACKEND = os.getenv('JOB_QUEUE_BACKEND', 'sqlite')
+# A job whose lease is not renewed for this long is claimed by another worker
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '30'))
+# Jobs that were claimed this often (e.g. because they crash every replica) fail instead
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# Pending jobs per route class, further requests are rejected with 503 like in modules/route_classes
+JOB_QUEUE_MAX_PENDING = int(os.getenv('JOB_QUEUE_MAX_PENDING', '64'))
+# Seconds between two polls of an idle worker or a waiting request
+JOB_QUEUE_POLL_INTERVAL = float(os.getenv('JOB_QUEUE_POLL_INTERVAL', '0.25'))
+# Results of asynchronous jobs are kept this long
+JOB_RESULT_TTL = float(os.getenv('JOB_RESULT_TTL', '3600'))
+# Set in the WSGI environ of a request that a queue worker runs, so it is not queued again
+JOB_ENVIRON_KEY = 'enrichment_server.job_id'
+# Request headers that are passed on to the replica that runs the job (see modules/profiling,
+# modules/result_encoding and modules/compression). The result is stored as it is sent, e.g. compressed.
+FORWARDED_HEADERS = ['X-Profile', 'X-Admin-Token', 'Accept', 'Accept-Encoding', 'If-None-Match']
+TRUE_VALUES = ('1', 'true')
+# A handler that answered with a quick approximation (mode=preview) sets this header. The result of an async job
+# is then served while the job runs again with mode=full.
+RESULT_STAGE_HEADER = 'X-Result-Stage'
+PREVIEW_STAGE = 'preview'
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    route_class TEXT NOT NULL,
+    route TEXT NOT NULL,
+    form TEXT NOT NULL,
+    headers TEXT NOT NULL,
+    has_input INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    submitted REAL NOT NULL,
+    finished REAL,
+    status INTEGER,
+    response_headers TEXT,
+    result_file TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_by_class ON jobs (route_class, state, submitted);
+"""
+
+
+@dataclass
+class Job:
+    job_id: str
+    route_class: str
+    route: str
+    # Form fields as (key, value) pairs, a field can occur more than once
+    form: list[tuple[str, str]]
+    headers: dict[str, str]
+    input_path: Path | None
+    # pending, running or done. A job that is refined is pending or running again, with its preview result.
+    state: str
+    attempts: int = 0
+    worker: str = None
+
+
+@dataclass
+class JobResult:
+    status: int
+    headers: dict[str, str]
+    body: bytes
+
+
+class JobQueue(ABC):
+    def __init__(self, lease_seconds: float = JOB_LEASE_SECONDS, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    @abstractmethod
+    def submit(self, route_class: str, route: str, form: list[tuple[str, str]], headers: dict[str, str],
+               input_path: Path | None) -> str:
+        """
+        Adds a pending job and takes over its input file, returns the job id
+        """
+
+    @abstractmethod
+    def claim(self, route_class: str, worker: str) -> Job | None:
+        """
+        Leases the oldest pending job of the route class, or one whose lease expired, to the worker
+        """
+
+    @abstractmethod
+    def heartbeat(self, job_id: str, worker: str) -> bool:
+        """
+        Renews the lease, False if the job was claimed by another worker in the meantime
+        """
+
+    @abstractmethod
+    def complete(self, job_id: str, worker: str, result: JobResult,
+                 refined_form: list[tuple[str, str]] = None) -> bool:
+        """
+        Stores the result. False if the job was claimed by another worker, then the result is dropped.
+        With refined_form, the result is provisional: It is served while the job is pending again with this form.
+        """
+
+    @abstractmethod
+    def get(self, job_id: str) -> Job | None:
+        pass
+
+    @abstractmethod
+    def get_result(self, job_id: str) -> JobResult | None:
+        """
+        The final or provisional result, None if there is none yet
+        """
+
+    @abstractmethod
+    def delete(self, job_id: str):
+        pass
+
+    @abstractmethod
+    def count(self, route_class: str = None) -> dict[str, int]:
+        """
+        Number of jobs by state
+        """
+
+    @abstractmethod
+    def purge(self, max_age: float) -> int:
+        """
+        Deletes the jobs that finished more than max_age seconds ago, returns how many
+        """
+
+
+class SQLiteJobQueue(JobQueue):
+    def __init__(self, directory: Path, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = Path(directory)
+        Path.mkdir(self.directory / 'inputs', parents=True, exist_ok=True)
+        Path.mkdir(self.directory / 'results', parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.directory / 'jobs.sqlite', timeout=60)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    @contextlib.contextmanager
+    def transaction(self, immediate: bool = False):
+        # One connection per transaction, so the queue can be used from any thread and after a fork.
+        # BEGIN IMMEDIATE takes the write lock right away, so two workers never claim the same job.
+        connection = sqlite3.connect(self.directory / 'jobs.sqlite', timeout=60, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            connection.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            yield connection
+            connection.execute('COMMIT')
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+
+    def get_input_path(self, job_id: str) -> Path:
+        return self.directory / 'inputs' / f'{job_id}.json'
+
+    def submit(self, route_class: str, route: str, form: list[tuple[str, str]], headers: dict[str, str],
+               input_path: Path | None) -> str:
+        job_id = uuid.uuid4().hex
+        if input_path is not None:
+            shutil.move(input_path, self.get_input_path(job_id))
+        with self.transaction() as connection:
+            connection.execute('INSERT INTO jobs (job_id, route_class, route, form, headers, has_input, state, '
+                               'submitted) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (job_id, route_class, route, json.dumps(form), json.dumps(headers),
+                                input_path is not None, 'pending', time.time()))
+        return job_id
+
+    def claim(self, route_class: str, worker: str) -> Job | None:
+        while True:
+            with self.transaction(immediate=True) as connection:
+                now = time.time()
+                row = connection.execute("SELECT * FROM jobs WHERE route_class = ? AND (state = 'pending' OR "
+                                         "(state = 'running' AND lease_expires < ?)) ORDER BY submitted LIMIT 1",
+                                         (route_class, now)).fetchone()
+                if row is None:
+                    return None
+                if row['attempts'] < self.max_attempts:
+                    connection.execute("UPDATE jobs SET state = 'running', worker = ?, lease_expires = ?, "
+                                       "attempts = attempts + 1 WHERE job_id = ?",
+                                       (worker, now + self.lease_seconds, row['job_id']))
+                    job = self.to_job(row)
+                    job.state, job.worker, job.attempts = 'running', worker, row['attempts'] + 1
+                    return job
+            # The job lost its worker too often, e.g. because it crashed every replica that ran it
+            print(f"Job {row['job_id']} failed, its worker stopped {row['attempts']} times.")
+            result = JobResult(500, CORS_HEADERS, f'Error: The job was started {row["attempts"]} times, but never '
+                                                  f'finished.\n'.encode())
+            self.complete(row['job_id'], row['worker'], result)
+
+    def heartbeat(self, job_id: str, worker: str) -> bool:
+        with self.transaction() as connection:
+            updated = connection.execute("UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND worker = ? AND "
+                                         "state = 'running'", (time.time() + self.lease_seconds, job_id, worker))
+            return updated.rowcount == 1
+
+    def complete(self, job_id: str, worker: str, result: JobResult,
+                 refined_form: list[tuple[str, str]] = None) -> bool:
+        # Another worker may complete the same job after its lease expired, so each writes its own file
+        result_file = f'{job_id}.{uuid.uuid4().hex[:8]}'
+        tmp_result = self.directory / 'results' / f'{result_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        tmp_result.write_bytes(result.body)
+        os.replace(tmp_result, self.directory / 'results' / result_file)
+        with self.transaction(immediate=True) as connection:
+            row = connection.execute("SELECT result_file FROM jobs WHERE job_id = ? AND worker IS ? "
+                                     "AND state != 'done'", (job_id, worker)).fetchone()
+            if row is not None and refined_form is None:
+                connection.execute("UPDATE jobs SET state = 'done', finished = ?, status = ?, response_headers = ?, "
+                                   "result_file = ? WHERE job_id = ?",
+                                   (time.time(), result.status, json.dumps(result.headers), result_file, job_id))
+            elif row is not None:
+                # Queued again behind the jobs that are already waiting, the input is kept for the refinement
+                connection.execute("UPDATE jobs SET state = 'pending', worker = NULL, lease_expires = NULL, "
+                                   "attempts = 0, submitted = ?, form = ?, status = ?, response_headers = ?, "
+                                   "result_file = ? WHERE job_id = ?",
+                                   (time.time(), json.dumps(refined_form), result.status,
+                                    json.dumps(result.headers), result_file, job_id))
+        if row is None:
+            (self.directory / 'results' / result_file).unlink()
+            return False
+        if row['result_file'] is not None:
+            (self.directory / 'results' / row['result_file']).unlink(missing_ok=True)
+        if refined_form is None:
+            self.get_input_path(job_id).unlink(missing_ok=True)
+        return True
+
+    def to_job(self, row: sqlite3.Row) -> Job:
+        return Job(job_id=row['job_id'], route_class=row['route_class'], route=row['route'],
+                   form=[tuple(field) for field in json.loads(row['form'])], headers=json.loads(row['headers']),
+                   input_path=self.get_input_path(row['job_id']) if row['has_input'] else None, state=row['state'],
+                   attempts=row['attempts'], worker=row['worker'])
+
+    def get(self, job_id: str) -> Job | None:
+        with self.transaction() as connection:
+            row = connection.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return None if row is None else self.to_job(row)
+
+    def get_result(self, job_id: str) -> JobResult | None:
+        with self.transaction() as connection:
+            row = connection.execute("SELECT status, response_headers, result_file FROM jobs WHERE job_id = ? "
+                                     "AND result_file IS NOT NULL", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return JobResult(row['status'], json.loads(row['response_headers']),
+                         (self.directory / 'results' / row['result_file']).read_bytes())
+
+    def delete(self, job_id: str):
+        with self.transaction() as connection:
+            row = connection.execute('DELETE FROM jobs WHERE job_id = ? RETURNING result_file', (job_id,)).fetchone()
+        self.get_input_path(job_id).unlink(missing_ok=True)
+        if row is not None and row['result_file'] is not None:
+            (self.directory / 'results' / row['result_file']).unlink(missing_ok=True)
+
+    def count(self, route_class: str = None) -> dict[str, int]:
+        with self.transaction() as connection:
+            rows = connection.execute('SELECT state, COUNT(*) AS n FROM jobs WHERE route_class = ? OR ? IS NULL '
+                                      'GROUP BY state', (route_class, route_class)).fetchall()
+        return {state: 0 for state in ['pending', 'running', 'done']} | {row['state']: row['n'] for row in rows}
+
+    def purge(self, max_age: float) -> int:
+        with self.transaction() as connection:
+            rows = connection.execute("SELECT job_id FROM jobs WHERE state = 'done' AND finished < ?",
+                                      (time.time() - max_age,)).fetchall()
+        for row in rows:
+            self.delete(row['job_id'])
+        return len(rows)
+
+
+BACKENDS = {
+    'sqlite': SQLiteJobQueue,
+}
+
+
+@functools.cache
+def get_queue() -> JobQueue | None:
+    if not JOB_QUEUE_DIR:
+        return None
+    return BACKENDS[JOB_QUEUE_BACKEND](Path(JOB_QUEUE_DIR))
+
+
+def keep_leased(queue: JobQueue, job_id: str, worker: str, stop: threading.Event,
+                job_cancellation: cancellation.Cancellation):
+    while not stop.wait(queue.lease_seconds / 3):
+        try:
+            if queue.heartbeat(job_id, worker):
+                continue
+            # Nobody waits for the result of this worker anymore, so the job is stopped
+            if queue.get(job_id) is None:
+                print(f'Job {job_id} was cancelled.')
+                job_cancellation.cancel(cancellation.CANCELLED)
+            else:
+                print(f'Job {job_id} lost its lease to another worker.')
+                job_cancellation.cancel(cancellation.SUPERSEDED)
+            return
+        except (OSError, sqlite3.Error) as error:
+            # Retried with the next heartbeat, if the lease runs out meanwhile, that heartbeat stops the job
+            print(f'Heartbeat of job {job_id} failed: {error}')
+
+
+def get_refined_form(job: Job, result: JobResult) -> list[tuple[str, str]] | None:
+    """
+    The form of the full run after a successful preview of an async job, None if there is nothing to refine.
+    A synchronous request already got the preview as its answer.
+    """
+    is_async = any(key == 'async' and value.lower() in TRUE_VALUES for key, value in job.form)
+    if result.status != 200 or result.headers.get(RESULT_STAGE_HEADER) != PREVIEW_STAGE or not is_async:
+        return None
+    return [(key, 'full' if key == 'mode' else value) for key, value in job.form]
+
+
+def run_once(queue: JobQueue, route_class: str, worker: str, execute: Callable[[Job], JobResult]) -> bool:
+    """
+    Claims and runs one job, returns False if there was none
+    """
+    job = queue.claim(route_class, worker)
+    if job is None:
+        return False
+    stop = threading.Event()
+    job_cancellation = cancellation.Cancellation()
+    heartbeat = threading.Thread(target=keep_leased, args=(queue, job.job_id, worker, stop, job_cancellation),
+                                 daemon=True)
+    heartbeat.start()
+    # The handler that runs the job picks up the cancellation (see cancellation.cancellable)
+    token = cancellation.CURRENT_CANCELLATION.set(job_cancellation)
+    try:
+        result = execute(job)
+    except Exception as error:
+        print(f'Job {job.job_id} failed: {error}')
+        result = JobResult(500, CORS_HEADERS, f'Error: {error}\n'.encode())
+    finally:
+        cancellation.CURRENT_CANCELLATION.reset(token)
+        stop.set()
+        heartbeat.join()
+    if not queue.complete(job.job_id, worker, result, get_refined_form(job, result)):
+        print(f'Result of job {job.job_id} dropped, the job was cancelled or claimed by another worker.')
+    return True
+
+
+def work(queue: JobQueue, route_class: str, worker: str, execute: Callable[[Job], JobResult],
+         stop: threading.Event):
+    while not stop.is_set():
+        try:
+            if not run_once(queue, route_class, worker, execute):
+                stop.wait(JOB_QUEUE_POLL_INTERVAL)
+        except (OSError, sqlite3.Error) as error:
+            # E.g. the shared volume is briefly unavailable, the lease of a claimed job runs out and it is retried
+            print(f'Job queue worker {worker} failed: {error}')
+            stop.wait(JOB_QUEUE_POLL_INTERVAL)
+
+
+def purge_results(queue: JobQueue, stop: threading.Event):
+    while not stop.wait(JOB_RESULT_TTL / 10):
+        try:
+            queue.purge(JOB_RESULT_TTL)
+        except (OSError, sqlite3.Error) as error:
+            print(f'Purging the job queue failed: {error}')
+
+
+def start_workers(execute: Callable[[Job], JobResult]) -> threading.Event | None:
+    """
+    Starts <CLASS>_WORKERS worker threads per route class if the queue is enabled, so a replica claims as many jobs of
+    a class as it has slots for. Returns the event that stops them.
+    """
+    queue = get_queue()
+    if queue is None:
+        return None
+    stop = threading.Event()
+    for name, route_class in route_classes.ROUTE_CLASSES.items():
+        for i in range(route_class.workers):
+            worker = f'{socket.gethostname()}:{os.getpid()}:{name}{i}'
+            threading.Thread(target=work, args=(queue, name, worker, execute, stop), daemon=True,
+                             name=f'job-queue-{name}{i}').start()
+    threading.Thread(target=purge_results, args=(queue, stop), daemon=True, name='job-queue-purge').start()
+    print(f'Job queue workers started on {JOB_QUEUE_DIR}.')
+    return stop
+
+
+def submit_request(queue: JobQueue, route_class_name: str, request: werkzeug.Request) -> str:
+    form = [(key, value) for key, value in request.form.items(multi=True) if key != 'data']
+    headers = {header: request.headers[header] for header in FORWARDED_HEADERS if header in request.headers}
+    # The input is written to a workspace first and then moved into the queue
+    job_workspace = workspace.create(request.form.get('session_id', ''), request.form.get('dataset_name', ''),
+                                     request.path)
+    try:
+        input_path = job_workspace / 'input.json'
+        # A cohort of several uploaded datasets is queued as one file, see modules/uploads
+        if not uploads.save_upload(request, input_path):
+            # The replica that runs the job answers with the usual error
+            input_path = None
+        return queue.submit(route_class_name, request.path, form, headers, input_path)
+    finally:
+        workspace.release(job_workspace)
+
+
+def get_response(queue: JobQueue, job_id: str) -> tuple[bytes | str, int, dict[str, str]]:
+    job = queue.get(job_id)
+    if job is None:
+        return f'Error: Job {job_id} not found.\n', 404, CORS_HEADERS
+    if job.state != 'done':
+        # A preview is served while the job is refined, the client polls until the stage header says full
+        result = queue.get_result(job_id)
+        if result is not None:
+            return result.body, result.status, result.headers | {'Retry-After': '5'}
+        return json.dumps({'job_id': job_id, 'state': job.state, 'attempts': job.attempts}), 202, \
+            CORS_HEADERS | {'Content-Type': 'application/json', 'Retry-After': '5'}
+    result = queue.get_result(job_id)
+    return result.body, result.status, result.headers
+
+
+def queued(route_class_name: str, request: werkzeug.Request):
+    """
+    Decorator for request handlers: If the queue is enabled, the request is queued and answered with the result once
+    a worker of any replica ran it. With the form field async=1, the request is answered right away with the job id,
+    and the result is fetched from /jobs/<job_id>. A waiting client that disconnects cancels its job, like
+    DELETE /jobs/<job_id> does for an async job.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            queue = get_queue()
+            if queue is None or JOB_ENVIRON_KEY in request.environ:
+                return handler(*args, **kwargs)
+            if queue.count(route_class_name)['pending'] >= JOB_QUEUE_MAX_PENDING:
+                print(f'Rejected request, {JOB_QUEUE_MAX_PENDING} {route_class_name} jobs are pending.')
+                return f'Error: The server is busy with {route_class_name} requests, please try again later.\n', \
+                    503, {'Retry-After': '30'}
+            try:
+                job_id = submit_request(queue, route_class_name, request)
+            except ValueError as error:
+                # An invalid cohort, which can not be queued as it is
+                return f'Error: {error}.\n'
+            if request.form.get('async', '').lower() in TRUE_VALUES:
+                return get_response(queue, job_id)
+            while (response := get_response(queue, job_id))[1] == 202:
+                if cancellation.CANCEL_ON_DISCONNECT and cancellation.is_disconnected(request.environ):
+                    # The worker that runs the job stops it with its next heartbeat
+                    print(f'Job {job_id} cancelled, the client disconnected.')
+                    queue.delete(job_id)
+                    return 'Error: The job was cancelled.\n', 499
+                time.sleep(JOB_QUEUE_POLL_INTERVAL)
+            queue.delete(job_id)
+            return response
+        return wrapper
+    return decorator
+
+
+def get_prometheus_metrics() -> str:
+    queue = get_queue()
+    if queue is None:
+        return ''
+    lines = []
+    for name in route_classes.ROUTE_CLASSES:
+        for state, count in queue.count(name).items():
+            lines.append(f'enrichment_server_job_queue_jobs{{route_class="{name}",state="{state}"}} {count}')
+    return '\n'.join(lines) + '\n'
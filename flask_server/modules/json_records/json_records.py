@@ -0,0 +1,154 @@
+import json
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# Bytes that are read from the input file at once
+READ_CHUNK_SIZE = 1024 * 1024
+WHITESPACE = ' \t\n\r'
+# Records that are converted to columns at once
+RECORD_BATCH_SIZE = 10000
+
+
+class ChunkedReader:
+    """
+    Decodes the values of a JSON file one by one, reading the file in chunks
+    """
+    def __init__(self, infile):
+        self.infile = infile
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def read_chunk(self) -> bool:
+        chunk = self.infile.read(READ_CHUNK_SIZE)
+        self.eof = chunk == ''
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return not self.eof
+
+    def peek(self, skipped: str = WHITESPACE) -> str:
+        """
+        The next character that is not in skipped, '' at the end of the file
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in skipped:
+                self.position += 1
+            if self.position < len(self.buffer) or not self.read_chunk():
+                return self.buffer[self.position:self.position + 1]
+
+    def expect(self, character: str, skipped: str = WHITESPACE):
+        if self.peek(skipped) != character:
+            raise json.JSONDecodeError(f"Expecting '{character}'", self.buffer, self.position)
+        self.position += 1
+
+    def decode(self):
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                # The value continues in the next chunk
+                self.read_chunk()
+                continue
+            self.position = end
+            return value
+
+    def iter_array(self):
+        """
+        Yields the values of the array that starts at the current position
+        """
+        self.expect('[')
+        while (character := self.peek(WHITESPACE + ',')) != ']':
+            if character == '':
+                raise json.JSONDecodeError('Unterminated array', self.buffer, self.position)
+            yield self.decode()
+        self.position += 1
+
+
+def iter_records(filepath: Path):
+    """
+    Yields the objects of a top-level JSON array one by one, reading the file in chunks
+    """
+    with open(filepath) as infile:
+        reader = ChunkedReader(infile)
+        if reader.peek() != '[':
+            raise ValueError(f'{filepath} does not contain a JSON array')
+        yield from reader.iter_array()
+
+
+def to_dataframe(records) -> pd.DataFrame:
+    """
+    pd.DataFrame.from_dict(list(records)), but the records are converted to typed columns in batches
+    """
+    batches = []
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == RECORD_BATCH_SIZE:
+            batches.append(pd.DataFrame.from_dict(batch))
+            batch = []
+    if len(batch) > 0 or len(batches) == 0:
+        batches.append(pd.DataFrame.from_dict(batch))
+    if len(batches) == 1:
+        return batches[0]
+    return concat_batches(batches)
+
+
+def concat_batches(batches: list[pd.DataFrame]) -> pd.DataFrame:
+    """
+    pd.concat without the columns that are all-NA in a batch, so that they do not decide the dtype.
+    As with from_dict, a column that is NA in every batch holds None if every record has the key, NaN otherwise.
+    """
+    # Columns in the order of their first appearance, and whether every batch has them with None values
+    columns = {}
+    for i, frame in enumerate(batches):
+        for column in columns.keys() - set(frame.columns):
+            columns[column] = False
+        for column in frame.columns:
+            columns[column] = columns.get(column, i == 0) and frame[column].dtype == object
+        na_columns = frame.columns[frame.isna().all()]
+        if len(na_columns) > 0:
+            batches[i] = frame.drop(columns=na_columns)
+    dataframe = pd.concat(batches, ignore_index=True, copy=False)
+    for column, none_values in columns.items():
+        if column not in dataframe:
+            dataframe[column] = None if none_values else np.nan
+    return dataframe[list(columns)]
+
+
+def iter_named_records(filepath: Path):
+    """
+    Yields the name and the records (as read_records) of each array of a top-level JSON object of record arrays
+    ({"<name>": [{"col": value, ...}, ...], ...}), one array after the other
+    """
+    with open(filepath) as infile:
+        reader = ChunkedReader(infile)
+        if reader.peek() != '{':
+            raise ValueError(f'{filepath} does not contain a JSON object')
+        reader.position += 1
+        while (character := reader.peek(WHITESPACE + ',')) != '}':
+            if character != '"':
+                raise json.JSONDecodeError('Expecting property name', reader.buffer, reader.position)
+            name = reader.decode()
+            reader.expect(':')
+            if reader.peek() != '[':
+                raise ValueError(f'{name} in {filepath} is not a JSON array')
+            yield name, to_dataframe(reader.iter_array())
+
+
+def read_records(filepath: Path) -> pd.DataFrame:
+    """
+    Same result as pd.DataFrame.from_dict(json.load(open(filepath))) for record-oriented input
+    ([{"col": value, ...}, ...]), but the records are parsed in batches straight into typed columns,
+    so the full list of dicts never exists in memory.
+    The only difference: An explicit null can end up as NaN instead of None in a column that also holds strings.
+    """
+    with open(filepath) as infile:
+        if infile.read(READ_CHUNK_SIZE).lstrip(WHITESPACE)[:1] == '{':
+            # Column-oriented input is small enough for the regular parser
+            return pd.DataFrame.from_dict(json.load(open(filepath)))
+
+    return to_dataframe(iter_records(filepath))
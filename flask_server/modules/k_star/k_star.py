@@ -5,13 +5,18 @@ import pickle
 import numpy as np
 import pandas as pd
 import psite_annotation as pa
-from kstar import helpers, calculate, mapping, config
+from kstar import helpers, calculate, config
 
+from modules.json_records import json_records
+from modules.k_star import site_mapping
+from modules.result_filter import result_filter
+from modules.result_encoding import result_encoding
+from modules.cancellation import cancellation
 
-def run_kstar(filepath: Path) -> Path:
+
+def run_kstar(filepath: Path, output_filter: result_filter.ResultFilter = result_filter.ResultFilter()) -> Path:
     output_dir = filepath.parent
-    input_json = json.load(open(filepath))
-    input_df = pd.DataFrame.from_dict(input_json)
+    input_df = json_records.read_records(filepath)
     data_columns = [col for col in input_df if
                     col not in ['Modified sequence', 'Proteins']]
 
@@ -31,9 +36,8 @@ def run_kstar(filepath: Path) -> Path:
     Path.mkdir(output_dir / 'MAPPED_DATA', parents=True, exist_ok=True)
     mapping_log = helpers.get_logger('mapping_log', output_dir / 'MAPPED_DATA' / 'mapping_log.log')
     mapDict = {'peptide': 'Sequence', 'accession_id': 'Uniprot_Accession'}
-    exp_mapper = mapping.ExperimentMapper(experiment=input_df,
-                                          columns=mapDict,
-                                          logger=mapping_log)
+    # Same as mapping.ExperimentMapper, but sites that were mapped for an earlier request are looked up in an index
+    mapped_experiment = site_mapping.map_experiment(input_df, mapDict, mapping_log)
     # Now perform the activity scoring
     Path.mkdir(output_dir / 'RESULTS', parents=True, exist_ok=True)
     activity_log = helpers.get_logger('activity_log', output_dir / 'RESULTS' / 'activity_log.log')
@@ -43,10 +47,11 @@ def run_kstar(filepath: Path) -> Path:
     networks['Y'] = pickle.load(open(config.NETWORK_Y_PICKLE, "rb"))
 
     # Test if there is enough evidence to perform ST and/or Y enrichment, only then perform it
-    result = dict(ST=[], Y=[])
+    result_dfs = dict(ST=[], Y=[])
     for phospho_type in ['ST', 'Y']:
         for direction in ['up', 'down']:
-            kinact = calculate.KinaseActivity(exp_mapper.experiment,
+            cancellation.check_cancelled()
+            kinact = calculate.KinaseActivity(mapped_experiment,
                                               activity_log,
                                               phospho_type=phospho_type)
             threshold_test = kinact.test_threshold(agg='mean',
@@ -55,7 +60,7 @@ def run_kstar(filepath: Path) -> Path:
                                                    return_evidence_sizes=True)
 
             if threshold_test.min() > 0:
-                kinact_dict = calculate.enrichment_analysis(exp_mapper.experiment, activity_log, networks,
+                kinact_dict = calculate.enrichment_analysis(mapped_experiment, activity_log, networks,
                                                             phospho_types=[phospho_type],
                                                             # We already filtered for regulations, so 0 is an acceptable threshold
                                                             agg='mean', threshold=0,
@@ -64,16 +69,21 @@ def run_kstar(filepath: Path) -> Path:
 
                 result_df = np.log10(kinact_dict[phospho_type].activities) * (-1 if direction == 'up' else 1)
 
-                # Post Process and convert into JSON
-                result_list = result_df.rename({
+                # Post Process
+                result_dfs[phospho_type].append(result_df.rename({
                     # Trim away the 'data:'
                     col: col[5:] for col in kinact_dict[phospho_type].activities.columns
-                }, axis=1).reset_index(names='Kinase').to_dict(orient='records')
-
-                result[phospho_type] += result_list
+                }, axis=1).reset_index(names='Kinase'))
 
+    # The values are signed -log10 p-values (positive for up, negative for down)
+    result = {phospho_type: output_filter.apply(pd.concat(dfs, ignore_index=True), 'Kinase', neg_log_pvalues=True)
+              if len(dfs) > 0 else pd.DataFrame()
+              for phospho_type, dfs in result_dfs.items()}
     output_json = output_dir / f'kstar_result.json'
+    if result_encoding.keep_result(output_json, result):
+        return output_json
+    # Convert into JSON
     with open(output_json, 'w') as outfile:
-        json.dump(result, outfile)
+        json.dump({phospho_type: df.to_dict(orient='records') for phospho_type, df in result.items()}, outfile)
 
     return output_json
@@ -0,0 +1,168 @@
+"""
+Persistent index of the KSTAR site mapping. kstar's ExperimentMapper aligns every (accession, peptide) pair of a
+dataset to the KinPred reference proteome, one row at a time, although the alignment of a site only depends on the
+reference and the same sites recur in almost every dataset. The index stores the mapped site and peptide of each
+(accession, peptide) pair, or the reason it did not map. map_experiment looks up the known pairs, aligns only the new
+ones with the functions of kstar.mapping, and then takes the same steps as ExperimentMapper, so the mapped experiment
+is the same.
+"""
+import os
+import sqlite3
+import threading
+import contextlib
+from itertools import chain
+from pathlib import Path
+import logging
+import numpy as np
+import pandas as pd
+from kstar import mapping, config
+
+from modules.result_cache import result_cache
+
+# An empty path keeps the index off, all sites are aligned for every request
+KSTAR_MAPPING_INDEX = os.getenv('KSTAR_MAPPING_INDEX', '../cache/kstar/site_mapping.sqlite')
+# Amino acids left and right of the site in the mapped peptide, as in ExperimentMapper
+WINDOW = 7
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sites (
+    reference TEXT NOT NULL,
+    accession TEXT NOT NULL,
+    peptide TEXT NOT NULL,
+    site TEXT,
+    mapped_peptide TEXT,
+    reason TEXT,
+    PRIMARY KEY (reference, accession, peptide)
+) WITHOUT ROWID;
+"""
+
+_index_lock = threading.Lock()
+_checked_references = set()
+
+
+def get_reference(window: int = WINDOW) -> str:
+    # A new reference proteome (e.g. after config.install_resource_files()) invalidates the index
+    return f'{result_cache.get_reference_fingerprint(Path(config.HUMAN_REF_FASTA_FILE))}:{window}'
+
+
+@contextlib.contextmanager
+def open_index(index_path: Path, reference: str):
+    Path.mkdir(index_path.parent, parents=True, exist_ok=True)
+    connection = sqlite3.connect(index_path, timeout=60)
+    try:
+        with _index_lock:
+            if (index_path, reference) not in _checked_references:
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.executescript(SCHEMA)
+                # Sites of older references are never looked up again
+                with connection:
+                    connection.execute('DELETE FROM sites WHERE reference != ?', (reference,))
+                _checked_references.add((index_path, reference))
+        yield connection
+    finally:
+        connection.close()
+
+
+def lookup(connection: sqlite3.Connection, reference: str,
+           pairs: list[tuple[str, str]]) -> dict[tuple[str, str], tuple[str | None, str | None, str | None]]:
+    # All pairs in one join instead of one query per pair
+    connection.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (accession TEXT, peptide TEXT)')
+    connection.execute('DELETE FROM lookup')
+    connection.executemany('INSERT INTO lookup VALUES (?, ?)', pairs)
+    rows = connection.execute('SELECT sites.accession, sites.peptide, site, mapped_peptide, reason FROM lookup '
+                              'JOIN sites ON sites.reference = ? AND sites.accession = lookup.accession AND '
+                              'sites.peptide = lookup.peptide', (reference,))
+    return {(accession, peptide): (site, mapped_peptide, reason)
+            for accession, peptide, site, mapped_peptide, reason in rows}
+
+
+def store(connection: sqlite3.Connection, reference: str,
+          alignments: dict[tuple[str, str], tuple[str | None, str | None, str | None]]):
+    with connection:
+        connection.executemany('INSERT OR IGNORE INTO sites VALUES (?, ?, ?, ?, ?, ?)',
+                               [(reference, *pair, *alignment) for pair, alignment in alignments.items()])
+
+
+def align_site(accession: str, peptide: str, sequences: dict[str, str],
+               window: int = WINDOW) -> tuple[str | None, str | None, str | None]:
+    """
+    Site, mapped peptide and reason it did not map (None if it did) of a peptide with one modified residue,
+    like ExperimentMapper.align_sites
+    """
+    sequence = sequences.get(accession)
+    if sequence is None:
+        return None, None, f'SEQUENCE NOT FOUND : {accession}'
+    site = mapping.peptide_site_number(peptide=peptide, site=None, sequence=sequence)
+    if site is None:
+        return None, None, f'SITE NOT FOUND : {accession}\t{peptide}'
+    aligned_peptide = mapping.get_aligned_peptide(site=site, sequence=sequence, window=window)
+    return site, peptide if aligned_peptide is None else aligned_peptide, None
+
+
+def get_accession_id(accession: str) -> str:
+    # Isoform suffixes are removed: P12345-2 -> P12345
+    parts = accession.split('-')
+    return '-'.join(parts[:-1] if len(parts) > 1 else parts)
+
+
+def expand_peptide(peptide: str) -> list[str]:
+    # One peptide per modified (lowercase) residue, with only that residue in lowercase, like mapping.expand_peptide
+    upper_peptide = peptide.upper()
+    return [upper_peptide[:position] + upper_peptide[position].lower() + upper_peptide[position + 1:]
+            for _, position in mapping.find_modified_sites(peptide)]
+
+
+def map_experiment(experiment: pd.DataFrame, columns: dict[str, str], logger: logging.Logger,
+                   sequences: dict[str, str] = None, compendia: pd.DataFrame = None, window: int = WINDOW,
+                   index_path: Path | None = None, reference: str = None) -> pd.DataFrame:
+    """
+    The experiment of mapping.ExperimentMapper(experiment, columns, logger, sequences, compendia, window),
+    for the columns 'accession_id' and 'peptide'. Rows that do not map are logged with the reason.
+    """
+    sequences = config.HUMAN_REF_SEQUENCES if sequences is None else sequences
+    compendia = config.HUMAN_REF_COMPENDIA if compendia is None else compendia
+    if index_path is None and KSTAR_MAPPING_INDEX:
+        index_path = Path(KSTAR_MAPPING_INDEX)
+    reference = get_reference(window) if reference is None and index_path is not None else reference
+
+    experiment = experiment.copy()
+    experiment[config.KSTAR_ACCESSION] = experiment[columns['accession_id']].apply(get_accession_id)
+    experiment[config.KSTAR_PEPTIDE] = experiment[columns['peptide']]
+    experiment[config.KSTAR_SITE] = None
+
+    expansions = {peptide: expand_peptide(peptide) for peptide in experiment[config.KSTAR_PEPTIDE].unique()}
+    n_expansions = experiment[config.KSTAR_PEPTIDE].map(lambda peptide: len(expansions[peptide])).to_numpy()
+    expanded = experiment.iloc[np.repeat(np.arange(len(experiment)), n_expansions)].reset_index(drop=True)
+    expanded[config.KSTAR_PEPTIDE] = list(chain.from_iterable(expansions[peptide]
+                                                              for peptide in experiment[config.KSTAR_PEPTIDE]))
+
+    pairs = list(dict.fromkeys(zip(expanded[config.KSTAR_ACCESSION], expanded[config.KSTAR_PEPTIDE])))
+    if index_path is None:
+        alignments = {pair: align_site(*pair, sequences, window) for pair in pairs}
+    else:
+        with open_index(index_path, reference) as connection:
+            alignments = lookup(connection, reference, pairs)
+            logger.info(f'{len(alignments)} of {len(pairs)} sites found in the mapping index.')
+            new_alignments = {pair: align_site(*pair, sequences, window) for pair in pairs if pair not in alignments}
+            store(connection, reference, new_alignments)
+        alignments |= new_alignments
+
+    row_alignments = [alignments[pair] for pair in zip(expanded[config.KSTAR_ACCESSION],
+                                                       expanded[config.KSTAR_PEPTIDE])]
+    for _, _, reason in row_alignments:
+        if reason is not None:
+            logger.warning(reason)
+    expanded[config.KSTAR_SITE] = pd.Series([site for site, _, _ in row_alignments], index=expanded.index,
+                                            dtype='object')
+    expanded[config.KSTAR_PEPTIDE] = pd.Series([mapped_peptide for _, mapped_peptide, _ in row_alignments],
+                                               index=expanded.index, dtype='object')
+
+    # From here on, the same steps as ExperimentMapper
+    expanded = expanded.dropna(axis='rows', subset=[config.KSTAR_ACCESSION, config.KSTAR_SITE, config.KSTAR_PEPTIDE])
+    expanded = expanded.drop_duplicates()
+    compendia = compendia[[config.KSTAR_ACCESSION, config.KSTAR_SITE, 'KSTAR_NUM_COMPENDIA',
+                           'KSTAR_NUM_COMPENDIA_CLASS']]
+    mapped = pd.merge(expanded, compendia, how='inner', on=[config.KSTAR_ACCESSION, config.KSTAR_SITE])
+    mapped['KSTAR_NUM_COMPENDIA'] = mapped['KSTAR_NUM_COMPENDIA'].fillna(0.0).astype(int)
+    mapped['KSTAR_NUM_COMPENDIA_CLASS'] = mapped['KSTAR_NUM_COMPENDIA_CLASS'].fillna(0.0).astype(int)
+    return mapped
@@ -1,25 +1,56 @@
+import os
 import json
+import time
+import hashlib
 import requests
+import pandas as pd
 from pathlib import Path
 
-KEA3_URL = 'https://amp.pharm.mssm.edu/kea3/api/enrich/'
+from modules.result_cache import result_cache
+from modules.result_encoding import result_encoding
+from modules.cancellation import cancellation
+
+KEA3_URL = os.getenv('KEA3_URL', 'https://amp.pharm.mssm.edu/kea3/api/enrich/')
+# The KEA3 libraries are updated upstream, cached answers are asked again after this many days
+KEA3_CACHE_TTL_DAYS = float(os.getenv('KEA3_CACHE_TTL_DAYS', '7'))
+
+
+def load_cached(cache_key: str) -> dict | None:
+    # Entries are (time of the request, answer)
+    cached = result_cache.load('kea3', cache_key)
+    if cached is None or time.time() - cached[0] > KEA3_CACHE_TTL_DAYS * 24 * 3600:
+        return None
+    return cached[1]
 
 
 def run_kea3_api(filepath: Path) -> Path:
     input_json = json.load(open(filepath))
     result = dict()
     for experiment in input_json.keys():
-        payload = {'gene_set': [val for val in input_json[experiment] if val], 'query_name': experiment}
-        response = requests.post(KEA3_URL, data=json.dumps(payload))
-        if not response.ok:
-            raise Exception(f'Error in Enrichment of Experiment {experiment}')
-        response_json = json.loads(response.text)
-        result[experiment] = {
-            'MeanRank': response_json['Integrated--meanRank'],
-            'TopRank': response_json['Integrated--topRank']
-        }
+        cancellation.check_cancelled()
+        gene_set = [val for val in input_json[experiment] if val]
+        # KEA3 only sees the gene set and the name, so an unchanged experiment does not have to be sent again
+        cache_key = result_cache.get_key('kea3', hashlib.sha256(json.dumps(gene_set).encode()).hexdigest(),
+                                         url=KEA3_URL, query_name=experiment)
+        result[experiment] = load_cached(cache_key)
+        if result[experiment] is None:
+            payload = {'gene_set': gene_set, 'query_name': experiment}
+            response = requests.post(KEA3_URL, data=json.dumps(payload))
+            if not response.ok:
+                raise Exception(f'Error in Enrichment of Experiment {experiment}')
+            response_json = json.loads(response.text)
+            result[experiment] = {
+                'MeanRank': response_json['Integrated--meanRank'],
+                'TopRank': response_json['Integrated--topRank']
+            }
+            result_cache.store('kea3', cache_key, (time.time(), result[experiment]))
 
     output_json = filepath.parent / f'kea3_result.json'
+    # KEA3 answers with records, the compact encodings need one table per ranking
+    if result_encoding.keep_result(output_json, {experiment: {ranking: pd.DataFrame.from_records(records)
+                                                              for ranking, records in rankings.items()}
+                                                 for experiment, rankings in result.items()}):
+        return output_json
     with open(output_json, 'w') as outfile:
         json.dump(result, outfile)
 
@@ -1,16 +1,41 @@
+import os
+import functools
 from pathlib import Path
-import json
-import subprocess
+from typing import Callable
 import pandas as pd
 import numpy as np
 import kinact
 
+from modules.json_records import json_records
+from modules.data_exchange import data_exchange
+from modules.server_logging import server_logging
+from modules.job_budget import job_budget
+from modules.cancellation import cancellation
+from modules.result_cache import result_cache
+from modules.reference_db import reference_db
+from modules.result_filter import result_filter
+from modules.result_encoding import result_encoding
+from modules.uploads import uploads
+from modules.ksea import rokai
+
+# 'r' runs run_rokai.R, 'python' uses the sparse RoKAI implementation in rokai.py, which is experimental
+ROKAI_ENGINE = os.getenv('ROKAI_ENGINE', 'r')
+if ROKAI_ENGINE == 'python':
+    print('ROKAI_ENGINE=python is experimental, its refined profiles can differ from run_rokai.R (see rokai.py).')
+KSEA_ADJACENCY_MATRIX = Path('../db/psp_kinase_substrate_adjacency_matrix.csv')
+
 
 def preprocess_ksea(filepath: Path) -> Path:
     output_dir = filepath.parent
-    input_json = json.load(open(filepath))
-    input_df = pd.DataFrame.from_dict(input_json)
+    input_df = preprocess_ksea_dataframe(json_records.read_records(filepath))
+
+    Path.mkdir(output_dir, parents=True, exist_ok=True)
 
+    output_matrix = data_exchange.matrix_path(output_dir, filepath.stem)
+    return data_exchange.write_matrix(input_df, output_matrix)
+
+
+def preprocess_ksea_dataframe(input_df: pd.DataFrame) -> pd.DataFrame:
     # Todo: Merge with preprocess_ssgsea function
     idcolumn = 'Site' if 'Site' in input_df else 'id'
 
@@ -21,71 +46,170 @@ def preprocess_ksea(filepath: Path) -> Path:
     experiment_columns = [col for col in input_df.columns if col != idcolumn]
     input_df_grouped = input_df.groupby(idcolumn)
     unique_values = [input_df_grouped[exp].apply(abs_max_signed) for exp in experiment_columns]
-    input_df = pd.DataFrame(unique_values).T.reset_index()
-
-    Path.mkdir(output_dir, parents=True, exist_ok=True)
-
-    output_csv = output_dir / f'{filepath.stem}.csv'
-    input_df.to_csv(output_csv, index=False)
-    return output_csv
+    return pd.DataFrame(unique_values).T.reset_index()
 
 
 def run_rokai(filepath: Path) -> Path:
-    output_path = filepath.parent / f'rokai_result.csv'
-    subprocess_output = subprocess.run(["Rscript",
+    output_path = data_exchange.matrix_path(filepath.parent, 'rokai_result')
+    subprocess_output = job_budget.run(["Rscript",
                                         "modules/ksea/run_rokai.R",
                                         str(filepath),
                                         str(output_path)],
                                        capture_output=True, text=True)
-    print(subprocess_output.stdout)
-    print(subprocess_output.stderr)
+    server_logging.log_subprocess_output(subprocess_output, 'run_rokai')
     return output_path
 
 
-def perform_ksea(filepath: Path) -> Path:
-    input_df = pd.read_csv(filepath)
+def perform_rokai_ksea(filepath: Path,
+                       output_filter: result_filter.ResultFilter = result_filter.ResultFilter()) -> Path:
+    if ROKAI_ENGINE == 'python':
+        input_df = data_exchange.read_matrix(filepath).set_index('Site')
+        # The refined profiles go straight into KSEA, without a round trip through the file system
+        return write_ksea_result(perform_ksea_dataframe(rokai.refine(input_df)), filepath.parent, output_filter)
+    return perform_ksea(run_rokai(filepath), output_filter)
+
+
+def perform_ksea(filepath: Path, output_filter: result_filter.ResultFilter = result_filter.ResultFilter()) -> Path:
+    input_df = data_exchange.read_matrix(filepath)
     input_df.set_index('Site', inplace=True)
+    return write_ksea_result(perform_ksea_dataframe(input_df), filepath.parent, output_filter)
+
 
-    adjacency_matrix = pd.read_csv('../db/psp_kinase_substrate_adjacency_matrix.csv', skiprows=1).set_index('p_site')
+def load_adjacency_matrix() -> pd.DataFrame:
+    # From the compiled reference data if available (modules/reference_db)
+    adjacency_matrix = reference_db.load_ksea_adjacency()
+    if adjacency_matrix is None:
+        adjacency_matrix = pd.read_csv(KSEA_ADJACENCY_MATRIX, skiprows=1).set_index('p_site')
+    return adjacency_matrix
 
+
+def perform_ksea_dataframe(input_df: pd.DataFrame,
+                           load_adjacency: Callable[[], pd.DataFrame] = load_adjacency_matrix) -> pd.DataFrame | None:
     ksea_results = []
+    adjacency_matrix = None
     for experiment in input_df:
-        try:
-            scores, p_values = kinact.ksea.ksea_mean(
-                data_fc=input_df[experiment],
-                interactions=adjacency_matrix,
-                mP=input_df[experiment].mean(),
-                delta=input_df[experiment].std())
-            overlap = {}
-            percent_overlap = {}
-            experiment_sites = set(input_df[experiment].dropna().index)
-            for kinase in adjacency_matrix:
-                substrates = set(adjacency_matrix[kinase].dropna().index)
-                kinase_overlap = list(substrates.intersection(experiment_sites))
-                if len(kinase_overlap) > 0:
-                    overlap[kinase] = list(substrates.intersection(experiment_sites))
-                    percent_overlap[kinase] = 100*len(overlap[kinase]) / len(substrates)
-
-
-            res = pd.DataFrame({
-                f'Score ({experiment})': scores,
-                f'adj p-val ({experiment})': p_values,
-                f'Overlap ({experiment})': overlap,
-                f'Percent Overlap ({experiment})': percent_overlap}).dropna()
-            ksea_results.append(res)
-        except ZeroDivisionError:
-            continue
-    output_json = filepath.parent / f'ksea_result.json'
+        cancellation.check_cancelled()
+        # Each experiment only depends on its own values, so unchanged experiments come from the cache
+        cache_key = result_cache.get_key('ksea', input_df[experiment], references=[KSEA_ADJACENCY_MATRIX])
+        cached = result_cache.load('ksea', cache_key)
+        if cached is None:
+            if adjacency_matrix is None:
+                adjacency_matrix = load_adjacency()
+            cached = {'result': perform_ksea_experiment(input_df[experiment], adjacency_matrix)}
+            result_cache.store('ksea', cache_key, cached)
+        if cached['result'] is not None:
+            ksea_results.append(cached['result'].rename(columns=lambda col: f'{col} ({experiment})'))
 
     if len(ksea_results) == 0:
+        return None
+    ksea_results_df = pd.concat(ksea_results, axis=1)
+    ksea_results_df.index.name = 'Gene'
+    return ksea_results_df
+
+
+def perform_ksea_experiment(values: pd.Series, adjacency_matrix: pd.DataFrame) -> pd.DataFrame | None:
+    try:
+        scores, p_values = kinact.ksea.ksea_mean(
+            data_fc=values,
+            interactions=adjacency_matrix,
+            mP=values.mean(),
+            delta=values.std())
+    except ZeroDivisionError:
+        return None
+    overlap = {}
+    percent_overlap = {}
+    experiment_sites = set(values.dropna().index)
+    for kinase in adjacency_matrix:
+        substrates = set(adjacency_matrix[kinase].dropna().index)
+        kinase_overlap = list(substrates.intersection(experiment_sites))
+        if len(kinase_overlap) > 0:
+            overlap[kinase] = list(substrates.intersection(experiment_sites))
+            percent_overlap[kinase] = 100*len(overlap[kinase]) / len(substrates)
+
+    return pd.DataFrame({
+        'Score': scores,
+        'adj p-val': p_values,
+        'Overlap': overlap,
+        'Percent Overlap': percent_overlap}).dropna()
+
+
+def perform_ksea_batch(filepath: Path, ksea_type: str = None,
+                       output_filter: result_filter.ResultFilter = result_filter.ResultFilter()) -> Path:
+    """
+    KSEA of every dataset of a cohort (see modules/uploads), the result has the same records per dataset as a request
+    per dataset. For RoKAI, the experiments of all datasets are refined in one pass over a wide matrix, the network is
+    only loaded once. The adjacency matrix is also loaded once for all datasets.
+    """
+    datasets = {}
+    for name, input_df in uploads.iter_cohort(filepath):
+        input_df = preprocess_ksea_dataframe(input_df)
+        datasets[name] = input_df.set_index(input_df.columns[0]).rename_axis('Site')
+    if ksea_type == 'rokai':
+        datasets = refine_cohort(datasets, filepath.parent)
+
+    load_adjacency = functools.cache(load_adjacency_matrix)
+    results = {}
+    for name, input_df in datasets.items():
+        ksea_results_df = perform_ksea_dataframe(input_df, load_adjacency)
+        results[name] = pd.DataFrame() if ksea_results_df is None else \
+            output_filter.apply(ksea_results_df.reset_index(), 'Gene', 'Score', 'adj p-val')
+
+    output_json = filepath.parent / 'ksea_batch_result.json'
+    if not result_encoding.keep_result(output_json, results):
         with open(output_json, 'w') as o:
-            o.write(str(ksea_results))
+            o.write(result_encoding.to_records_json(results))
+    return output_json
+
+
+def refine_cohort(datasets: dict[str, pd.DataFrame], output_dir: Path) -> dict[str, pd.DataFrame]:
+    """
+    Refines the experiments of all datasets with RoKAI at once. They are merged into one matrix with a column per
+    experiment, each experiment is refined on its own valid sites, so the refined values are the same as per dataset.
+    """
+    experiments = {}
+    for name, input_df in datasets.items():
+        for experiment in input_df:
+            experiments[f'Experiment{len(experiments) + 1}'] = (name, experiment)
+    wide_df = pd.concat(list(datasets.values()), axis=1, join='outer')
+    wide_df.columns = list(experiments)
+    wide_df.index.name = 'Site'
+
+    network_ids = wide_df.index.str.replace(r'_\D', '_', regex=True)
+    if ROKAI_ENGINE == 'python' and network_ids.duplicated().any():
+        # rokai.refine keeps one of the sites that map to the same network site, which could come from another
+        # dataset, so those cohorts are refined per dataset
+        return {name: rokai.refine(input_df) for name, input_df in datasets.items()}
+    if ROKAI_ENGINE == 'python':
+        refined_df = rokai.refine(wide_df)
     else:
-        ksea_results_df = pd.concat(ksea_results, axis=1)
-        ksea_results_df.index.name = 'Gene'
+        wide_matrix = data_exchange.write_matrix(wide_df.reset_index(),
+                                                 data_exchange.matrix_path(output_dir, 'cohort'))
+        refined_df = data_exchange.read_matrix(run_rokai(wide_matrix)).set_index('Site')
+
+    refined = {}
+    for name, input_df in datasets.items():
+        # Experiments that RoKAI skipped (too few valid values) are missing, like in the result of a single dataset
+        columns = {column: experiment for column, (dataset, experiment) in experiments.items()
+                   if dataset == name and column in refined_df}
+        refined[name] = refined_df[list(columns)].dropna(how='all').rename(columns=columns)
+    return refined
 
-        ksea_results_df.reset_index().to_json(path_or_buf=output_json,
-                                              orient='records',
-                                              # indent=1  # For DEBUG
-                                              )
+
+def write_ksea_result(ksea_results_df: pd.DataFrame | None, output_dir: Path,
+                      output_filter: result_filter.ResultFilter = result_filter.ResultFilter()) -> Path:
+    output_json = output_dir / f'ksea_result.json'
+
+    if ksea_results_df is not None:
+        ksea_results_df = output_filter.apply(ksea_results_df.reset_index(), 'Gene', 'Score', 'adj p-val')
+    if result_encoding.keep_result(output_json, pd.DataFrame() if ksea_results_df is None else ksea_results_df):
+        return output_json
+
+    if ksea_results_df is None:
+        with open(output_json, 'w') as o:
+            o.write('[]')
+    else:
+        ksea_results_df.to_json(path_or_buf=output_json,
+                                orient='records',
+                                # indent=1  # For DEBUG
+                                )
     return output_json
@@ -0,0 +1,145 @@
+import sys
+import shutil
+import tempfile
+import functools
+from dataclasses import dataclass
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import scipy.io
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import splu
+
+# Created by export_rokai_network.R from the RoKAI network that run_rokai.R uses (see Dockerfile)
+ROKAI_NETWORK_DIR = Path('../db/rokai')
+# Same as run_rokai.R: The 'ppi' network (kinase-kinase) only gets a small weight
+PPI_SCALING = 1e-3
+# Conductance of the network edges relative to the conductance that ties each site to its measured value.
+# Experimental: run_rokai.R also sources the edge weighting of rokai_weights.R in RokaiApp, which is not ported, so
+# the refined values can differ from the R engine. tests/test_rokai.py compares both against R_PARITY_FIXTURE.
+NETWORK_CONDUCTANCE = 0.1
+# The input of the parity check and its profiles refined by run_rokai.R, written once in the Docker image with
+# python -m modules.ksea.rokai, so the engines are compared without R
+PARITY_INPUT = Path('../fixtures/ksea/input/input.csv')
+R_PARITY_FIXTURE = Path('../fixtures/ksea/expected_output/rokai_refined_r.csv')
+
+
+@dataclass
+class RokaiNetwork:
+    sites: pd.Index
+    kinases: pd.DataFrame
+    wk2s: sp.csr_matrix
+    wk2k: sp.csr_matrix
+    ws2s: sp.csr_matrix
+
+
+def load_sparse(network_dir: Path, name: str) -> sp.csr_matrix:
+    # Matrix Market is slow to parse, so it is converted to npz the first time it is loaded
+    npz_file = network_dir / f'{name}.npz'
+    if npz_file.exists():
+        return sp.load_npz(npz_file).tocsr()
+    matrix = sp.csr_matrix(scipy.io.mmread(network_dir / f'{name}.mtx'))
+    sp.save_npz(npz_file, matrix)
+    return matrix
+
+
+@functools.cache
+def load_rokai_network(network_dir: Path = ROKAI_NETWORK_DIR) -> RokaiNetwork:
+    """
+    Load the RoKAI network once per process.
+    Like run_rokai.R, phosphatases are appended to the kinases and the site-site network is 'sd' | 'coev'.
+    """
+    ws2s = load_sparse(network_dir, 'Wsite2site_sd') + load_sparse(network_dir, 'Wsite2site_coev')
+    ws2s.data = (ws2s.data != 0).astype(float)
+    return RokaiNetwork(sites=pd.Index(pd.read_csv(network_dir / 'sites.csv')['Identifier']),
+                        kinases=pd.read_csv(network_dir / 'kinases.csv'),
+                        wk2s=load_sparse(network_dir, 'Wkin2site_psp'),
+                        wk2k=load_sparse(network_dir, 'Wkin2kin') * PPI_SCALING,
+                        ws2s=ws2s)
+
+
+def refine(input_df: pd.DataFrame, network: RokaiNetwork = None) -> pd.DataFrame:
+    """
+    Refine the phosphorylation profiles of all experiments (columns of input_df, indexed by 'Site') with RoKAI.
+    Returns the refined, normalized values of the sites that are part of the network, like run_rokai.R does.
+    """
+    network = network or load_rokai_network()
+
+    # 'O75822_S11' -> 'O75822_11', the network does not store the residue
+    network_indices = network.sites.get_indexer(input_df.index.str.replace(r'_\D', '_', regex=True))
+    mapped_df = input_df[network_indices >= 0].copy()
+    mapped_df['network_index'] = network_indices[network_indices >= 0]
+    mapped_df = mapped_df.reset_index().drop_duplicates('network_index', keep='last').set_index('network_index')
+    site_names = mapped_df.pop(input_df.index.name or 'index')
+
+    # Experiments with the same valid sites share the same linear system, so we factorize it once per pattern
+    experiments_by_pattern = {}
+    for experiment in mapped_df:
+        values = mapped_df[experiment]
+        if values.notna().sum() < 2 or values.std() == 0:
+            # Cannot be normalized, run_rokai.R skips these experiments as well
+            continue
+        experiments_by_pattern.setdefault(values.notna().values.tobytes(), []).append(experiment)
+
+    refined = {}
+    for experiments in experiments_by_pattern.values():
+        valid_sites = mapped_df[experiments[0]].notna().values
+        X = mapped_df.loc[valid_sites, experiments]
+        # Like run_rokai.R, normalize each experiment. After normalization the standard error Sx is 1 for all sites.
+        X = (X - X.mean()) / X.std()
+        Xs = solve_circuit(X.values, X.index.values, network)
+        for i, experiment in enumerate(experiments):
+            refined[experiment] = pd.Series(Xs[:, i], index=site_names.loc[X.index].values)
+
+    refined_df = pd.DataFrame(refined, columns=[exp for exp in input_df if exp in refined]).sort_index()
+    refined_df.index.name = input_df.index.name
+    return refined_df
+
+
+def solve_circuit(X: np.ndarray, site_indices: np.ndarray, network: RokaiNetwork) -> np.ndarray:
+    """
+    RoKAI's electrical circuit model: Sites and kinases are nodes, the kinase-site, kinase-kinase and site-site
+    networks are resistors between them and each measured site is tied to its observed value (voltage source).
+    The refined values are the node voltages, i.e. the solution of (G + lambda * L) V = G X
+    with the graph Laplacian L and the conductances G to the sources. X may contain several experiments (columns).
+    """
+    n_sites = len(site_indices)
+    wk2s = network.wk2s[:, site_indices]
+    W = sp.bmat([[network.ws2s[site_indices][:, site_indices], wk2s.T],
+                 [wk2s, network.wk2k]], format='csr')
+    W = W.maximum(W.T)
+    W.setdiag(0)
+    W.eliminate_zeros()
+
+    # Kinases that are not connected to any measured site would make the system singular, leave them out
+    _, components = connected_components(W, directed=False)
+    keep = np.isin(components, np.unique(components[:n_sites]))
+    keep[:n_sites] = True
+    W = W[keep][:, keep]
+
+    conductance = np.zeros(W.shape[0])
+    conductance[:n_sites] = 1
+    laplacian = sp.diags(np.asarray(W.sum(axis=1)).ravel()) - W
+    A = (sp.diags(conductance) + NETWORK_CONDUCTANCE * laplacian).tocsc()
+    b = np.zeros((W.shape[0], X.shape[1]))
+    b[:n_sites] = X
+    V = splu(A).solve(b)
+    return V[:n_sites]
+
+
+def write_parity_fixture(output_path: Path = R_PARITY_FIXTURE):
+    """
+    Refines PARITY_INPUT with run_rokai.R and keeps the result as the reference of the Python engine
+    """
+    from modules.ksea import ksea
+    from modules.data_exchange import data_exchange
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_csv = Path(shutil.copy(PARITY_INPUT, Path(tmp_dir) / 'input.csv'))
+        refined_df = data_exchange.read_matrix(ksea.run_rokai(input_csv)).set_index('Site').sort_index()
+    refined_df.to_csv(output_path, float_format='%.17g')
+    print(f'Wrote the run_rokai.R result of {PARITY_INPUT} to {output_path}.')
+
+
+if __name__ == '__main__':
+    write_parity_fixture(Path(sys.argv[1]) if len(sys.argv) > 1 else R_PARITY_FIXTURE)
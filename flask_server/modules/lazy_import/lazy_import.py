@@ -0,0 +1,60 @@
+import os
+import time
+import importlib
+import threading
+
+# Import all registered modules in a background thread after startup, so the first request does not pay for it
+WARMUP_MODULES = os.getenv('WARMUP_MODULES', '1') == '1'
+
+REGISTRY = {}
+
+
+class LazyModule:
+    """
+    Stands in for an analysis module and imports it on first attribute access.
+    The analysis modules pull in heavy dependencies (kinact, kstar, py4cytoscape, statsmodels, ...),
+    so a worker can answer GET / long before all of them are loaded.
+    """
+
+    def __init__(self, module_name: str):
+        self.module_name = module_name
+        self.module = None
+        self.import_time = None
+        self._lock = threading.Lock()
+        REGISTRY[module_name] = self
+
+    def load(self):
+        if self.module is None:
+            with self._lock:
+                if self.module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self.module_name)
+                    self.import_time = time.perf_counter() - start
+                    self.module = module
+                    print(f'Imported {self.module_name} in {self.import_time:.2f} s')
+        return self.module
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+
+def warm_up():
+    for lazy_module in list(REGISTRY.values()):
+        try:
+            lazy_module.load()
+        except Exception as e:
+            # The request that needs the module will raise the error again
+            print(f'Warm-up of {lazy_module.module_name} failed: {e}')
+
+
+def start_warmup() -> threading.Thread | None:
+    if not WARMUP_MODULES:
+        return None
+    thread = threading.Thread(target=warm_up, name='module-warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def get_import_times() -> dict[str, float | None]:
+    return {name: None if lazy_module.import_time is None else round(lazy_module.import_time, 3)
+            for name, lazy_module in REGISTRY.items()}
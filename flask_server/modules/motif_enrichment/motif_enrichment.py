@@ -1,7 +1,7 @@
 # This script mostly uses code written by Florian P. Bayer <f.bayer@tum.de>
 
-import json
-from collections import defaultdict
+import itertools
+from dataclasses import dataclass, field, asdict
 from pathlib import Path
 
 import numpy as np
@@ -12,26 +12,145 @@ import statsmodels.api as sm
 
 from tqdm import tqdm
 
-tqdm.pandas()
+from modules.json_records import json_records
+from modules.result_cache import result_cache
+from modules.reference_db import reference_db
+from modules.result_filter import result_filter
+from modules.result_encoding import result_encoding
+from modules.uploads import uploads
+from modules.cancellation import cancellation
+
+# Progress bars are only shown on a terminal, they would flood the log otherwise
+tqdm.pandas(disable=None)
 
 PHOSPHOSITE_FASTA = "../db/Phosphosite_seq.fasta"
 ODDS_PATH = "../db/kinase_library/Motif_Odds_Ratios.txt"
 QUANTILE_MATRIX_PATH = "../db/kinase_library/Kinase_Score_Quantile_Matrix.txt"
 
-MOTIF_COLS = [
-    "Top Motif Kinases",
-    "Top Motif Scores",
-    "Top Motif Percentiles",
-    "Top Motif Totals",
-]
+# The columns that identify the sites, all others are experiments
+SITE_COLUMNS = ['Modified sequence', 'Proteins', 'Site positions']
+REGULATION_TYPES = ['down', 'up', 'not']
+# Metrics for ranking and filtering the kinases of a site
+METRICS = ['score', 'percentile', 'total']
+# Upper limit for the number of settings in one request (product of all parameter values)
+MAX_SETTINGS = 64
+# Sites that are scored against all kinases at once
+SCORING_CHUNK_SIZE = 5000
+
+
+@dataclass(frozen=True)
+class MotifSetting:
+    """
+    Which kinases count for a site: The kinases with a positive motif score are ranked by sort_type, those whose
+    threshold_type metric is above threshold are kept and the top_n of them count. The metrics are the log2 motif
+    score, its percentile according to Johnson et al. (the default) and their product (total).
+    """
+    top_n: int = 15
+    threshold: float = -np.inf
+    threshold_type: str = 'percentile'
+    sort_type: str = 'percentile'
+
+
+@dataclass
+class ScoredContexts:
+    """
+    Motif scores and percentiles (sequences x kinases, see score_sites) of unique site sequence contexts
+    """
+    sequences: pd.Index
+    kinases: list[str]
+    scores: np.ndarray
+    percentiles: np.ndarray
+
 
+@dataclass
+class MotifAnnotation:
+    """
+    Full kinase ranking of the sites of a dataset. Any top-N or threshold selection is derived from it by slicing,
+    so a different setting does not rescore the sites.
 
-def run_motif_enrichment(filepath: Path) -> Path:
-    input_json = json.load(open(filepath))
-    input_df = pd.DataFrame.from_dict(input_json)
-    result_df = run_motif_enrichment_dataframe(input_df)
+    rows, site_weights, site_index: One entry per site sequence context of the input (a row with several phospho sites
+    has several), with the input row, the weight and the index of the unique context.
+    scores, percentiles: Unique contexts x kinases, NaN where the motif score is not positive
+    (those kinases never count for the site).
+    """
+    rows: np.ndarray
+    site_weights: np.ndarray
+    site_index: np.ndarray
+    kinases: np.ndarray
+    scores: np.ndarray
+    percentiles: np.ndarray
+    orders: dict = field(default_factory=dict)
+
+    def get_metric(self, metric: str) -> np.ndarray:
+        if metric == 'score':
+            return self.scores
+        if metric == 'percentile':
+            return self.percentiles
+        return self.scores * self.percentiles
+
+    def get_order(self, sort_type: str) -> np.ndarray:
+        """
+        Kinase indices of each unique context, best first. Sorted once per sort type, ties keep the kinase order.
+        """
+        if sort_type not in self.orders:
+            metric = np.nan_to_num(self.get_metric(sort_type), nan=-np.inf)
+            self.orders[sort_type] = np.argsort(-metric, axis=1, kind='stable').astype('int16')
+        return self.orders[sort_type]
+
+    def select(self, setting: MotifSetting) -> np.ndarray:
+        """
+        Unique contexts x kinases, True for the kinases that count for the site with this setting
+        """
+        order = self.get_order(setting.sort_type)
+        passing = np.take_along_axis(self.get_metric(setting.threshold_type), order, axis=1) > setting.threshold
+        selected = np.zeros_like(passing)
+        np.put_along_axis(selected, order, passing & (np.cumsum(passing, axis=1) <= setting.top_n), axis=1)
+        return selected
+
+
+def parse_settings(form: dict) -> list[MotifSetting]:
+    """
+    Settings from the form fields top_n, threshold, threshold_type and sort_type. Each field can hold several
+    comma-separated values, all combinations are computed (e.g. top_n=5,10,15 and threshold=0,0.9 are 6 settings).
+    Raises ValueError for invalid values.
+    """
+    values = {}
+    for param, default in asdict(MotifSetting()).items():
+        raw_values = [value.strip() for raw in form.getlist(param) for value in raw.split(',') if value.strip()]
+        if len(raw_values) == 0:
+            values[param] = [default]
+            continue
+        try:
+            values[param] = list(dict.fromkeys(type(default)(value) for value in raw_values))
+        except ValueError:
+            raise ValueError(f"Invalid '{param}': {', '.join(raw_values)}")
+    if any(top_n < 1 for top_n in values['top_n']):
+        raise ValueError("Invalid 'top_n'. It has to be at least 1")
+    for param in ['threshold_type', 'sort_type']:
+        if any(value not in METRICS for value in values[param]):
+            raise ValueError(f"Invalid '{param}'. Allowed values are {', '.join(METRICS)}")
+    settings = [MotifSetting(*combination) for combination in itertools.product(*values.values())]
+    if len(settings) > MAX_SETTINGS:
+        raise ValueError(f'Too many settings ({len(settings)}), at most {MAX_SETTINGS} are allowed per request')
+    return settings
+
+
+def get_setting_label(setting: MotifSetting, settings: list[MotifSetting]) -> str:
+    # Only the parameters that differ between the settings of the request
+    return ', '.join(f'{param}={value}' for param, value in asdict(setting).items()
+                     if len({getattr(other, param) for other in settings}) > 1)
+
+
+def run_motif_enrichment(filepath: Path, settings: list[MotifSetting] = (MotifSetting(),),
+                         output_filter: result_filter.ResultFilter = result_filter.ResultFilter()) -> Path:
+    input_df = json_records.read_records(filepath)
+    result_df = run_motif_enrichment_dataframe(input_df, settings)
+    result_df = output_filter.apply(result_df, 'Kinase', 'Log2 Enrichment', '-Log10 p_value adjusted',
+                                    neg_log_pvalues=True)
 
     output_json = filepath.parent / f"motif_enrichment_result.json"
+    if result_encoding.keep_result(output_json, result_df):
+        return output_json
     result_df.to_json(
         path_or_buf=output_json,
         orient="records",
@@ -40,21 +159,142 @@ def run_motif_enrichment(filepath: Path) -> Path:
     return output_json
 
 
-def run_motif_enrichment_dataframe(input_df: pd.DataFrame) -> pd.DataFrame:
-    ## Load the ODD ratios
-    ODDS = pd.read_csv(ODDS_PATH, sep='\t', index_col=['Kinase', 'Position', 'AA'])
+def run_motif_enrichment_batch(filepath: Path, settings: list[MotifSetting] = (MotifSetting(),),
+                               output_filter: result_filter.ResultFilter = result_filter.ResultFilter()) -> Path:
+    """
+    Motif enrichment of every dataset of a cohort (see modules/uploads), the result has the same records per dataset
+    as a request per dataset. The site weights depend on the sites of each dataset, so the datasets are not merged,
+    but the sites of all datasets are annotated in one pass: The sequence contexts are looked up at once and each
+    unique context is scored once, also if it occurs in several datasets.
+    """
+    datasets = dict(uploads.iter_cohort(filepath))
+    annotation_keys = {name: get_annotation_key(get_sites_hash(input_df)) for name, input_df in datasets.items()}
+    annotations = {name: result_cache.load('motif_annotation', key) for name, key in annotation_keys.items()}
+    missing = {name: datasets[name] for name, annotation in annotations.items() if annotation is None}
+    if len(missing) > 0:
+        site_contexts = get_cohort_site_contexts(missing)
+        scored = score_site_contexts(list(site_contexts.values()))
+        for name, contexts in site_contexts.items():
+            annotations[name] = annotate_site_contexts(contexts, scored)
+            result_cache.store('motif_annotation', annotation_keys[name], annotations[name])
+        del scored
+
+    results = {}
+    for name, input_df in datasets.items():
+        cancellation.check_cancelled()
+        result_df = run_motif_enrichment_dataframe(input_df, settings, annotations.pop(name))
+        results[name] = output_filter.apply(result_df, 'Kinase', 'Log2 Enrichment', '-Log10 p_value adjusted',
+                                            neg_log_pvalues=True)
+
+    output_json = filepath.parent / 'motif_enrichment_batch_result.json'
+    if not result_encoding.keep_result(output_json, results):
+        with open(output_json, 'w') as o:
+            o.write(result_encoding.to_records_json(results))
+    return output_json
+
+
+def get_sites_hash(input_df: pd.DataFrame) -> str:
+    return result_cache.hash_values(input_df[[col for col in input_df if col in SITE_COLUMNS]])
 
-    ODDS = ODDS['Odds Ratio'].to_dict()
+
+def get_annotation_key(sites_hash: str) -> str:
+    return result_cache.get_key('motif_annotation', sites_hash,
+                                references=[PHOSPHOSITE_FASTA, ODDS_PATH, QUANTILE_MATRIX_PATH])
+
+
+def run_motif_enrichment_dataframe(input_df: pd.DataFrame,
+                                   settings: list[MotifSetting] = (MotifSetting(),),
+                                   annotation: MotifAnnotation = None) -> pd.DataFrame:
+    """
+    With a single setting, the columns are named '<column> (<experiment>)', with several settings
+    '<column> (<experiment>, <parameters that differ>)'.
+    The annotation of the sites is looked up in the cache or computed if it is not given.
+    """
+    experiment_columns = [col for col in input_df.columns if col not in SITE_COLUMNS]
+
+    # The enrichment of an experiment depends on its column, on the setting and on the sites of the whole dataset
+    # (site weights), the FDR correction is cheap and is always recomputed from the cached enrichment
+    sites_hash = get_sites_hash(input_df)
+    references = [PHOSPHOSITE_FASTA, ODDS_PATH, QUANTILE_MATRIX_PATH]
+    cache_keys = {
+        (experiment, setting): result_cache.get_key('motif_enrichment',
+                                                    sites_hash + result_cache.hash_values(input_df[experiment]),
+                                                    references=references, site_weights=True, **asdict(setting))
+        for experiment in experiment_columns for setting in settings}
+    enrichments = {key: result_cache.load('motif_enrichment', cache_key) for key, cache_key in cache_keys.items()}
+    missing = [key for key, enrichment in enrichments.items() if enrichment is None]
+    if len(missing) > 0:
+        enrichments.update(run_motif_enrichment_analyses(input_df, missing, sites_hash, annotation))
+        for key in missing:
+            result_cache.store('motif_enrichment', cache_keys[key], enrichments[key])
+
+    enrichment_dfs = []
+    for experiment in experiment_columns:
+        for setting in settings:
+            label = experiment if len(settings) == 1 else f'{experiment}, {get_setting_label(setting, settings)}'
+            enrichment_df_experiment = correct_for_multipletesting(enrichments[(experiment, setting)].copy())
+            enrichment_df_experiment.columns = [f'{col} ({label})' for col in enrichment_df_experiment.columns]
+            enrichment_dfs.append(enrichment_df_experiment)
+
+    return pd.concat(enrichment_dfs, axis=1).reset_index(names="Kinase")
+
+
+def run_motif_enrichment_analyses(input_df: pd.DataFrame, analyses: list[tuple[str, MotifSetting]],
+                                  sites_hash: str,
+                                  annotation: MotifAnnotation = None) -> dict[tuple[str, MotifSetting], pd.DataFrame]:
+    """
+    Enrichment of each (experiment, setting). The sites are annotated once (and cached by sites_hash),
+    each setting only selects kinases from the annotation and counts them.
+    """
+    if annotation is None:
+        annotation_key = get_annotation_key(sites_hash)
+        annotation = result_cache.load('motif_annotation', annotation_key)
+    if annotation is None:
+        annotation = annotate_sites(input_df)
+        result_cache.store('motif_annotation', annotation_key, annotation)
+
+    regulations = {experiment: get_regulations(input_df[experiment], annotation)
+                   for experiment in dict.fromkeys(experiment for experiment, _ in analyses)}
+    enrichments = {}
+    for setting in dict.fromkeys(setting for _, setting in analyses):
+        cancellation.check_cancelled()
+        selected = annotation.select(setting)
+        order = annotation.get_order(setting.sort_type)
+        for experiment, experiment_setting in analyses:
+            if experiment_setting == setting:
+                enrichments[(experiment, setting)] = motif_enrichment_analysis(regulations[experiment], annotation,
+                                                                               selected, order)
+    return enrichments
+
+
+def load_motif_references() -> tuple[dict, dict]:
+    ## Load the ODD ratios, from the compiled reference data if available (modules/reference_db)
+    ODDS = reference_db.load_motif_odds()
+    if ODDS is None:
+        ODDS = pd.read_csv(ODDS_PATH, sep='\t', index_col=['Kinase', 'Position', 'AA'])
+
+        ODDS = ODDS['Odds Ratio'].to_dict()
 
     ## Load the qunatiles
-    QUANTILE_MATRIX = pd.read_csv(QUANTILE_MATRIX_PATH, sep='\t', index_col='Score').T
-    QUANTILES = {}
-    for kinase, q in QUANTILE_MATRIX.iterrows():
-        QUANTILES[kinase] = (q.index, q.values)
+    QUANTILES = reference_db.load_motif_quantiles()
+    if QUANTILES is None:
+        QUANTILE_MATRIX = pd.read_csv(QUANTILE_MATRIX_PATH, sep='\t', index_col='Score').T
+        QUANTILES = {}
+        for kinase, q in QUANTILE_MATRIX.iterrows():
+            QUANTILES[kinase] = (q.index, q.values)
+    return ODDS, QUANTILES
+
+
+def annotate_sites(input_df: pd.DataFrame) -> MotifAnnotation:
+    site_contexts = get_site_contexts(input_df)
+    return annotate_site_contexts(site_contexts, score_site_contexts([site_contexts]))
 
-    experiment_columns = [col for col in input_df.columns if
-                          col not in ['Modified sequence', 'Proteins', 'Site positions']]
 
+def get_site_contexts(input_df: pd.DataFrame) -> pd.Series:
+    """
+    The ';'-separated sequence contexts of the phospho sites of each row, '' where the site was not found
+    """
+    input_df = input_df.copy()
     if 'Modified sequence' in input_df:
         input_df = pa.addPeptideAndPsitePositions(input_df, PHOSPHOSITE_FASTA, pspInput=True, context_left=5,
                                                   context_right=5, retain_other_mods=True)
@@ -62,9 +302,45 @@ def run_motif_enrichment_dataframe(input_df: pd.DataFrame) -> pd.DataFrame:
         input_df = pa.addSiteSequenceContext(input_df, PHOSPHOSITE_FASTA, pspInput=True, context_left=5,
                                              context_right=5,
                                              retain_other_mods=True)
+    return input_df['Site sequence context'].reset_index(drop=True)
+
 
-    # Explode for multiple phosphos becomming individual rows
-    input_df['Site sequence context'] = input_df['Site sequence context'].str.split(';')
+def get_cohort_site_contexts(datasets: dict[str, pd.DataFrame]) -> dict[str, pd.Series]:
+    """
+    get_site_contexts of several datasets, the datasets with the same site columns are looked up together
+    """
+    groups = {}
+    for name, input_df in datasets.items():
+        groups.setdefault(tuple(col for col in SITE_COLUMNS if col in input_df), []).append(name)
+    site_contexts = {}
+    for columns, names in groups.items():
+        stacked_contexts = get_site_contexts(pd.concat([datasets[name][list(columns)] for name in names],
+                                                       ignore_index=True))
+        offsets = np.cumsum([0] + [len(datasets[name]) for name in names])
+        for name, start, end in zip(names, offsets[:-1], offsets[1:]):
+            site_contexts[name] = stacked_contexts.iloc[start:end].reset_index(drop=True)
+    return site_contexts
+
+
+def score_site_contexts(site_contexts: list[pd.Series]) -> ScoredContexts:
+    """
+    Scores each unique sequence context of the given sites against all kinases
+    """
+    ODDS, QUANTILES = load_motif_references()
+    sequences = pd.Index(pd.concat(site_contexts, ignore_index=True).str.split(';').explode().unique())
+    sequences = sequences[sequences != '']
+    kinases = list(QUANTILES.keys())
+    scores, percentiles = score_sites(sequences.tolist(), kinases, QUANTILES, ODDS)
+    return ScoredContexts(sequences=sequences, kinases=kinases, scores=scores, percentiles=percentiles)
+
+
+def annotate_site_contexts(site_contexts: pd.Series, scored: ScoredContexts) -> MotifAnnotation:
+    """
+    The annotation of the sites of one dataset, scored holds the scores of (at least) all of their contexts
+    """
+    # Explode for multiple phosphos becomming individual rows, 'Row' is the row of the input
+    input_df = pd.DataFrame({'Row': np.arange(len(site_contexts)),
+                             'Site sequence context': site_contexts.str.split(';')})
     input_df['Site weight'] = 1 / input_df['Site sequence context'].apply(len)
     input_df = input_df.explode('Site sequence context').reset_index(drop=True)
     input_df['Site weight'] = input_df['Site weight'] / input_df.groupby('Site sequence context')[
@@ -74,51 +350,77 @@ def run_motif_enrichment_dataframe(input_df: pd.DataFrame) -> pd.DataFrame:
     mask = (input_df['Site sequence context'] == '')
     input_df = input_df[~mask]
 
-    ## Annotate the Sites with the best kinases
-    input_df[MOTIF_COLS] = input_df[["Site sequence context"]].progress_apply(
-        find_upstream_kinase,
-        Q=QUANTILES,
-        P=ODDS,
-        result_type="expand",
-        axis=1,
-    )
+    ## Look up the scores of each unique site
+    site_index, sequences = pd.factorize(input_df['Site sequence context'])
+    positions = scored.sequences.get_indexer(sequences)
+    return MotifAnnotation(rows=input_df['Row'].to_numpy(dtype='int64'),
+                           site_weights=input_df['Site weight'].to_numpy(dtype='float64'),
+                           site_index=site_index.astype('int64'),
+                           kinases=np.array(scored.kinases, dtype=object),
+                           scores=scored.scores[positions],
+                           percentiles=scored.percentiles[positions])
 
-    enrichment_dfs = []
-    for experiment in tqdm(experiment_columns):
-        input_experiment = (
-            input_df[["Site sequence context", "Site weight", experiment] + MOTIF_COLS]
-            .rename({experiment: "Regulation"}, axis=1)
-            .dropna()
-            .copy()
-        )
-
-        enrichment_df_experiment = motif_enrichment_analysis(
-            input_experiment, site_weights=True
-        )
-        enrichment_df_experiment = correct_for_multipletesting(enrichment_df_experiment)
-        enrichment_df_experiment.columns = [f'{col} ({experiment})' for col in enrichment_df_experiment.columns]
-        enrichment_dfs.append(enrichment_df_experiment)
 
-    return pd.concat(enrichment_dfs, axis=1).reset_index(names="Kinase")
+def score_sites(sequences: list[str], kinases: list[str], Q, P, motif_size=5) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The log2 motif score and the percentile of every kinase for every sequence (sequences x kinases), NaN where the
+    motif score is not positive. The motif score multiplies the odds ratios position by position, starting from the
+    left. The values stay float64, a percentile equal to the threshold or a tie must not change the selection.
+    """
+    amino_acids = sorted({aa for _, _, aa in P})
+    aa_index = {aa: i for i, aa in enumerate(amino_acids)}
+    kinase_index = {kinase: i for i, kinase in enumerate(kinases)}
+    # The last column is for amino acids without odds ratio, they count as 1.0
+    odds = np.ones((len(kinases), 2 * motif_size + 1, len(amino_acids) + 1))
+    for (kinase, pos, aa), odds_ratio in P.items():
+        if kinase in kinase_index and -motif_size <= pos <= motif_size:
+            odds[kinase_index[kinase], pos + motif_size, aa_index[aa]] = odds_ratio
+
+    scores = np.full((len(sequences), len(kinases)), np.nan)
+    percentiles = np.full((len(sequences), len(kinases)), np.nan)
+    for start in tqdm(range(0, len(sequences), SCORING_CHUNK_SIZE), disable=None):
+        chunk = sequences[start:start + SCORING_CHUNK_SIZE]
+        assert all(len(seq) == 2 * motif_size + 1 for seq in chunk)
+        encoded = np.array([[aa_index.get(aa, len(amino_acids)) for aa in seq] for seq in chunk], dtype='int64')
+        motif_scores = np.ones((len(chunk), len(kinases)))
+        for pos in range(2 * motif_size + 1):
+            motif_scores *= odds[:, pos, encoded[:, pos]].T
+        scored = motif_scores > 0
+        chunk_scores = np.full(motif_scores.shape, np.nan)
+        chunk_scores[scored] = np.log2(motif_scores[scored])
+        chunk_percentiles = np.column_stack([quantiles(chunk_scores[:, i], Q[kinase])
+                                             for i, kinase in enumerate(kinases)])
+        chunk_percentiles[~scored] = np.nan
+        scores[start:start + len(chunk)] = chunk_scores
+        percentiles[start:start + len(chunk)] = chunk_percentiles
+    return scores, percentiles
+
+
+def quantiles(s: np.ndarray, Q_kinase) -> np.ndarray:
+    """
+    quantile for an array of scores
+    """
+    scores, quantiles = np.asarray(Q_kinase[0], dtype='float64'), np.asarray(Q_kinase[1], dtype='float64')
+    index = np.searchsorted(scores, s)
+    inner = index + 1 < len(scores)
+    index = np.where(inner, index, 0)
+    y1, y2 = quantiles[index], quantiles[index + 1]
+    x1, x2 = scores[index], scores[index + 1]
+    return np.where(inner, y1 + (s - x1) * (y2 - y1) / (x2 - x1), quantiles[-1])
 
 
-def quantile(s, Q_kinase):
-    scores, quantiles = Q_kinase
-    index = np.searchsorted(scores, s)
-    if index + 1 >= len(scores):
-        quantile = quantiles[-1]
-    else:
-        y1 = quantiles[index]
-        y2 = quantiles[index + 1]
-        x1 = scores[index]
-        x2 = scores[index + 1]
-        quantile = y1 + (s - x1) * (y2 - y1) / (x2 - x1)
-    return float(quantile)
+def get_regulations(regulation: pd.Series, annotation: MotifAnnotation) -> np.ndarray:
+    """
+    Index into REGULATION_TYPES of the regulation of each site sequence context, -1 for a missing or other value
+    """
+    return pd.Categorical(regulation.to_numpy()[annotation.rows], categories=REGULATION_TYPES).codes
 
 
 def motif_enrichment_analysis(
-    df,
-    site_weights=False,
+    regulations: np.ndarray,
+    annotation: MotifAnnotation,
+    selected: np.ndarray,
+    order: np.ndarray,
 ):
     """
     Motif enrichment according to the Johnson paper DOI: 10.1038/s41586-022-05575-3 as default values.
@@ -127,37 +429,36 @@ def motif_enrichment_analysis(
 
     Input
     -----
-    df: DataFrame with 'Regulation' & 'SITE_+/-5_AA' column
-    P : ODDS Matrix
-    Q : QUANTILE Matrix
+    regulations: Regulation of each site sequence context of the annotation (see get_regulations)
+    annotation: Sites and kinase ranking of the dataset
+    selected: Kinases selected for each unique site (see MotifAnnotation.select)
+    order: Kinase ranking of each unique site for the sort type of the setting (see MotifAnnotation.get_order)
 
     Returns
     -------
-    enrichment DataFrame with results
+    enrichment DataFrame with results, the kinases in the order they first occur in the sites (by rank within a site)
     """
-    # Filter for correct regulation
-    regulation_types = {'down', 'up', 'not'}
-    df = df[df['Regulation'].isin(regulation_types)]
-
-    # initialize the 'Site weight' column and if customized overwrite from input df
-    if (not site_weights) or ("Site weight" not in df):
-        motif = df[MOTIF_COLS + ["Regulation"]]
-        motif.loc[:, "Site weight"] = 1
-    else:
-        motif = df[MOTIF_COLS + ["Regulation", "Site weight"]]
+    valid = regulations >= 0
+    regulations = regulations[valid]
+    site_weights = annotation.site_weights[valid]
+    site_index = annotation.site_index[valid]
 
     ## Count total down, not, up sites
-    total_regulations = motif.groupby('Regulation')['Site weight'].sum().to_dict()
-    total_regulations = pd.Series({reg: total_regulations.get(reg, 0) for reg in regulation_types})
+    total_regulations = pd.Series(site_weights).groupby(np.array(REGULATION_TYPES)[regulations]).sum().to_dict()
+    total_regulations = pd.Series({reg: total_regulations.get(reg, 0) for reg in REGULATION_TYPES})
 
     ## For each site, count if a Kinase was present with the correct regulation category
-    counter = defaultdict(lambda: {'down': 0, 'up': 0, 'not': 0})
-    for i, row in motif.iterrows():
-        regulation = row['Regulation']
-        site_weight = row['Site weight']
-        for kinase in row['Top Motif Kinases'].split(';'):
-            counter[kinase][regulation] += site_weight
-    kinase_counts = pd.DataFrame(counter).T
+    # The weights are added site by site, fisher_exact truncates the weighted counts to integers, so another order of
+    # the additions could change a count
+    sites, kinase_index = np.nonzero(selected[site_index])
+    counts = np.zeros((len(annotation.kinases), len(REGULATION_TYPES)))
+    np.add.at(counts, (kinase_index, regulations[sites]), site_weights[sites])
+    present, first = np.unique(kinase_index, return_index=True)
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(order.shape[1], dtype=order.dtype), axis=1)
+    first_sites = sites[first]
+    present = present[np.lexsort((ranks[site_index[first_sites], present], first_sites))]
+    kinase_counts = pd.DataFrame(counts[present], index=annotation.kinases[present], columns=REGULATION_TYPES)
 
     ## Make the fisher exact test for each kinase
     enrichment = {}
@@ -168,95 +469,6 @@ def motif_enrichment_analysis(
     return enrichment
 
 
-def find_upstream_kinase(seq: pd.Series, Q, P, top_n=15, threshold=-np.inf, threshold_type='percentile', sort_type='percentile'):
-    """
-    Score all kinases against input sequence based on Q-Matrix and P-Matrix.
-    Percentile is the standard metic according to Johnson et al. and has the best perfromace in my hands as well.
-
-    Input
-    -----
-    seq : str
-        seqeunce to score
-    Q : dict
-        Quantile matrix Q
-    P : dict
-        Probabilty matrix P
-    top_n : int
-        considers the top n ranked kinases only, default 15.
-    threshold: float
-        filters for total value bigger than threshold, default -np.inf.
-    threshold_type: float
-        specifies which metric should be used for filtering (0=score, 1=percentile, 2=score*percentile), default is percentile [1]
-    sort_type: float
-        specifies which metric should be used for ranking (0=score, 1=percentile, 2=score*percentile), default is percentile [1]
-
-    Returns
-    -------
-    (kinases, scores, percentiles, totals)
-    each is a string with semicolon sorted values
-    """
-    if len(seq["Site sequence context"]) == 0:
-        return ("", "", "", "")
-    
-    # Map the different parameter options
-    str_to_int_map = {'score': 0, 'percentile': 1, 'total': 2, }
-    if threshold_type not in str_to_int_map:
-        raise ValueError('threshold_type')
-    if sort_type not in str_to_int_map:
-        raise ValueError('sort_type')
-    threshold_type = str_to_int_map[threshold_type]
-    sort_type = str_to_int_map[sort_type]
-
-    scores = []
-    kinases = []
-    for kinase in Q.keys():
-        s = score(seq["Site sequence context"], kinase, P, motif_size=5)
-        if s <= 0:
-            continue
-        scores.append(s)
-        kinases.append(kinase)
-    scores = np.log2(np.array(scores))
-
-    quantiles = []
-    for kinase, s in zip(kinases, scores):
-        quantiles.append(quantile(s, Q[kinase]))
-    quantiles = np.array(quantiles)
-    totals = scores * quantiles
-
-    result = {k: (s, q, t) for k, s, q, t in zip(kinases, scores, quantiles, totals)}
-    # Sort by sort_type, then filter threshold_type > threshold, and then take the topN of the list
-    out = sorted(result.items(), key=lambda item: item[1][sort_type], reverse=True)
-    out = [(k, *tpl) for k, tpl in out if tpl[threshold_type] > threshold]
-    out = out[:top_n]
-
-    if len(out) == 0:
-        return ("", "", "", "")
-
-    kinases, scores, quantiles, totals = zip(*out)
-    scores = np.round(scores, 3)
-    quantiles = np.round(quantiles, 3)
-    totals = np.round(totals, 3)
-
-    # Transform to ; separated lists
-    kinases = ';'.join(kinases)  # kinase
-    scores = ';'.join(map(str, scores))  # [0] score
-    percentiles = ';'.join(map(str, quantiles))  # [1] percentile
-    totals = ';'.join(map(str, totals))  # [2] total = s*q
-    return (kinases, scores, percentiles, totals)
-
-
-def score(seq, kinase, P, motif_size=5):
-    """
-    Score the motife based on the AA positional ODDS matrix given a sequence and a kinase
-    """
-    assert len(seq) == (2 * motif_size + 1)
-    score = 1.0
-    for i, aa in enumerate(seq):
-        pos = i - motif_size
-        score *= P.get((kinase, pos, aa), 1.0)
-    return score
-
-
 def kinase_motif_enrichment_test(counts, total_regulations):
     """
     Motif enrichment according to the Johnson paper DOI: 10.1038/s41586-022-05575-3
@@ -322,6 +534,10 @@ def calculate_log_odds_ratio(table):
 
 
 def correct_for_multipletesting(df):
+    if len(df) == 0:
+        # A strict threshold can leave no kinase
+        df['-Log10 p_value adjusted'] = pd.Series(dtype='float64')
+        return df
     p_vals = 10 ** (-1 * df['-Log10 p_value'])
     reject, p_vals_corrected, _, _ = sm.stats.multipletests(p_vals, alpha=0.05, method='fdr_bh')
     df['-Log10 p_value adjusted'] = - np.log10(p_vals_corrected)
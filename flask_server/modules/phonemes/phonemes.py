@@ -1,5 +1,9 @@
-import subprocess
+import os
 import json
+import functools
+import hashlib
+import shutil
+import threading
 from collections import defaultdict
 from pathlib import Path
 import requests
@@ -8,12 +12,25 @@ import numpy as np
 import pandas as pd
 import py4cytoscape as p4c
 
+from modules.data_exchange import data_exchange
+from modules.server_logging import server_logging
+from modules.job_budget import job_budget
+from modules.cancellation import cancellation
+from modules.cache_eviction import cache_eviction
+from modules.reference_db import reference_db
+
 PHONEMES_PKN = Path('../db/phonemesPKN.csv')
 PHONEMES_KSN = Path('../db/phonemesKSN.csv')
 PHONEMES_PKN_KSN = Path('../db/phonemes_PKN_KSN.csv')
 CYTOSCAPE_PATH = '../Cytoscape_v3.10.1/Cytoscape'
-UNIPROT_MAPPING_ENDPOINT = 'https://rest.uniprot.org/idmapping/run'
-UNIPROT_RESULT_ENDPOINT = 'https://rest.uniprot.org/idmapping/stream/'
+UNIPROT_URL = os.getenv('UNIPROT_URL', 'https://rest.uniprot.org')
+UNIPROT_MAPPING_ENDPOINT = f'{UNIPROT_URL}/idmapping/run'
+UNIPROT_RESULT_ENDPOINT = f'{UNIPROT_URL}/idmapping/stream/'
+RUN_PHONEMES_SCRIPT = Path('modules/phonemes/run_phonemes.R')
+# Pruned networks (run_phonemes.R) and full results are kept across requests, the PKN rarely changes
+PHONEMES_CACHE_DIR = Path(os.getenv('PHONEMES_CACHE_DIR', '../cache/phonemes'))
+PHONEMES_CACHE_MAX_MB = float(os.getenv('PHONEMES_CACHE_MAX_MB', '2048'))
+PHONEMES_CACHE_MAX_AGE_DAYS = float(os.getenv('PHONEMES_CACHE_MAX_AGE_DAYS', '30'))
 
 
 def preprocess_phonemes(filepath: Path) -> Path:
@@ -26,9 +43,12 @@ def preprocess_phonemes(filepath: Path) -> Path:
     idcolumn = 'Site' if 'Site' in sites_df else 'id'
     experiment_columns = [col for col in sites_df.columns if col != idcolumn]
 
-    phonemes_pkn_ksn = pd.read_csv(PHONEMES_PKN_KSN)
-    all_pkn_ksn_nodes = set(np.concatenate(
-        [phonemes_pkn_ksn['source'].values, phonemes_pkn_ksn['target'].values]))
+    # From the compiled reference data if available (modules/reference_db)
+    all_pkn_ksn_nodes = reference_db.load_phonemes_nodes()
+    if all_pkn_ksn_nodes is None:
+        phonemes_pkn_ksn = pd.read_csv(PHONEMES_PKN_KSN)
+        all_pkn_ksn_nodes = set(np.concatenate(
+            [phonemes_pkn_ksn['source'].values, phonemes_pkn_ksn['target'].values]))
 
     sites_df = sites_df[sites_df['Site'].apply(lambda site: site in all_pkn_ksn_nodes)]
 
@@ -39,9 +59,13 @@ def preprocess_phonemes(filepath: Path) -> Path:
             pd.Series(data=1, index=input_json['targets'][experiment]['up']),
             pd.Series(data=-1, index=input_json['targets'][experiment]['down'])
         ])
+        targets_df = target_series.rename('sign').rename_axis('target').reset_index()
 
-        sites_df[[idcolumn, experiment]].dropna().to_csv(f'{output_prefix}_{experiment}_sites.csv', index=False)
-        target_series.to_csv(f'{output_prefix}_{experiment}_targets.csv', index=True, header=False)
+        data_exchange.write_matrix(sites_df[[idcolumn, experiment]].dropna(),
+                                   data_exchange.matrix_path(output_dir, f'{output_prefix.name}_{experiment}_sites'))
+        data_exchange.write_matrix(targets_df,
+                                   data_exchange.matrix_path(output_dir, f'{output_prefix.name}_{experiment}_targets'),
+                                   header=False)
 
     # Create a file containing the experiment names
     with open(str(output_prefix) + '_experiments.csv', 'w') as experiment_outfile:
@@ -58,38 +82,80 @@ def run_phonemes(file_prefix: Path) -> Path:
         experiments = infile.read().split(',')
 
     for experiment in experiments:
+        cancellation.check_cancelled()
         output_path = output_dir / f'{experiment}_phonemes_out.sif'
-        subprocess_output = subprocess.run(["Rscript",
-                                            "modules/phonemes/run_phonemes.R",
-                                            f'{file_prefix}_{experiment}_sites.csv',
-                                            f'{file_prefix}_{experiment}_targets.csv',
-                                            output_path],
+        sites_path = data_exchange.matrix_path(output_dir, f'{file_prefix.name}_{experiment}_sites')
+        targets_path = data_exchange.matrix_path(output_dir, f'{file_prefix.name}_{experiment}_targets')
+        cached_result = PHONEMES_CACHE_DIR / 'results' / f'{get_result_key(sites_path, targets_path)}.sif'
+        if cached_result.exists():
+            print(f'Using cached PHONEMeS result for {experiment}')
+            shutil.copyfile(cached_result, output_path)
+            cache_eviction.touch(cached_result)
+            continue
+        subprocess_output = job_budget.run(["Rscript",
+                                            RUN_PHONEMES_SCRIPT,
+                                            sites_path,
+                                            targets_path,
+                                            output_path,
+                                            PHONEMES_CACHE_DIR / 'networks'],
                                            capture_output=True, text=True)
-        print(subprocess_output.stdout)
-        print(subprocess_output.stderr)
+        server_logging.log_subprocess_output(subprocess_output, f'phonemes_{experiment}')
+        if subprocess_output.returncode == 0 and output_path.exists():
+            store_result(output_path, cached_result)
+        cache_eviction.schedule(PHONEMES_CACHE_DIR, PHONEMES_CACHE_MAX_MB, PHONEMES_CACHE_MAX_AGE_DAYS)
     return output_dir
 
 
-def run_cytoscape(phonemes_outputfolder: Path) -> Path:
-    cytoscape = subprocess.Popen(CYTOSCAPE_PATH)
-    # Wait until cytoscape is ready
-    not_found = True
-    while not_found:
-        try:
-            p4c.cytoscape_ping()
-            not_found = False
-        except (
-                requests.exceptions.RequestException,
-                requests.exceptions.ConnectionError,
-                requests.exceptions.HTTPError):
-            time.sleep(.5)
-
-    experiment_file = phonemes_outputfolder / 'input_experiments.csv'
-    with open(experiment_file) as infile:
-        experiments = infile.read().split(',')
+@functools.cache
+def get_file_fingerprint(path: Path) -> str:
+    # The PKN and the R script only change with a new deployment, so they are hashed once per process
+    return hashlib.sha256(path.read_bytes()).hexdigest()
 
-    for experiment in experiments:
-        try:
+
+def get_result_key(sites_path: Path, targets_path: Path) -> str:
+    """
+    PHONEMeS is deterministic for the same sites, targets, prior knowledge network and script,
+    so a result can be reused whenever all four are identical.
+    """
+    key = hashlib.sha256()
+    for path in (sites_path, targets_path):
+        key.update(path.read_bytes())
+    key.update(get_file_fingerprint(PHONEMES_PKN).encode())
+    key.update(get_file_fingerprint(RUN_PHONEMES_SCRIPT).encode())
+    return key.hexdigest()
+
+
+def store_result(result_path: Path, cached_result: Path):
+    cached_result.parent.mkdir(parents=True, exist_ok=True)
+    # Copy to a temporary file first, so concurrent workers never read a partially written entry
+    tmp_path = cached_result.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    shutil.copyfile(result_path, tmp_path)
+    os.replace(tmp_path, cached_result)
+
+
+def run_cytoscape(phonemes_outputfolder: Path) -> Path:
+    # The launcher script starts Java, both are killed as one process tree
+    cytoscape = cancellation.popen(CYTOSCAPE_PATH)
+    try:
+        # Wait until cytoscape is ready
+        not_found = True
+        while not_found:
+            cancellation.check_cancelled()
+            try:
+                p4c.cytoscape_ping()
+                not_found = False
+            except (
+                    requests.exceptions.RequestException,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.HTTPError):
+                time.sleep(.5)
+
+        experiment_file = phonemes_outputfolder / 'input_experiments.csv'
+        with open(experiment_file) as infile:
+            experiments = infile.read().split(',')
+
+        for experiment in experiments:
+            cancellation.check_cancelled()
             filepath = phonemes_outputfolder / f'{experiment}_phonemes_out.sif'
             phonemes_df = pd.read_csv(filepath)
             network = phonemes_df.rename(
@@ -103,11 +169,11 @@ def run_cytoscape(phonemes_outputfolder: Path) -> Path:
             p4c.layout_network()
             output_path = phonemes_outputfolder / f'{experiment}_cytoscape_out.cx'
             p4c.export_network(filename=str(output_path), type='CX', overwrite_file=True)
-        except FileNotFoundError:
-            cytoscape.kill()
-            raise
-
-    cytoscape.kill()
+    finally:
+        # Also if the analysis failed or was cancelled, Cytoscape would keep running otherwise
+        cancellation.kill_process_tree(cytoscape)
+        cytoscape.wait()
+        cancellation.unregister(cytoscape)
     return phonemes_outputfolder
 
 
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import hmac
+import time
+import uuid
+import resource
+import functools
+import contextvars
+import threading
+import subprocess
+from collections import Counter
+from pathlib import Path
+import werkzeug
+
+from modules.cache_eviction import cache_eviction
+
+# Profiling is only possible if an admin token is configured, without it the request handlers are not wrapped at all
+PROFILING_ADMIN_TOKEN = os.getenv('PROFILING_ADMIN_TOKEN', '')
+PROFILE_DIR = Path(os.getenv('PROFILE_DIR', '../profiles'))
+# Profiles are deleted after this many days, or earlier if they take more space (oldest first)
+PROFILE_MAX_AGE_DAYS = float(os.getenv('PROFILE_MAX_AGE_DAYS', '7'))
+PROFILE_MAX_MB = float(os.getenv('PROFILE_MAX_MB', '512'))
+# Seconds between two stack samples
+PROFILING_INTERVAL = float(os.getenv('PROFILING_INTERVAL', '0.005'))
+PROFILE_HEADER = 'X-Profile'
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+
+# The profiler of the current request, threads started by the request have to copy the context
+ACTIVE_PROFILER = contextvars.ContextVar('active_profiler', default=None)
+_popen_lock = threading.Lock()
+_active_profilers = 0
+_original_popen = subprocess.Popen
+
+
+class ProfiledPopen(subprocess.Popen):
+    """
+    Popen that collects the resource usage of the child when it is reaped (wait4 instead of waitpid).
+    Only installed as subprocess.Popen while a request is profiled, so subprocess.run picks it up everywhere.
+    The usage is attributed to the profiler of the request that started the child.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.profiler = ACTIVE_PROFILER.get()
+        self.start_time = time.perf_counter()
+        super().__init__(*args, **kwargs)
+
+    def _try_wait(self, wait_flags):
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return self.pid, 0
+        if pid == self.pid and self.profiler is not None:
+            self.profiler.record_child(self.args, time.perf_counter() - self.start_time, rusage)
+        return pid, sts
+
+
+class RequestProfiler:
+    """
+    Sampling profiler for one request: A background thread periodically records the Python stacks of the
+    request thread and of all threads started during the request (e.g. the ssGSEA shards).
+    With threaded workers, threads of requests that start at the same time are sampled as well.
+    The samples are written as collapsed stacks ('frame;frame;frame count'), the format of flamegraph.pl and speedscope.
+    cpu_time is the CPU time of the request thread. The sampler also records the peak growth of the worker's RSS,
+    which includes the allocations of concurrent requests in the same worker.
+    """
+
+    def __init__(self, interval: float = PROFILING_INTERVAL):
+        self.interval = interval
+        self.profile_id = uuid.uuid4().hex
+        self.samples = Counter()
+        self.children = []
+        self.peak_rss_growth_mb = 0
+        self._children_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self._target_thread = threading.get_ident()
+        self._ignored_threads = {ident for ident in sys._current_frames() if ident != self._target_thread}
+        self._token = ACTIVE_PROFILER.set(self)
+        install_profiled_popen()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.thread_time()
+        self._baseline_rss_mb = get_rss_mb()
+        self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._sampler.join()
+        self.wall_time = time.perf_counter() - self._start_wall
+        self.cpu_time = time.thread_time() - self._start_cpu
+        uninstall_profiled_popen()
+        ACTIVE_PROFILER.reset(self._token)
+        return False
+
+    def _sample(self):
+        self._ignored_threads.add(threading.get_ident())
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident not in self._ignored_threads:
+                    self.samples[collapse_stack(frame)] += 1
+            self.peak_rss_growth_mb = max(self.peak_rss_growth_mb, get_rss_mb() - self._baseline_rss_mb)
+
+    def record_child(self, args, wall_time: float, rusage: resource.struct_rusage | None):
+        command = [str(arg) for arg in args] if isinstance(args, (list, tuple)) else [str(args)]
+        with self._children_lock:
+            self.children.append({'command': ' '.join(command[:2]),
+                                  'wall_time': round(wall_time, 3),
+                                  'cpu_time': None if rusage is None else round(rusage.ru_utime + rusage.ru_stime, 3),
+                                  # Linux reports ru_maxrss in KiB
+                                  'peak_memory_mb': None if rusage is None else round(rusage.ru_maxrss / 1024, 1)})
+
+    def save(self, method: str) -> Path:
+        output_dir = PROFILE_DIR / self.profile_id
+        Path.mkdir(output_dir, parents=True, exist_ok=True)
+        with open(output_dir / 'stacks.collapsed', 'w') as outfile:
+            outfile.writelines(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+        summary = {'method': method,
+                   'wall_time': round(self.wall_time, 3),
+                   'cpu_time': round(self.cpu_time, 3),
+                   'peak_rss_growth_mb': round(self.peak_rss_growth_mb, 1),
+                   'sampling_interval': self.interval,
+                   'samples': sum(self.samples.values()),
+                   'children': self.children}
+        with open(output_dir / 'profile.json', 'w') as outfile:
+            json.dump(summary, outfile, indent=2)
+        cache_eviction.schedule(PROFILE_DIR, PROFILE_MAX_MB, PROFILE_MAX_AGE_DAYS, remove_directories=True)
+        return output_dir
+
+
+def get_rss_mb() -> float:
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+
+
+def install_profiled_popen():
+    global _active_profilers
+    with _popen_lock:
+        if _active_profilers == 0:
+            subprocess.Popen = ProfiledPopen
+        _active_profilers += 1
+
+
+def uninstall_profiled_popen():
+    global _active_profilers
+    with _popen_lock:
+        _active_profilers -= 1
+        if _active_profilers == 0:
+            subprocess.Popen = _original_popen
+
+
+def collapse_stack(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+def is_authorized(post_request: werkzeug.Request) -> bool:
+    token = post_request.headers.get(ADMIN_TOKEN_HEADER, '')
+    return bool(PROFILING_ADMIN_TOKEN) and hmac.compare_digest(token.encode(), PROFILING_ADMIN_TOKEN.encode())
+
+
+def is_requested(post_request: werkzeug.Request) -> bool:
+    flag = post_request.headers.get(PROFILE_HEADER) or post_request.form.get('profile')
+    return flag in ('1', 'true') and is_authorized(post_request)
+
+
+def profiled(method: str, post_request: werkzeug.Request):
+    """
+    Decorator for request handlers. If a request asks for profiling (form field 'profile=1' or header 'X-Profile: 1')
+    and carries the admin token, the handler runs under the RequestProfiler and the response gets the profile id
+    in the 'X-Profile-Id' header. Without a configured admin token the handler is returned unchanged.
+    """
+    def decorator(handler):
+        if not PROFILING_ADMIN_TOKEN:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            if not is_requested(post_request):
+                return handler(*args, **kwargs)
+            with RequestProfiler() as profiler:
+                response = handler(*args, **kwargs)
+            profiler.save(method)
+            print(f'{method} request profiled. Profile ID: {profiler.profile_id}')
+            if isinstance(response, werkzeug.Response):
+                response.headers['X-Profile-Id'] = profiler.profile_id
+            return response
+        return wrapper
+    return decorator
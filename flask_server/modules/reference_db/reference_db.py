@@ -0,0 +1,261 @@
+"""
+Compiles the text reference data under db/ into typed binary artifacts (.npz with interned identifiers)
+and loads them at runtime.
+Compile (from the flask_server directory, see Dockerfile): python -m modules.reference_db.reference_db
+The manifest records the content hash of every artifact and the hash and version of its sources.
+At runtime an artifact is only used if the manifest, the artifact and its sources still match,
+a mismatch raises ReferenceVersionError. Without compiled artifacts, the modules parse the text files as before.
+"""
+import os
+import re
+import sys
+import json
+import functools
+from datetime import date
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from modules.file_hash import file_hash
+
+REFERENCE_DB_DIR = Path(os.getenv('REFERENCE_DB_DIR', '../db/compiled'))
+MANIFEST_FILE = 'manifest.json'
+# Increase whenever the layout of an artifact changes
+ARTIFACT_FORMAT_VERSION = 1
+
+KSEA_ADJACENCY_MATRIX = Path('../db/psp_kinase_substrate_adjacency_matrix.csv')
+PHONEMES_PKN_KSN = Path('../db/phonemes_PKN_KSN.csv')
+MOTIF_ODDS = Path('../db/kinase_library/Motif_Odds_Ratios.txt')
+MOTIF_QUANTILE_MATRIX = Path('../db/kinase_library/Kinase_Score_Quantile_Matrix.txt')
+GMT_FILES = [Path('../db/c2.cp.kegg+wp.v2023.2.Hs.symbols.gmt'),
+             Path('../ssGSEA2.0/db/ptmsigdb/ptm.sig.db.all.flanking.human.v2.0.0.gmt'),
+             Path('../ssGSEA2.0/db/ptmsigdb/ptm.sig.db.all.uniprot.human.v2.0.0.gmt')]
+
+
+class ReferenceVersionError(Exception):
+    pass
+
+
+def get_source_version(path: Path) -> str:
+    with open(path) as infile:
+        first_line = infile.readline()
+    # update_ksea_es_db.py writes '### Database Version: <date>' above the header
+    if first_line.startswith('### Database Version:'):
+        return first_line.split(':', 1)[1].strip()
+    # Versioned file names, e.g. c2.cp.kegg+wp.v2023.2.Hs.symbols.gmt
+    match = re.search(r'\.v(\d+(\.\d+)*)\.', path.name)
+    if match:
+        return match.group(1)
+    return date.fromtimestamp(path.stat().st_mtime).isoformat()
+
+
+def pack_strings(values: np.ndarray) -> np.ndarray:
+    # One UTF-8 buffer instead of a fixed-width unicode array, which would pad every value to the longest one
+    return np.frombuffer('\n'.join(values.tolist()).encode(), dtype='uint8')
+
+
+def unpack_strings(packed: np.ndarray, n_values: int) -> np.ndarray:
+    if n_values == 0:
+        return np.array([], dtype=object)
+    return np.array(packed.tobytes().decode().split('\n'), dtype=object)
+
+
+def save_artifact(artifact_file: Path, arrays: dict[str, np.ndarray]):
+    # String arrays are packed, '<name>.n' keeps their length so empty strings survive the round trip
+    packed = {}
+    for key, values in arrays.items():
+        if values.dtype.kind in 'UO':
+            packed[f'{key}.strings'] = pack_strings(values)
+            packed[f'{key}.n'] = np.array(len(values))
+        else:
+            packed[key] = values
+    np.savez(artifact_file, **packed)
+
+
+def intern(values) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Unique identifiers and the int32 index of each value into them
+    """
+    unique_values, indices = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    return unique_values, indices.astype('int32')
+
+
+### Compilers: Each one reads its sources and returns the arrays of the artifact
+
+def compile_ksea_adjacency(path: Path) -> dict[str, np.ndarray]:
+    adjacency_matrix = pd.read_csv(path, skiprows=1).set_index('p_site')
+    values = adjacency_matrix.to_numpy(dtype='float64')
+    rows, cols = np.nonzero(~np.isnan(values))
+    return {'sites': adjacency_matrix.index.to_numpy(dtype=str),
+            'kinases': adjacency_matrix.columns.to_numpy(dtype=str),
+            'row': rows.astype('int32'),
+            'col': cols.astype('int32'),
+            'value': values[rows, cols].astype('int8')}
+
+
+def compile_phonemes_nodes(path: Path) -> dict[str, np.ndarray]:
+    # preprocess_phonemes only needs the node set, run_phonemes.R reads the networks itself
+    network = pd.read_csv(path, dtype={'source': str, 'target': str})
+    return {'nodes': np.unique(np.concatenate([network['source'], network['target']]).astype(str))}
+
+
+def compile_motif_odds(path: Path) -> dict[str, np.ndarray]:
+    odds = pd.read_csv(path, sep='\t', usecols=['Kinase', 'Position', 'AA', 'Odds Ratio'])
+    kinases, kinase_indices = intern(odds['Kinase'])
+    return {'kinases': kinases,
+            'kinase': kinase_indices,
+            'position': odds['Position'].to_numpy(dtype='int8'),
+            'aa': odds['AA'].to_numpy(dtype=str),
+            'odds': odds['Odds Ratio'].to_numpy(dtype='float64')}
+
+
+def compile_motif_quantiles(path: Path) -> dict[str, np.ndarray]:
+    quantile_matrix = pd.read_csv(path, sep='\t', index_col='Score')
+    return {'scores': quantile_matrix.index.to_numpy(dtype='float64'),
+            'kinases': quantile_matrix.columns.to_numpy(dtype=str),
+            'quantiles': quantile_matrix.to_numpy(dtype='float64')}
+
+
+def compile_gmt(path: Path) -> dict[str, np.ndarray]:
+    names, descriptions, members, offsets = [], [], [], [0]
+    with open(path) as infile:
+        for line in infile:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 2:
+                continue
+            names.append(fields[0])
+            descriptions.append(fields[1])
+            members.extend(member for member in fields[2:] if member)
+            offsets.append(len(members))
+    genes, member_indices = intern(members)
+    return {'names': np.array(names, dtype=str),
+            'descriptions': np.array(descriptions, dtype=str),
+            'genes': genes,
+            'members': member_indices,
+            'offsets': np.array(offsets, dtype='int64')}
+
+
+def get_artifact_sources() -> dict[str, tuple]:
+    artifacts = {'ksea_adjacency': (compile_ksea_adjacency, KSEA_ADJACENCY_MATRIX),
+                 'phonemes_pkn_ksn': (compile_phonemes_nodes, PHONEMES_PKN_KSN),
+                 'motif_odds': (compile_motif_odds, MOTIF_ODDS),
+                 'motif_quantiles': (compile_motif_quantiles, MOTIF_QUANTILE_MATRIX)}
+    for gmt_file in GMT_FILES:
+        artifacts[f'gmt_{gmt_file.stem}'] = (compile_gmt, gmt_file)
+    return artifacts
+
+
+def compile_all(output_dir: Path = REFERENCE_DB_DIR) -> dict:
+    Path.mkdir(output_dir, parents=True, exist_ok=True)
+    manifest = {'format_version': ARTIFACT_FORMAT_VERSION, 'compiled': date.today().isoformat(), 'artifacts': {}}
+    for name, (compiler, source) in get_artifact_sources().items():
+        if not source.exists():
+            print(f'Skipping {name}, {source} does not exist')
+            continue
+        artifact_file = output_dir / f'{name}.npz'
+        save_artifact(artifact_file, compiler(source))
+        manifest['artifacts'][name] = {'file': artifact_file.name,
+                                       'sha256': file_hash.hash_file(artifact_file),
+                                       'source': str(source),
+                                       'source_sha256': file_hash.hash_file(source),
+                                       'source_version': get_source_version(source)}
+        print(f'Compiled {source} into {artifact_file} ({artifact_file.stat().st_size / 1024:.0f} KiB)')
+    with open(output_dir / MANIFEST_FILE, 'w') as outfile:
+        json.dump(manifest, outfile, indent=2)
+    return manifest
+
+
+### Runtime
+
+@functools.cache
+def load_manifest(reference_db_dir: Path | None = None) -> dict | None:
+    manifest_file = (reference_db_dir or REFERENCE_DB_DIR) / MANIFEST_FILE
+    if not manifest_file.exists():
+        return None
+    manifest = json.load(open(manifest_file))
+    if manifest['format_version'] != ARTIFACT_FORMAT_VERSION:
+        raise ReferenceVersionError(f'{manifest_file} has format version {manifest["format_version"]}, '
+                                    f'expected {ARTIFACT_FORMAT_VERSION}. Recompile the reference data.')
+    return manifest
+
+
+@functools.cache
+def load_artifact(name: str, reference_db_dir: Path | None = None) -> dict[str, np.ndarray] | None:
+    """
+    The arrays of an artifact, or None if it has not been compiled. Checked once per process.
+    """
+    reference_db_dir = reference_db_dir or REFERENCE_DB_DIR
+    manifest = load_manifest(reference_db_dir)
+    if manifest is None or name not in manifest['artifacts']:
+        return None
+    entry = manifest['artifacts'][name]
+    artifact_file = reference_db_dir / entry['file']
+    if file_hash.hash_file(artifact_file) != entry['sha256']:
+        raise ReferenceVersionError(f'{artifact_file} does not match the manifest. Recompile the reference data.')
+    if Path(entry['source']).exists() and file_hash.hash_file(Path(entry['source'])) != entry['source_sha256']:
+        raise ReferenceVersionError(f'{entry["source"]} changed after {artifact_file} was compiled '
+                                    f'(version {entry["source_version"]}). Recompile the reference data.')
+    arrays = {}
+    with np.load(artifact_file, allow_pickle=False) as artifact:
+        for key in artifact.files:
+            if key.endswith('.strings'):
+                name = key.removesuffix('.strings')
+                arrays[name] = unpack_strings(artifact[key], int(artifact[f'{name}.n']))
+            elif not key.endswith('.n'):
+                arrays[key] = artifact[key]
+    return arrays
+
+
+def load_ksea_adjacency() -> pd.DataFrame | None:
+    """
+    Same DataFrame as pd.read_csv(KSEA_ADJACENCY_MATRIX, skiprows=1).set_index('p_site')
+    """
+    artifact = load_artifact('ksea_adjacency')
+    if artifact is None:
+        return None
+    values = np.full((len(artifact['sites']), len(artifact['kinases'])), np.nan)
+    values[artifact['row'], artifact['col']] = artifact['value']
+    return pd.DataFrame(values, index=pd.Index(artifact['sites'], name='p_site'),
+                        columns=artifact['kinases'])
+
+
+@functools.cache
+def load_phonemes_nodes() -> set[str] | None:
+    """
+    All sources and targets of PHONEMES_PKN_KSN
+    """
+    artifact = load_artifact('phonemes_pkn_ksn')
+    if artifact is None:
+        return None
+    return set(artifact['nodes'].tolist())
+
+
+@functools.cache
+def load_motif_odds() -> dict[tuple[str, int, str], float] | None:
+    artifact = load_artifact('motif_odds')
+    if artifact is None:
+        return None
+    kinases = artifact['kinases'][artifact['kinase']].tolist()
+    return dict(zip(zip(kinases, artifact['position'].tolist(), artifact['aa'].tolist()),
+                    artifact['odds'].tolist()))
+
+
+@functools.cache
+def load_motif_quantiles() -> dict[str, tuple[pd.Index, np.ndarray]] | None:
+    artifact = load_artifact('motif_quantiles')
+    if artifact is None:
+        return None
+    scores = pd.Index(artifact['scores'], name='Score')
+    return {kinase: (scores, artifact['quantiles'][:, i]) for i, kinase in enumerate(artifact['kinases'].tolist())}
+
+
+def load_gmt(gmt_file: Path) -> dict[str, np.ndarray] | None:
+    """
+    Signature sets of a GMT file: names, descriptions, and the members of set i are
+    genes[members[offsets[i]:offsets[i + 1]]]
+    """
+    return load_artifact(f'gmt_{Path(gmt_file).stem}')
+
+
+if __name__ == '__main__':
+    compile_all(Path(sys.argv[1]) if len(sys.argv) > 1 else REFERENCE_DB_DIR)
@@ -0,0 +1,94 @@
+import os
+import json
+import pickle
+import hashlib
+import functools
+import threading
+import importlib.metadata
+from pathlib import Path
+import pandas as pd
+
+from modules.cache_eviction import cache_eviction
+
+# Per-experiment results are kept across requests, so a resubmitted dataset only computes new or changed experiments
+RESULT_CACHE_DIR = Path(os.getenv('RESULT_CACHE_DIR', '../cache/results'))
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE', '1') == '1'
+RESULT_CACHE_MAX_MB = float(os.getenv('RESULT_CACHE_MAX_MB', '4096'))
+RESULT_CACHE_MAX_AGE_DAYS = float(os.getenv('RESULT_CACHE_MAX_AGE_DAYS', '30'))
+# The results (and the pickles) depend on these, an upgrade must not reuse the results of the old versions
+KEY_LIBRARIES = ['numpy', 'pandas', 'scipy', 'kinact', 'psite_annotation']
+
+
+@functools.cache
+def get_reference_fingerprint(path: Path) -> str:
+    # The reference data only changes with a new deployment, size and modification time are enough to notice it
+    stat = Path(path).stat()
+    return f'{Path(path).name}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+@functools.cache
+def get_library_versions() -> str:
+    versions = {}
+    for library in KEY_LIBRARIES:
+        try:
+            versions[library] = importlib.metadata.version(library)
+        except importlib.metadata.PackageNotFoundError:
+            versions[library] = None
+    return json.dumps(versions, sort_keys=True)
+
+
+def hash_values(values: pd.Series | pd.DataFrame) -> str:
+    # Index and values, but not the name, so a renamed experiment still hits the cache
+    return hashlib.sha256(pd.util.hash_pandas_object(values, index=True).values.tobytes()).hexdigest()
+
+
+def get_key(method: str, values: pd.Series | pd.DataFrame | str, references: list[Path] = (), **params) -> str:
+    """
+    Key of one experiment: Its values, the method parameters, the reference files the method reads and the versions
+    of the libraries that compute it
+    """
+    key = hashlib.sha256(method.encode())
+    key.update(get_library_versions().encode())
+    key.update(values.encode() if isinstance(values, str) else hash_values(values).encode())
+    key.update(json.dumps(params, sort_keys=True, default=str).encode())
+    for reference in references:
+        key.update(get_reference_fingerprint(reference).encode())
+    return key.hexdigest()
+
+
+def get_path(method: str, key: str) -> Path:
+    return RESULT_CACHE_DIR / method / key[:2] / f'{key}.pkl'
+
+
+def load(method: str, key: str):
+    """
+    The cached object, or None if there is none
+    """
+    if not RESULT_CACHE_ENABLED:
+        return None
+    path = get_path(method, key)
+    try:
+        with open(path, 'rb') as infile:
+            cached = pickle.load(infile)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # A truncated or otherwise unreadable entry is computed again and overwritten
+        print(f'Ignoring the unreadable cache entry {path}: {e!r}')
+        return None
+    cache_eviction.touch(path)
+    return cached
+
+
+def store(method: str, key: str, result):
+    if not RESULT_CACHE_ENABLED:
+        return
+    path = get_path(method, key)
+    Path.mkdir(path.parent, parents=True, exist_ok=True)
+    # Write to a temporary file first, other workers might read the same entry
+    tmp_path = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(tmp_path, 'wb') as outfile:
+        pickle.dump(result, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    # Emptied directories are kept, removing them could race with the mkdir of another worker
+    cache_eviction.schedule(RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB, RESULT_CACHE_MAX_AGE_DAYS)
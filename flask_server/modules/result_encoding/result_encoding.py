@@ -0,0 +1,146 @@
+"""
+Encodings of the analysis results, negotiated through the Accept header. The default is the record-oriented JSON
+([{"Score (Experiment01)": ..., "adj p-val (Experiment01)": ...}, ...]), which repeats every column name in every row.
+The alternatives are encoded straight from the result DataFrames and carry the column names once:
+- application/vnd.enrichment-server.split+json: {"schema": {"fields": [...]}, "data": [[row values], ...]}, the schema
+  is a Table Schema as in DataFrame.to_json(orient='table')
+- application/vnd.apache.arrow.stream: One Arrow IPC stream. Results with several tables (e.g. KSTAR) are
+  concatenated, the column Result names the table. The Log is stored in the schema metadata.
+- application/msgpack: {"schema": {"fields": [...]}, "columns": [[column values], ...]}, only if msgpack is installed
+A module hands its result to keep_result instead of writing the JSON file, unless the client asked for JSON.
+"""
+import json
+import contextvars
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import werkzeug.datastructures
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+RECORDS = 'application/json'
+SPLIT_JSON = 'application/vnd.enrichment-server.split+json'
+ARROW = 'application/vnd.apache.arrow.stream'
+MSGPACK = 'application/msgpack'
+SUFFIXES = {SPLIT_JSON: '.split.json', ARROW: '.arrow', MSGPACK: '.msgpack'}
+# Names the table of each row if a result with several tables is encoded as one Arrow table
+RESULT_COLUMN = 'Result'
+
+# A DataFrame, or a dict of results (e.g. one table per phospho type or per experiment)
+Result = pd.DataFrame | dict[str, 'Result']
+
+REQUEST_ENCODING = contextvars.ContextVar('request_encoding', default=RECORDS)
+KEPT_RESULTS = contextvars.ContextVar('kept_results', default=None)
+
+
+def get_encodings() -> list[str]:
+    return [RECORDS, SPLIT_JSON, ARROW] + ([MSGPACK] if msgpack is not None else [])
+
+
+def negotiate(accept: werkzeug.datastructures.MIMEAccept) -> str:
+    """
+    Chooses the encoding of the current request. JSON comes first, so */* and requests without Accept get JSON.
+    """
+    encoding = accept.best_match(get_encodings(), default=RECORDS)
+    REQUEST_ENCODING.set(encoding)
+    KEPT_RESULTS.set({})
+    return encoding
+
+
+def reset():
+    REQUEST_ENCODING.set(RECORDS)
+    KEPT_RESULTS.set(None)
+
+
+def keep_result(output_path: Path, result: Result) -> bool:
+    """
+    Keeps the result for encode_result if the request negotiated another encoding than JSON.
+    Returns False if the module has to write the JSON to output_path as usual.
+    """
+    kept_results = KEPT_RESULTS.get()
+    if REQUEST_ENCODING.get() == RECORDS or kept_results is None:
+        return False
+    kept_results[output_path] = result
+    return True
+
+
+def iter_tables(result: Result, path: tuple[str, ...] = ()):
+    if isinstance(result, pd.DataFrame):
+        yield path, result
+    else:
+        for key, value in result.items():
+            yield from iter_tables(value, path + (str(key),))
+
+
+def get_schema(df: pd.DataFrame) -> dict:
+    return pd.io.json.build_table_schema(df, index=False, version=False)
+
+
+def to_records_json(result: Result) -> str:
+    # The default encoding, e.g. for the batch routes whose result is a dict of tables, one per dataset
+    if isinstance(result, pd.DataFrame):
+        return result.to_json(orient='records')
+    return '{' + ','.join(f'{json.dumps(str(key))}:{to_records_json(value)}' for key, value in result.items()) + '}'
+
+
+def to_split_json(result: Result) -> str:
+    if isinstance(result, pd.DataFrame):
+        # The rows are written by pandas, like the records, only without the column names
+        return f'{{"schema":{json.dumps(get_schema(result))},"data":{result.to_json(orient="values")}}}'
+    return '{' + ','.join(f'{json.dumps(str(key))}:{to_split_json(value)}' for key, value in result.items()) + '}'
+
+
+def to_msgpack_object(result: Result | list):
+    if isinstance(result, pd.DataFrame):
+        return {'schema': get_schema(result),
+                'columns': [result.iloc[:, position].tolist() for position in range(result.shape[1])]}
+    if isinstance(result, dict):
+        return {str(key): to_msgpack_object(value) for key, value in result.items()}
+    # Results that only exist as JSON, e.g. the pathway skeletons of PHONEMeS
+    return result
+
+
+def to_arrow_table(result: Result, log: dict) -> pa.Table:
+    if isinstance(result, pd.DataFrame):
+        df = result
+    else:
+        # Empty tables would turn the integer columns of the others into floats
+        tables = {'/'.join(path): df for path, df in iter_tables(result) if len(df) > 0}
+        df = pd.concat(tables, names=[RESULT_COLUMN]).reset_index(level=0).reset_index(drop=True) \
+            if len(tables) > 0 else pd.DataFrame({RESULT_COLUMN: []})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), b'Log': json.dumps(log).encode()})
+
+
+def encode_result(result_path: Path, log: dict) -> tuple[Path, str] | None:
+    """
+    Writes the result of result_path in the negotiated encoding next to it. Returns the path and the media type,
+    or None if the result is sent as JSON: If JSON was negotiated, or the result is not tabular (only msgpack can
+    encode any JSON).
+    """
+    encoding = REQUEST_ENCODING.get()
+    kept_results = KEPT_RESULTS.get() or {}
+    if encoding == RECORDS:
+        return None
+    if result_path in kept_results:
+        result = kept_results.pop(result_path)
+    elif encoding == MSGPACK:
+        result = json.load(open(result_path))
+    else:
+        return None
+
+    output_path = result_path.with_suffix(SUFFIXES[encoding])
+    if encoding == SPLIT_JSON:
+        with open(output_path, 'w') as outfile:
+            outfile.write(f'{{"Log":{json.dumps(log)},"Result":{to_split_json(result)}}}')
+    elif encoding == ARROW:
+        table = to_arrow_table(result, log)
+        with pa.OSFile(str(output_path), 'wb') as sink, pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        with open(output_path, 'wb') as outfile:
+            msgpack.pack({'Log': log, 'Result': to_msgpack_object(result)}, outfile, use_bin_type=True)
+    return output_path, encoding
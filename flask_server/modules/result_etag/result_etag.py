@@ -0,0 +1,45 @@
+"""
+Strong ETags of analysis results. The result of a route only depends on the input file, the form fields that
+parameterize the analysis, the server settings that change results, the reference data, the server version and the
+negotiated result encoding, so the ETag is a hash of those and is known before the analysis runs. A client that sends
+it back in If-None-Match gets 304 without the analysis being run again.
+"""
+import os
+import hashlib
+import functools
+from pathlib import Path
+import werkzeug.datastructures
+
+from modules.file_hash import file_hash
+
+# Everything the analyses read besides the input, the size and modification time of each file is hashed
+REFERENCE_DIRS = [Path('../db'), Path('../ssGSEA2.0/db')]
+# Form fields that do not change the result
+IGNORED_FORM_FIELDS = {'session_id', 'dataset_name', 'async', 'profile'}
+# Environment variables that change results, an unset one is hashed as unset, its default comes with the version
+RESULT_SETTINGS = ['ROKAI_ENGINE', 'SSGSEA_PERMUTATIONS', 'SSGSEA_PREVIEW_PERMUTATIONS', 'SSGSEA_MIN_OVERLAP']
+
+
+@functools.cache
+def get_reference_fingerprint() -> str:
+    # The reference data only changes with a new deployment, so the files are listed once per worker
+    fingerprint = hashlib.sha256()
+    for reference_dir in REFERENCE_DIRS:
+        for root, dirs, files in sorted(os.walk(reference_dir)):
+            for name in sorted(files):
+                stat = (Path(root) / name).stat()
+                fingerprint.update(f'{Path(root) / name}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+    return fingerprint.hexdigest()
+
+
+def get_etag(version: str, route: str, form: werkzeug.datastructures.MultiDict, input_path: Path,
+             representation: str) -> str:
+    etag = hashlib.sha256()
+    etag.update(f'{version}\n{route}\n{representation}\n{get_reference_fingerprint()}\n'.encode())
+    for setting in RESULT_SETTINGS:
+        etag.update(f'{setting}={os.getenv(setting)}\n'.encode())
+    for key, value in sorted(form.items(multi=True)):
+        if key not in IGNORED_FORM_FIELDS:
+            etag.update(f'{key}={value}\n'.encode())
+    etag.update(file_hash.hash_file(input_path).encode())
+    return etag.hexdigest()[:32]
@@ -0,0 +1,105 @@
+from dataclasses import dataclass
+import pandas as pd
+
+# Columns with the ids of the matched sites/genes, by far the largest part of the ssGSEA and KSEA results
+OVERLAP_FIELD = 'Overlap'
+TRUE_VALUES = ('1', 'true')
+
+
+@dataclass(frozen=True)
+class ResultFilter:
+    """
+    Optional result controls of a request (see parse_filter). Applied to the result table right before it is
+    serialized, so filtered rows and columns are never written.
+    Results are wide, one '<field> (<experiment>)' column per field and experiment. A row is kept if it passes
+    in at least one experiment.
+    """
+    max_pvalue: float = None
+    top_k: int = None
+    columns: tuple[str] = None
+    drop_overlap: bool = False
+
+    def is_empty(self) -> bool:
+        return self.max_pvalue is None and self.top_k is None and self.columns is None and not self.drop_overlap
+
+    def apply(self, result_df: pd.DataFrame, id_column: str, score_field: str = None, pvalue_field: str = None,
+              neg_log_pvalues: bool = False) -> pd.DataFrame:
+        """
+        score_field, pvalue_field: Fields of the score and of the (adjusted) p-value. Without them, each column
+        except the id column is one experiment with a signed -log10 p-value (KSTAR).
+        neg_log_pvalues: The p-value field holds -log10 p-values.
+        """
+        if self.is_empty() or len(result_df) == 0:
+            return result_df
+
+        columns = [column for column in result_df if self.includes(column, id_column)]
+        if self.max_pvalue is None and self.top_k is None:
+            return result_df[columns]
+
+        experiments = get_experiments(result_df, id_column, score_field)
+        # Rows x experiments, whether a row passes in an experiment
+        passing = pd.DataFrame(True, index=result_df.index, columns=experiments)
+        if self.max_pvalue is not None:
+            p_values = result_df[[get_column(pvalue_field, experiment) for experiment in experiments]]
+            p_values = p_values.set_axis(experiments, axis=1).astype('float64')
+            if neg_log_pvalues:
+                p_values = 10 ** -p_values.abs()
+            passing &= p_values <= self.max_pvalue
+        if self.top_k is not None:
+            # Ranked among the rows that pass the cutoff in the same experiment
+            scores = result_df[[get_column(score_field, experiment) for experiment in experiments]]
+            scores = scores.set_axis(experiments, axis=1).astype('float64').abs().where(passing)
+            passing &= scores.rank(ascending=False, method='first') <= self.top_k
+        return result_df.loc[passing.any(axis=1), columns]
+
+    def includes(self, column: str, id_column: str) -> bool:
+        if column == id_column:
+            return True
+        field = get_field(column)
+        if self.drop_overlap and field == OVERLAP_FIELD:
+            return False
+        return self.columns is None or column in self.columns or field in self.columns
+
+
+def get_field(column: str) -> str:
+    # 'adj p-val (Experiment01)' -> 'adj p-val'
+    if column.endswith(')') and ' (' in column:
+        return column.rsplit(' (', 1)[0]
+    return column
+
+
+def get_column(field: str | None, experiment: str) -> str:
+    return experiment if field is None else f'{field} ({experiment})'
+
+
+def get_experiments(result_df: pd.DataFrame, id_column: str, score_field: str | None) -> list[str]:
+    if score_field is None:
+        return [column for column in result_df if column != id_column]
+    prefix = f'{score_field} ('
+    return [column[len(prefix):-1] for column in result_df if column.startswith(prefix) and column.endswith(')')]
+
+
+def parse_filter(form: dict) -> ResultFilter:
+    """
+    Result controls from the form fields max_pvalue (cutoff for the adjusted p-value, or for the p-value of methods
+    without FDR), top_k (best rows by absolute score per experiment), columns (comma-separated fields or column names)
+    and drop_overlap (1 or true). Raises ValueError for invalid values.
+    """
+    controls = {'drop_overlap': form.get('drop_overlap', '').lower() in TRUE_VALUES}
+    if form.get('max_pvalue'):
+        try:
+            controls['max_pvalue'] = float(form['max_pvalue'])
+        except ValueError:
+            raise ValueError(f"Invalid 'max_pvalue': {form['max_pvalue']}")
+        if not 0 < controls['max_pvalue'] <= 1:
+            raise ValueError("Invalid 'max_pvalue'. It has to be in (0, 1]")
+    if form.get('top_k'):
+        try:
+            controls['top_k'] = int(form['top_k'])
+        except ValueError:
+            raise ValueError(f"Invalid 'top_k': {form['top_k']}")
+        if controls['top_k'] < 1:
+            raise ValueError("Invalid 'top_k'. It has to be at least 1")
+    if form.get('columns'):
+        controls['columns'] = tuple(column.strip() for column in form['columns'].split(',') if column.strip())
+    return ResultFilter(**controls)
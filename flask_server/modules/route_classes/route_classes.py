@@ -0,0 +1,104 @@
+import os
+import time
+import functools
+import threading
+
+# Routes are sorted into classes by how long they take. Each class has its own slots per gunicorn worker process,
+# so a few long PHONEMeS or KSTAR runs cannot block the routes that finish in seconds, and GET / is never limited.
+# <CLASS>_WORKERS: concurrently running requests, <CLASS>_QUEUE: requests that may wait for a slot.
+ROUTE_CLASS_DEFAULTS = {
+    'fast': (4, 4),  # KEA3, KSEA
+    'medium': (2, 2),  # ssGSEA, motif enrichment
+    'heavy': (1, 1),  # PHONEMeS, KSTAR
+}
+
+
+class RouteClass:
+    def __init__(self, name: str, workers: int, queue_limit: int):
+        self.name = name
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._slots = threading.BoundedSemaphore(workers)
+        self._lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.busy_seconds = 0.0
+
+    def try_enqueue(self) -> bool:
+        with self._lock:
+            if self.running + self.waiting >= self.workers + self.queue_limit:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            return True
+
+    def run(self, handler, *args, **kwargs):
+        start = time.perf_counter()
+        self._slots.acquire()
+        started = time.perf_counter()
+        with self._lock:
+            self.waiting -= 1
+            self.running += 1
+            self.wait_seconds += started - start
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                self.busy_seconds += time.perf_counter() - started
+            self._slots.release()
+
+    def metrics(self) -> dict[str, float]:
+        with self._lock:
+            return {'workers': self.workers,
+                    'queue_limit': self.queue_limit,
+                    'running': self.running,
+                    'waiting': self.waiting,
+                    'saturation': self.running / self.workers,
+                    'completed_total': self.completed,
+                    'rejected_total': self.rejected,
+                    'wait_seconds_total': round(self.wait_seconds, 3),
+                    'busy_seconds_total': round(self.busy_seconds, 3)}
+
+
+def create_route_classes() -> dict[str, RouteClass]:
+    route_classes = {}
+    for name, (workers, queue_limit) in ROUTE_CLASS_DEFAULTS.items():
+        route_classes[name] = RouteClass(name,
+                                         int(os.getenv(f'{name.upper()}_WORKERS', str(workers))),
+                                         int(os.getenv(f'{name.upper()}_QUEUE', str(queue_limit))))
+    return route_classes
+
+
+ROUTE_CLASSES = create_route_classes()
+
+
+def limited(route_class_name: str):
+    """
+    Decorator for request handlers: The handler runs in a slot of its route class.
+    If all slots are taken and the queue of the class is full, the request is rejected with 503 right away.
+    """
+    route_class = ROUTE_CLASSES[route_class_name]
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            if not route_class.try_enqueue():
+                print(f'Rejected request, all {route_class.name} slots and queue places are taken.')
+                return f'Error: The server is busy with {route_class.name} requests, please try again later.\n', \
+                    503, {'Retry-After': '30'}
+            return route_class.run(handler, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_prometheus_metrics() -> str:
+    lines = []
+    for name, route_class in ROUTE_CLASSES.items():
+        for metric, value in route_class.metrics().items():
+            lines.append(f'enrichment_server_route_class_{metric}{{route_class="{name}",pid="{os.getpid()}"}} {value}')
+    return '\n'.join(lines) + '\n'
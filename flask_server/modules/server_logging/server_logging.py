@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+import contextvars
+import subprocess
+from pathlib import Path
+from werkzeug.utils import secure_filename
+
+# Every process writes its own file, '<stem>.<pid><suffix>': gunicorn workers cannot share a rotated file, each of them
+# would rotate it on its own
+LOG_FILE = Path(os.getenv('LOG_FILE', 'enrichment_server_logfile.log'))
+# The log file is rotated when it reaches LOG_MAX_BYTES, LOG_BACKUP_COUNT old files are kept
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+# Records that do not fit into the queue are dropped instead of blocking the request
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Only the first and last lines of the output of a subprocess are logged
+SUBPROCESS_LOG_HEAD_LINES = int(os.getenv('SUBPROCESS_LOG_HEAD_LINES', '20'))
+SUBPROCESS_LOG_TAIL_LINES = int(os.getenv('SUBPROCESS_LOG_TAIL_LINES', '20'))
+# The full output of failed subprocesses is kept here
+SUBPROCESS_LOG_DIR = Path(os.getenv('SUBPROCESS_LOG_DIR', 'job_logs'))
+
+# Set by the server for each request. Threads started during a request need to copy the context.
+REQUEST_CONTEXT = contextvars.ContextVar('request_context', default={})
+
+
+def reset_request_context():
+    # The threads of a threaded worker serve one request after the other, the ids must not leak into the next request
+    REQUEST_CONTEXT.set({})
+
+
+def get_log_file(pid: int = None) -> Path:
+    if str(LOG_FILE) == os.devnull:
+        return LOG_FILE
+    return LOG_FILE.with_name(f'{LOG_FILE.stem}.{pid or os.getpid()}{LOG_FILE.suffix}')
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Attaches the ids of the current request to each record. It runs in the thread that logs,
+    before the record is handed to the writer thread.
+    """
+
+    def filter(self, record):
+        for key, value in REQUEST_CONTEXT.get().items():
+            setattr(record, key, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    CONTEXT_FIELDS = ['request_id', 'session_id', 'dataset_name', 'method']
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'message': record.getMessage()}
+        for field in self.CONTEXT_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    dropped_records = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block or raise in the request, the writer thread is behind
+            DroppingQueueHandler.dropped_records += 1
+
+
+class LoggerWriter:
+    """
+    Replaces sys.stdout and sys.stderr, so print statements end up in the logger
+    """
+
+    def __init__(self, level):
+        self.level = level
+
+    def write(self, message):
+        if message.strip():  # Avoid logging empty messages
+            self.level(message)
+
+    def flush(self):
+        pass  # No-op for compatibility with sys.stdout/err
+
+    def isatty(self):
+        # Progress bars (tqdm) disable themselves if the output is not a terminal
+        return False
+
+
+def setup_logging(logger: logging.Logger) -> logging.handlers.QueueListener:
+    """
+    Logging is split in two: The logger only puts records into a queue, a background thread
+    formats them and writes them to the rotated JSON log file of the process and to the console.
+    """
+    file_handler = logging.handlers.RotatingFileHandler(get_log_file(), maxBytes=LOG_MAX_BYTES,
+                                                        backupCount=LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonFormatter())
+    # Write to the original stream, sys.stderr is replaced by a LoggerWriter below
+    console_handler = logging.StreamHandler(sys.__stderr__)
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    # Flush the remaining records when the worker exits
+    atexit.register(listener.stop)
+
+    sys.stdout = LoggerWriter(logger.info)
+    sys.stderr = LoggerWriter(logger.error)
+    return listener
+
+
+def cap_output(output: str) -> str:
+    lines = output.splitlines()
+    if len(lines) <= SUBPROCESS_LOG_HEAD_LINES + SUBPROCESS_LOG_TAIL_LINES:
+        return output
+    omitted = len(lines) - SUBPROCESS_LOG_HEAD_LINES - SUBPROCESS_LOG_TAIL_LINES
+    return '\n'.join(lines[:SUBPROCESS_LOG_HEAD_LINES]
+                     + [f'[... {omitted} lines omitted ...]']
+                     + lines[len(lines) - SUBPROCESS_LOG_TAIL_LINES:])
+
+
+def log_subprocess_output(subprocess_output: subprocess.CompletedProcess, name: str):
+    """
+    Print the head and tail of stdout and stderr of a finished subprocess.
+    If it failed, the full output is written to a file in SUBPROCESS_LOG_DIR.
+    """
+    print(cap_output(subprocess_output.stdout))
+    print(cap_output(subprocess_output.stderr))
+    if subprocess_output.returncode != 0:
+        request_id = REQUEST_CONTEXT.get().get('request_id', 'no_request')
+        Path.mkdir(SUBPROCESS_LOG_DIR, parents=True, exist_ok=True)
+        spill_file = SUBPROCESS_LOG_DIR / secure_filename(f'{request_id}_{name}.log')
+        with open(spill_file, 'w') as outfile:
+            outfile.write(f'$ {" ".join(str(arg) for arg in subprocess_output.args)}\n')
+            outfile.write(f'Exit code: {subprocess_output.returncode}\n\n=== stdout ===\n')
+            outfile.write(subprocess_output.stdout)
+            outfile.write('\n=== stderr ===\n')
+            outfile.write(subprocess_output.stderr)
+        print(f'{name} failed with exit code {subprocess_output.returncode}, full output in {spill_file}')
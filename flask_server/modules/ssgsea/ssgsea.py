@@ -1,49 +1,43 @@
-import subprocess
+import os
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import json
+import numpy as np
 import pandas as pd
-from cmapPy.pandasGEXpress import parse_gct
-
-R_SPECIAL_CHARACTERS_MAPPING = str.maketrans({elem: '.' for elem in [
-    " ",  # Space
-    "+",  # Plus
-    "-",  # Minus
-    "*",  # Multiplication
-    "/",  # Division
-    "^",  # Exponentiation
-    "#",  # Pound sign
-    "%",  # Percentage
-    "&",  # Ampersand
-    "!",  # Exclamation mark
-    "?",  # Question mark
-    ",",  # Comma
-    ".",  # Period (when at the start of a name)
-    ";",  # Semicolon
-    ":",  # Colon
-    "@",  # At sign
-    "~",  # Tilde
-    "\\",  # Backslash
-    '"',  # Double quotation mark
-    "'",  # Single quotation mark
-    "(",  # Left parenthesis
-    ")",  # Right parenthesis
-    "<",  # Left angle bracket
-    ">",  # Right angle bracket
-    "{",  # Left curly bracket
-    "}",  # Right curly bracket
-    "[",  # Left square bracket
-    "]",  # Right square bracket
-    "$",  # Dollar sign
-    "=",  # Equal sign
-    "|",  # Pipe
-    "`"  # Backtick
-]})
+from statsmodels.stats.multitest import multipletests
+
+from modules.json_records import json_records
+from modules.gct import gct
+from modules.server_logging import server_logging
+from modules.job_budget import job_budget
+from modules.reference_db import reference_db
+from modules.result_filter import result_filter
+from modules.result_encoding import result_encoding
+
+# 'auto' picks the number of column shards from SSGSEA_CORE_BUDGET and the number of experiments,
+# an integer is the maximal number of shards (1 disables sharding).
+SSGSEA_SHARDS = os.getenv('SSGSEA_SHARDS', 'auto')
+SSGSEA_CORE_BUDGET = int(os.getenv('SSGSEA_CORE_BUDGET', os.cpu_count() or 1))
+# Every ssgsea-cli.R process pays for R startup and for loading the GMT file,
+# and single-column GCTs trip up ssGSEA2.0, so a shard gets at least this many experiments.
+MIN_COLUMNS_PER_SHARD = 2
+# Minimal overlap between a signature and the dataset (ssgsea-cli.R -m). Signatures below it are not scored by
+# ssGSEA2.0, SSGSEA_PREFILTER=1 already removes them from the GMT that is passed to R.
+SSGSEA_MIN_OVERLAP = int(os.getenv('SSGSEA_MIN_OVERLAP', '10'))
+SSGSEA_PREFILTER = os.getenv('SSGSEA_PREFILTER', '1') == '1'
+# PTMSigDB members carry the direction of regulation, the ids of the dataset do not
+DIRECTION_SUFFIXES = (';u', ';d')
+# Permutations for the p-values (ssgsea-cli.R -p). mode=preview uses fewer, its p-values are approximate and cannot
+# be smaller than 1 / SSGSEA_PREVIEW_PERMUTATIONS. Scores and overlaps do not depend on the permutations.
+SSGSEA_PERMUTATIONS = int(os.getenv('SSGSEA_PERMUTATIONS', '1000'))
+SSGSEA_PREVIEW_PERMUTATIONS = int(os.getenv('SSGSEA_PREVIEW_PERMUTATIONS', '100'))
+MODES = ['full', 'preview']
 
 
 def preprocess_ssgsea(filepath: Path, type_isnot_gcr) -> Path:
     output_dir = filepath.parent
-    input_json = json.load(open(filepath))
-    input_df = pd.DataFrame.from_dict(input_json)
+    input_df = json_records.read_records(filepath)
 
     idcolumn = 'Site' if 'Site' in input_df else 'id'
 
@@ -58,24 +52,71 @@ def preprocess_ssgsea(filepath: Path, type_isnot_gcr) -> Path:
         unique_values = [input_df_grouped[exp].apply(abs_max_signed) for exp in experiment_columns]
         input_df = pd.DataFrame(unique_values).T.reset_index()
 
-    # There is a method cmapPy.pandasGEXpress.write_gct,
-    # but I could not get it to run
-    # (it tries to use DataFrame.at[] with ranges and I couldn't find a pandas version where this works)
-    # So I wrote a minimal version myself
     input_gct_file = output_dir / 'ssgsea_input.gct'
-    with open(input_gct_file, 'w') as f:
-        # Write Version and dims
-        f.write("#1.3\n")
-        f.write(f"{input_df.shape[0]}\t{input_df.shape[1] - 1}\t0\t0\n")
-        # Write data df
-        input_df.to_csv(f, sep='\t', index=False)
-    return input_gct_file
+    return gct.write_gct(input_gct_file, input_df.set_index(idcolumn))
+
+
+def get_shard_count(n_experiments: int) -> int:
+    max_shards = SSGSEA_CORE_BUDGET if SSGSEA_SHARDS == 'auto' else int(SSGSEA_SHARDS)
+    return max(1, min(max_shards, n_experiments // MIN_COLUMNS_PER_SHARD))
+
+
+def split_columns(experiment_columns: list, n_shards: int) -> list[list]:
+    """
+    Splits the columns into n_shards shards of consecutive columns, whose sizes differ by at most one.
+    With n_shards from get_shard_count, every shard has at least MIN_COLUMNS_PER_SHARD columns.
+    """
+    return [list(shard) for shard in np.array_split(np.array(experiment_columns, dtype=object), n_shards)]
+
+
+def parse_mode(form: dict) -> str:
+    mode = form.get('mode', 'full')
+    if mode not in MODES:
+        raise ValueError(f"Invalid 'mode'. Allowed values are {', '.join(MODES)}")
+    return mode
 
 
-def run_ssgsea(filepath: Path, ssgsea_type, ssc_input_type) -> Path:
+def get_permutations(mode: str) -> int:
+    return SSGSEA_PREVIEW_PERMUTATIONS if mode == 'preview' else SSGSEA_PERMUTATIONS
+
+
+def run_ssgsea(filepath: Path, ssgsea_type, ssc_input_type, mode: str = 'full') -> Path:
     output_dir = filepath.parent
+    permutations = get_permutations(mode)
     output_prefix = output_dir / f'ssgsea_{ssgsea_type}_out'
+    database = get_database(ssgsea_type, ssc_input_type)
+
+    input_df = gct.read_gct(filepath).data_df
+    if SSGSEA_PREFILTER:
+        database = prefilter_database(input_df, database, output_dir / 'ssgsea_signatures.gmt')
+        if database is None:
+            # No signature reaches the minimal overlap, postprocess_ssgsea returns an empty result
+            return Path(str(output_prefix) + '-combined.gct')
+    experiment_columns = list(input_df.columns)
+    n_shards = get_shard_count(len(experiment_columns))
+    if n_shards == 1:
+        return run_ssgsea_cli(filepath, output_prefix, database, permutations)
+
+    # ssGSEA scores each experiment independently, so the columns can be split into shards that run concurrently.
+    # Consecutive columns stay together so that the merged output keeps the original order.
+    shard_outputs = []
+    for shard, shard_columns in enumerate(split_columns(experiment_columns, n_shards)):
+        shard_gct_file = output_dir / f'ssgsea_input_shard{shard}.gct'
+        gct.write_gct(shard_gct_file, input_df[shard_columns])
+        shard_outputs.append((shard_gct_file, output_dir / f'ssgsea_{ssgsea_type}_out_shard{shard}'))
+
+    # Each shard gets a copy of the request context, so its log records carry the request ids.
+    # The shards run at the same time, so they share the memory budget of the job.
+    contexts = [contextvars.copy_context() for _ in shard_outputs]
+    with ThreadPoolExecutor(max_workers=len(shard_outputs)) as executor:
+        shard_combined_gcts = list(executor.map(
+            lambda context, shard: context.run(run_ssgsea_cli, *shard, database, permutations, len(shard_outputs)),
+            contexts, shard_outputs))
+
+    return merge_combined_gcts(shard_combined_gcts, Path(str(output_prefix) + '-combined.gct'))
+
 
+def get_database(ssgsea_type, ssc_input_type) -> str:
     match ssgsea_type:
         case 'ssc':
             if ssc_input_type == 'flanking':
@@ -84,35 +125,129 @@ def run_ssgsea(filepath: Path, ssgsea_type, ssc_input_type) -> Path:
                 database = "../ssGSEA2.0/db/ptmsigdb/ptm.sig.db.all.uniprot.human.v2.0.0.gmt"
         case 'gc' | 'gcr':
             database = "../db/c2.cp.kegg+wp.v2023.2.Hs.symbols.gmt"
+    return database
 
-    subprocess_output = subprocess.run(["Rscript",
+
+@functools.cache
+def load_signature_index(database: str) -> dict[str, np.ndarray]:
+    """
+    Signature sets of a GMT file (see reference_db.load_gmt), parsed once per process if it was not compiled.
+    'keys' are the members without direction suffix, as they appear in the dataset.
+    """
+    signatures = reference_db.load_gmt(Path(database))
+    if signatures is None:
+        signatures = reference_db.compile_gmt(Path(database))
+    keys = np.array([gene.removesuffix(DIRECTION_SUFFIXES[0]).removesuffix(DIRECTION_SUFFIXES[1])
+                     for gene in signatures['genes'].tolist()], dtype=object)
+    return signatures | {'keys': keys}
+
+
+def get_signature_overlaps(ids: pd.Index, signatures: dict[str, np.ndarray]) -> np.ndarray:
+    # Members are indices into the unique genes, so the lookup happens once per gene and not per member
+    member_hits = pd.Index(signatures['keys']).isin(ids)[signatures['members']]
+    cumulative_hits = np.concatenate([[0], np.cumsum(member_hits)])
+    return cumulative_hits[signatures['offsets'][1:]] - cumulative_hits[signatures['offsets'][:-1]]
+
+
+def prefilter_database(input_df: pd.DataFrame, database: str, output_gmt: Path) -> str | None:
+    """
+    Writes the signatures that reach SSGSEA_MIN_OVERLAP with the ids of the dataset to output_gmt,
+    returns None if there are none.
+    The overlap is counted over the ids with a value in any experiment, which is at least the overlap ssGSEA2.0 counts
+    per experiment. So every signature ssGSEA2.0 would score is kept, unchanged, and the removed ones would have been
+    left out of the result (and the FDR correction) anyway.
+    """
+    signatures = load_signature_index(database)
+    overlaps = get_signature_overlaps(input_df.index[input_df.notna().any(axis=1)], signatures)
+    retained = np.flatnonzero(overlaps >= SSGSEA_MIN_OVERLAP)
+    print(f'ssGSEA prefilter: {len(retained)} of {len(overlaps)} signatures in {Path(database).name} have an '
+          f'overlap of at least {SSGSEA_MIN_OVERLAP}.')
+    if len(retained) == 0:
+        return None
+
+    offsets = signatures['offsets']
+    with open(output_gmt, 'w') as outfile:
+        for i in retained:
+            members = signatures['genes'][signatures['members'][offsets[i]:offsets[i + 1]]]
+            outfile.write('\t'.join([signatures['names'][i], signatures['descriptions'][i], *members]) + '\n')
+    # Same form as the input file path passed to ssgsea-cli.R
+    return str(Path('..') / 'flask_server' / output_gmt)
+
+
+def run_ssgsea_cli(filepath: Path, output_prefix: Path, database: str, permutations: int = SSGSEA_PERMUTATIONS,
+                   memory_shares: int = 1) -> Path:
+    subprocess_output = job_budget.run(["Rscript",
                              "../ssGSEA2.0/ssgsea-cli.R",
                              "-i", str(Path('..') / 'flask_server' / filepath),
                              "-o", str(output_prefix),
                              "-d", database,
                              "-w", "0.75",
+                             "-m", str(SSGSEA_MIN_OVERLAP),
+                             "-p", str(permutations),
                              "-e", "FALSE",
                              ],
-                            capture_output=True, text=True)
-    print(subprocess_output.stdout)
-    print(subprocess_output.stderr)
+                            capture_output=True, text=True, memory_shares=memory_shares)
+    server_logging.log_subprocess_output(subprocess_output, f'ssgsea_cli_{output_prefix.name}')
     return Path(str(output_prefix) + '-combined.gct')
 
 
-def postprocess_ssgsea(output_gct: Path) -> Path:
+def merge_combined_gcts(shard_combined_gcts: list[Path], merged_gct: Path) -> Path:
+    shards = [gct.read_gct(shard_gct) for shard_gct in shard_combined_gcts if shard_gct.exists()]
+    if len(shards) == 0:
+        # No shard produced an output, let postprocess_ssgsea handle it like an unsharded run without output
+        return merged_gct
+
+    data_df = pd.concat([shard.data_df for shard in shards], axis=1)
+    col_metadata_df = pd.concat([shard.col_metadata_df for shard in shards], axis=0)
+    row_metadata_dfs = [shard.row_metadata_df for shard in shards]
+    row_metadata_all = pd.concat(row_metadata_dfs, axis=1)
+    # The names in the row metadata are sanitized by R
+    experiment_names = [gct.sanitize_r_name(name) for name in data_df.columns]
+
+    def per_experiment(field):
+        return [f'{field}.{exp}' for exp in experiment_names]
+
+    # Signatures that were only scored in some shards have no entry in the other shards
+    row_metadata_df = pd.DataFrame(index=data_df.index)
+    for field in ['Signature.set.description', 'Signature.set.size']:
+        row_metadata_df[field] = row_metadata_all[[field]].bfill(axis=1).iloc[:, 0]
+    row_metadata_df['Signature.set.size'] = row_metadata_df['Signature.set.size'].astype(int)
+    row_metadata_df = row_metadata_df.join(row_metadata_all[per_experiment('Signature.set.overlap.percent')
+                                                            + per_experiment('Signature.set.overlap')])
+    row_metadata_df['No.columns.scored'] = data_df.notna().sum(axis=1)
+    row_metadata_df = row_metadata_df.join(row_metadata_all[per_experiment('pvalue')])
+
+    # The FDR has to be recomputed over all signatures, a shard only knows the signatures it scored itself.
+    # Like ssGSEA2.0 (p.adjust with method 'fdr'), we apply Benjamini-Hochberg per experiment and skip NAs.
+    for exp in experiment_names:
+        p_values = row_metadata_df[f'pvalue.{exp}']
+        fdr = pd.Series(np.nan, index=p_values.index)
+        valid = p_values.notna()
+        if valid.any():
+            fdr[valid] = multipletests(p_values[valid], method='fdr_bh')[1]
+        row_metadata_df[f'fdr.pvalue.{exp}'] = fdr
+
+    return gct.write_gct(merged_gct, data_df, row_metadata_df, col_metadata_df)
+
+
+def postprocess_ssgsea(output_gct: Path,
+                       output_filter: result_filter.ResultFilter = result_filter.ResultFilter()) -> Path:
     output_json = output_gct.parent / f'{output_gct.stem}_result.json'
     if not output_gct.exists():
+        if result_encoding.keep_result(output_json, pd.DataFrame()):
+            return output_json
         with open(output_json, 'w') as o:
             o.write('[]')
     else:
-        gct_parsed = parse_gct.parse(output_gct)
-        experiment_names = gct_parsed.data_df.columns
+        experiment_names = gct.read_header(output_gct).data_columns
         # Sanitize experiment names - R turns several characters into dots
-        experiment_names = [name.translate(R_SPECIAL_CHARACTERS_MAPPING) for name in experiment_names]
-        gct_df_joined = gct_parsed.row_metadata_df[[f'Signature.set.overlap.percent.{exp}' for exp in experiment_names]
-                                                   + [f'fdr.pvalue.{exp}' for exp in experiment_names]
-                                                   + [f'Signature.set.overlap.{exp}' for exp in experiment_names]
-                                                   ].join(gct_parsed.data_df).reset_index()
+        experiment_names = [gct.sanitize_r_name(name) for name in experiment_names]
+        row_metadata_columns = ([f'Signature.set.overlap.percent.{exp}' for exp in experiment_names]
+                                + [f'fdr.pvalue.{exp}' for exp in experiment_names]
+                                + [f'Signature.set.overlap.{exp}' for exp in experiment_names])
+        # Only parse the metadata we need, e.g. the descriptions and raw p-values are skipped
+        gct_parsed = gct.read_gct(output_gct, row_metadata_columns=row_metadata_columns, read_col_metadata=False)
+        gct_df_joined = gct_parsed.row_metadata_df.join(gct_parsed.data_df).reset_index()
 
         gct_df_joined.columns = (['Signature ID']
                                  + [f'Percent Overlap ({exp})' for exp in experiment_names]
@@ -120,6 +255,9 @@ def postprocess_ssgsea(output_gct: Path) -> Path:
                                  + [f'Overlap ({exp})' for exp in experiment_names]
                                  + [f'Score ({exp})' for exp in experiment_names])
 
+        gct_df_joined = output_filter.apply(gct_df_joined, 'Signature ID', 'Score', 'adj p-val')
+        if result_encoding.keep_result(output_json, gct_df_joined):
+            return output_json
         gct_df_joined.to_json(path_or_buf=output_json, orient='records',
                               # indent=1  # For DEBUG
                               )
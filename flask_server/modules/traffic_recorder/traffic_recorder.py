@@ -0,0 +1,83 @@
+"""
+Opt-in recorder of the incoming analysis requests, one JSON object per line in TRAFFIC_LOG.
+Replay a recording against a local server with benchmarks/load_replay.py.
+Session ids and dataset names are only stored as hashes. The payload is only kept with TRAFFIC_RECORD_PAYLOAD=1.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+import werkzeug
+
+from modules.json_records import json_records
+from modules.file_hash import file_hash
+
+# Recording is off without a log file
+TRAFFIC_LOG = os.getenv('TRAFFIC_LOG', '')
+TRAFFIC_RECORD_PAYLOAD = os.getenv('TRAFFIC_RECORD_PAYLOAD', '0') == '1'
+TRAFFIC_PAYLOAD_DIR = Path(os.getenv('TRAFFIC_PAYLOAD_DIR', '../traffic/payloads'))
+# Form fields that identify the user or carry the input itself
+PRIVATE_FIELDS = ['session_id', 'dataset_name', 'data']
+
+_log_lock = threading.Lock()
+
+
+def anonymize(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()[:16]
+
+
+def get_input_dimensions(input_filepath: Path) -> dict[str, int]:
+    """
+    Rows and columns of a record-oriented input, experiments and largest gene set of a KEA3 input,
+    datasets and largest dataset of a cohort (see modules/uploads)
+    """
+    with open(input_filepath) as infile:
+        is_records = infile.read(json_records.READ_CHUNK_SIZE).lstrip(json_records.WHITESPACE)[:1] == '['
+    if not is_records:
+        gene_sets = json.load(open(input_filepath))
+        return {'rows': max((len(genes) for genes in gene_sets.values()), default=0), 'columns': len(gene_sets)}
+    rows, columns = 0, set()
+    for record in json_records.iter_records(input_filepath):
+        rows += 1
+        columns.update(record)
+    return {'rows': rows, 'columns': len(columns)}
+
+
+def record(post_request: werkzeug.Request, method: str, input_filepath: Path):
+    if not TRAFFIC_LOG:
+        return
+    try:
+        content_hash = file_hash.hash_file(input_filepath)
+        entry = {'timestamp': time.time(),
+                 'route': post_request.path,
+                 'method': method,
+                 'session': anonymize(post_request.form.get('session_id', '')),
+                 'dataset': anonymize(post_request.form.get('dataset_name', '')),
+                 'parameters': {key: value for key, value in post_request.form.items() if key not in PRIVATE_FIELDS},
+                 'input_bytes': input_filepath.stat().st_size,
+                 'content_sha256': content_hash,
+                 **get_input_dimensions(input_filepath)}
+        if TRAFFIC_RECORD_PAYLOAD:
+            payload = TRAFFIC_PAYLOAD_DIR / f'{content_hash}.json'
+            if not payload.exists():
+                Path.mkdir(TRAFFIC_PAYLOAD_DIR, parents=True, exist_ok=True)
+                tmp_payload = payload.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+                shutil.copyfile(input_filepath, tmp_payload)
+                os.replace(tmp_payload, payload)
+            entry['payload'] = str(payload)
+    except (OSError, ValueError, AttributeError) as error:
+        # The recorder must never fail a request, e.g. for an input that is not valid JSON
+        print(f'Traffic recorder skipped a {method} request: {error}')
+        return
+    # One write per line in append mode, so lines of concurrent workers do not interleave
+    line = (json.dumps(entry) + '\n').encode()
+    with _log_lock:
+        Path.mkdir(Path(TRAFFIC_LOG).parent, parents=True, exist_ok=True)
+        fd = os.open(TRAFFIC_LOG, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
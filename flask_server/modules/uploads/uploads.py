@@ -0,0 +1,107 @@
+"""
+Saves the input of a request. A single dataset comes as the file part 'file' or the form field 'data'.
+The batch routes (/batch/...) take a cohort of datasets: Several file parts 'dataset', an archive part 'archive'
+(.zip or .tar(.gz)) with one JSON file per dataset, or an already merged cohort file as 'file'.
+A cohort is saved as one JSON object {"<dataset name>": [records], ...}, so it passes through the job queue and
+the traffic recorder like any other input. The dataset name is the file name without the extension.
+"""
+import os
+import json
+import tarfile
+import zipfile
+from pathlib import Path, PurePosixPath
+import werkzeug
+
+COHORT_ROUTE_PREFIX = '/batch/'
+BATCH_MAX_DATASETS = int(os.getenv('BATCH_MAX_DATASETS', '1000'))
+# Bytes that are copied at once from an uploaded dataset into the cohort file
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def iter_archive(archive: werkzeug.datastructures.FileStorage):
+    """
+    Yields the name and a binary file object of every JSON file in a zip or tar archive
+    """
+    if zipfile.is_zipfile(archive.stream):
+        archive.stream.seek(0)
+        with zipfile.ZipFile(archive.stream) as zip_archive:
+            for member in zip_archive.infolist():
+                if not member.is_dir():
+                    with zip_archive.open(member) as member_file:
+                        yield member.filename, member_file
+        return
+    archive.stream.seek(0)
+    try:
+        with tarfile.open(fileobj=archive.stream, mode='r:*') as tar_archive:
+            for member in tar_archive:
+                if member.isfile():
+                    yield member.name, tar_archive.extractfile(member)
+    except tarfile.TarError:
+        raise ValueError(f'{archive.filename} is neither a zip nor a tar archive')
+
+
+def iter_uploaded_datasets(post_request: werkzeug.Request):
+    for dataset in post_request.files.getlist('dataset'):
+        if dataset.filename:
+            yield dataset.filename, dataset.stream
+    if 'archive' in post_request.files:
+        for name, member_file in iter_archive(post_request.files['archive']):
+            path = PurePosixPath(name)
+            # Hidden files and the resource forks that macOS adds to zip archives
+            if path.suffix == '.json' and not any(part.startswith(('.', '__MACOSX')) for part in path.parts):
+                yield name, member_file
+
+
+def save_cohort(post_request: werkzeug.Request, cohort_path: Path) -> int:
+    """
+    Writes the uploaded datasets into one cohort file, returns the number of datasets.
+    The datasets are copied as they are, they are parsed by the analysis.
+    """
+    names = set()
+    with open(cohort_path, 'wb') as outfile:
+        outfile.write(b'{')
+        for filename, infile in iter_uploaded_datasets(post_request):
+            name = PurePosixPath(filename).stem
+            if name in names:
+                raise ValueError(f'Dataset {name} occurs more than once')
+            if len(names) == BATCH_MAX_DATASETS:
+                raise ValueError(f'Too many datasets, at most {BATCH_MAX_DATASETS} are allowed per request')
+            outfile.write(f'{"," if names else ""}{json.dumps(name)}:'.encode())
+            for chunk in iter(lambda: infile.read(COPY_CHUNK_SIZE), b''):
+                outfile.write(chunk)
+            names.add(name)
+        outfile.write(b'}')
+    return len(names)
+
+
+def save_upload(post_request: werkzeug.Request, input_path: Path) -> bool:
+    """
+    Saves the input of the request to input_path, False if the request has none.
+    Raises ValueError for an invalid cohort.
+    """
+    if 'file' in post_request.files and post_request.files['file'].filename != '':
+        post_request.files['file'].save(input_path)
+        return True
+    if post_request.path.startswith(COHORT_ROUTE_PREFIX) and ('dataset' in post_request.files
+                                                             or 'archive' in post_request.files):
+        if save_cohort(post_request, input_path) == 0:
+            raise ValueError('The upload does not contain any JSON dataset')
+        return True
+    if 'data' in post_request.form:
+        with open(input_path, 'w') as o:
+            o.write(post_request.form['data'])
+        return True
+    return False
+
+
+def iter_cohort(cohort_path: Path):
+    """
+    Yields the name and the records of each dataset of a cohort file. The file is parsed one dataset after the other
+    (see json_records), so only the parsed datasets are in memory, not the parsed file.
+    """
+    # Imported here, json_records needs pandas, which is not imported at startup (see enrichment_server)
+    from modules.json_records import json_records
+    try:
+        yield from json_records.iter_named_records(cohort_path)
+    except ValueError as e:
+        raise ValueError(f'A cohort is a JSON object with a list of records per dataset ({e})')
@@ -0,0 +1,84 @@
+"""
+Scratch workspaces of the jobs. Every job gets its own directory below WORKSPACE_ROOT, so two identical submissions
+that run at the same time do not share (and delete) each other's input and intermediate files.
+Mount a tmpfs at WORKSPACE_ROOT to keep the intermediate GCT, CSV, SIF and CX files off the container's filesystem.
+A workspace is released after its request (see enrichment_server.py), the workspaces of crashed workers are reaped
+when the next worker starts. Its size counts against the disk budget of the job (see modules/job_budget).
+"""
+import os
+import re
+import uuid
+import shutil
+from pathlib import Path
+from werkzeug.utils import secure_filename
+
+WORKSPACE_ROOT = Path(os.getenv('WORKSPACE_ROOT', '../workspaces'))
+# Session id and dataset name are part of the directory name for debugging, cut to this length
+NAME_PART_LENGTH = 48
+# '<pid>.<process start time>_<job id>_...', only directories named like this are ever reaped
+WORKSPACE_NAME_PATTERN = re.compile(r'^(\d+)\.(\d+)_[0-9a-f]{12}_')
+
+
+def get_owner_token(pid: int) -> str | None:
+    """
+    '<pid>.<start time>' of a running process, None if there is none. The start time (in clock ticks since boot)
+    tells a process apart from a later one with the same pid.
+    """
+    try:
+        stat = Path(f'/proc/{pid}/stat').read_text()
+    except OSError:
+        return None
+    return f'{pid}.{stat.rsplit(")", 1)[1].split()[19]}'
+
+
+def create(session_id: str, dataset_name: str, route: str) -> Path:
+    name = '_'.join([get_owner_token(os.getpid()), uuid.uuid4().hex[:12],
+                     secure_filename(session_id)[:NAME_PART_LENGTH],
+                     secure_filename(dataset_name + route.replace('/', '_'))[:NAME_PART_LENGTH]])
+    workspace = WORKSPACE_ROOT / name
+    # Fails instead of sharing a directory with another job
+    Path.mkdir(workspace, parents=True)
+    return workspace
+
+
+def get_size(path: Path) -> int:
+    # Bytes of all files below path, files that are deleted while walking the tree are skipped
+    size = 0
+    for directory, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(directory, file)).st_size
+            except OSError:
+                continue
+    return size
+
+
+def release(workspace: Path | None) -> int:
+    """
+    Deletes the workspace, returns the bytes it held. Releasing a workspace twice is a no-op.
+    """
+    if workspace is None or not workspace.exists():
+        return 0
+    scratch_bytes = get_size(workspace)
+    shutil.rmtree(workspace, ignore_errors=True)
+    print(f'Workspace {workspace.name} released: {scratch_bytes} scratch bytes.')
+    return scratch_bytes
+
+
+def reap_orphans() -> list[Path]:
+    """
+    Deletes the workspaces whose worker process is gone, e.g. after it was killed during a job.
+    The workspaces of running workers are kept, so every worker can call this at startup.
+    """
+    if not WORKSPACE_ROOT.is_dir():
+        return []
+    orphans = []
+    for workspace in WORKSPACE_ROOT.iterdir():
+        match = WORKSPACE_NAME_PATTERN.match(workspace.name)
+        if match is None or get_owner_token(int(match.group(1))) == f'{match.group(1)}.{match.group(2)}':
+            continue
+        shutil.rmtree(workspace, ignore_errors=True)
+        orphans.append(workspace)
+    if orphans:
+        print(f'Reaped {len(orphans)} orphaned workspaces in {WORKSPACE_ROOT}.')
+    return orphans
@@ -0,0 +1,50 @@
+import os
+import time
+from modules.cache_eviction import cache_eviction
+
+
+def write_entry(path, size, age_days):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(bytes(size))
+    last_use = time.time() - age_days * 24 * 3600
+    os.utime(path, (last_use, last_use))
+    return path
+
+
+def test_old_entries_are_evicted(tmp_path):
+    old = write_entry(tmp_path / 'ab' / 'old.pkl', 10, age_days=40)
+    recent = write_entry(tmp_path / 'cd' / 'recent.pkl', 10, age_days=1)
+
+    assert cache_eviction.evict(tmp_path, max_mb=1, max_age_days=30) == 1
+    assert not old.exists() and recent.exists()
+
+
+def test_least_recently_used_entries_are_evicted_first(tmp_path):
+    mb = 1024 * 1024
+    entries = [write_entry(tmp_path / f'entry{i}.sif', mb, age_days=3 - i) for i in range(3)]
+    # Using the oldest entry makes it the most recent one
+    cache_eviction.touch(entries[0])
+
+    assert cache_eviction.evict(tmp_path, max_mb=2, max_age_days=30) == 1
+    assert [entry.exists() for entry in entries] == [True, False, True]
+
+
+def test_recent_temporary_files_are_kept(tmp_path):
+    writing = write_entry(tmp_path / 'entry.sif.123.tmp', 1024 * 1024, age_days=0)
+    abandoned = write_entry(tmp_path / 'entry.sif.456.tmp', 10, age_days=1)
+
+    cache_eviction.evict(tmp_path, max_mb=0, max_age_days=30)
+    assert writing.exists() and not abandoned.exists()
+
+
+def test_eviction_is_throttled(tmp_path, monkeypatch):
+    evicted = []
+    monkeypatch.setattr(cache_eviction, 'evict', lambda *args: evicted.append(args))
+    monkeypatch.setattr(cache_eviction, '_last_eviction', {})
+
+    cache_eviction.schedule(tmp_path, 1, 30)
+    cache_eviction.schedule(tmp_path, 1, 30)
+    deadline = time.monotonic() + 5
+    while not evicted and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(evicted) == 1
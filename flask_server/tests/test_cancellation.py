@@ -0,0 +1,105 @@
+import os
+import time
+import socket
+import subprocess
+import threading
+import pytest
+from modules.cancellation import cancellation
+from modules.job_budget import job_budget
+from modules.job_queue import job_queue
+
+
+@pytest.fixture
+def job_cancellation():
+    job_cancellation = cancellation.Cancellation()
+    token = cancellation.CURRENT_CANCELLATION.set(job_cancellation)
+    yield job_cancellation
+    cancellation.CURRENT_CANCELLATION.reset(token)
+
+
+def is_running(pid: int) -> bool:
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            # Zombies are dead, they only wait to be reaped
+            return stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def test_cancel_kills_the_process_tree(job_cancellation):
+    # The shell starts a grandchild and reports its pid
+    process = cancellation.popen(['sh', '-c', 'sleep 60 & echo $!; wait'], stdout=subprocess.PIPE,
+                                 text=True)
+    grandchild = int(process.stdout.readline())
+    assert os.getsid(process.pid) == os.getpgid(process.pid) == process.pid
+
+    job_cancellation.cancel(cancellation.DISCONNECT)
+    process.wait(timeout=5)
+    for _ in range(50):
+        if not is_running(grandchild):
+            break
+        time.sleep(0.1)
+
+    assert not is_running(grandchild)
+    assert job_cancellation.killed_processes == 1
+    with pytest.raises(cancellation.JobCancelled):
+        cancellation.check_cancelled()
+
+
+def test_budgeted_child_is_stopped_when_the_job_is_cancelled(job_cancellation):
+    threading.Timer(0.3, job_cancellation.cancel, args=(cancellation.CANCELLED,)).start()
+
+    @job_budget.budgeted('fast')
+    def handler():
+        return job_budget.run(['sleep', '30'])
+
+    start = time.perf_counter()
+    with pytest.raises(cancellation.JobCancelled):
+        handler()
+    assert time.perf_counter() - start < 5
+    assert job_cancellation.processes == []
+
+
+def test_closed_connection_is_detected():
+    server_side, client_side = socket.socketpair()
+    environ = {'werkzeug.socket': server_side}
+    try:
+        assert not cancellation.is_disconnected(environ)
+        client_side.close()
+        assert cancellation.is_disconnected(environ)
+    finally:
+        server_side.close()
+    assert not cancellation.is_disconnected({})
+
+
+def test_deleted_job_is_cancelled_on_its_worker(tmp_path):
+    queue = job_queue.SQLiteJobQueue(tmp_path, lease_seconds=0.3)
+    job_id = queue.submit('heavy', '/phonemes', [], {}, None)
+    started = threading.Event()
+
+    def execute(job: job_queue.Job) -> job_queue.JobResult:
+        started.set()
+        # Stands in for an analysis that checks between its experiments
+        while True:
+            cancellation.check_cancelled()
+            time.sleep(0.05)
+
+    worker = threading.Thread(target=job_queue.run_once, args=(queue, 'heavy', 'replica1', execute))
+    worker.start()
+    assert started.wait(5)
+    queue.delete(job_id)
+    worker.join(5)
+
+    assert not worker.is_alive()
+    assert queue.get(job_id) is None
+
+
+def test_cancelled_jobs_are_reported(job_cancellation):
+    cancellation.record('Test', cancellation.Cancellation(), 10)
+    job_cancellation.cancel(cancellation.DISCONNECT)
+    cancellation.record('Test', job_cancellation, 4)
+
+    metrics = cancellation.get_prometheus_metrics()
+    labels = f'method="Test",reason="disconnect",pid="{os.getpid()}"'
+    assert f'enrichment_server_cancelled_jobs{{{labels}}} 1' in metrics
+    assert f'enrichment_server_reclaimed_cpu_seconds{{{labels}}} 6.000' in metrics
@@ -0,0 +1,59 @@
+import gzip
+import pytest
+import werkzeug.wrappers
+from werkzeug.datastructures import Accept, MultiDict
+from werkzeug.http import parse_accept_header
+from modules.compression import compression
+from modules.result_etag import result_etag
+
+
+def accept_encodings(header: str) -> Accept:
+    return parse_accept_header(header, Accept)
+
+
+def test_streams_gzip_and_marks_the_etag():
+    body = b'[' + b','.join(b'{"Score (Experiment01)": %d}' % i for i in range(1000)) + b']'
+    chunks = [body[position:position + 8192] for position in range(0, len(body), 8192)]
+    response = werkzeug.wrappers.Response(iter(chunks), headers={'Content-Length': str(len(body))})
+    response.set_etag('abc')
+
+    response = compression.compress(response, accept_encodings('br;q=1.0, gzip;q=0.8'))
+
+    assert response.headers['Content-Encoding'] == 'gzip' and 'Content-Length' not in response.headers
+    assert response.get_etag() == ('abc-gzip', False) and 'Accept-Encoding' in response.vary
+    assert gzip.decompress(b''.join(response.response)) == body
+
+
+def test_small_and_unaccepted_responses_are_sent_as_they_are():
+    small = compression.compress(werkzeug.wrappers.Response('[]'), accept_encodings('gzip'))
+    identity = compression.compress(werkzeug.wrappers.Response('x' * 10000), accept_encodings('identity'))
+
+    assert 'Content-Encoding' not in small.headers and small.get_data() == b'[]'
+    assert 'Content-Encoding' not in identity.headers and len(identity.get_data()) == 10000
+
+
+def test_etag_depends_on_what_changes_the_result(tmp_path):
+    input_path = tmp_path / 'input.json'
+    input_path.write_text('[{"id": "AKT1", "Experiment01": 1.0}]')
+    form = MultiDict([('session_id', 'A'), ('dataset_name', 'first'), ('max_pvalue', '0.05')])
+    etag = result_etag.get_etag('0.1.3', '/ksea', form, input_path, 'application/json')
+
+    other_session = MultiDict([('session_id', 'B'), ('dataset_name', 'second'), ('max_pvalue', '0.05')])
+    assert result_etag.get_etag('0.1.3', '/ksea', other_session, input_path, 'application/json') == etag
+    other_filter = MultiDict([('session_id', 'A'), ('dataset_name', 'first'), ('max_pvalue', '0.01')])
+    assert result_etag.get_etag('0.1.3', '/ksea', other_filter, input_path, 'application/json') != etag
+    assert result_etag.get_etag('0.1.3', '/ksea/rokai', form, input_path, 'application/json') != etag
+    assert result_etag.get_etag('0.1.3', '/ksea', form, input_path, 'application/msgpack') != etag
+    input_path.write_text('[{"id": "AKT1", "Experiment01": 2.0}]')
+    assert result_etag.get_etag('0.1.3', '/ksea', form, input_path, 'application/json') != etag
+
+
+@pytest.mark.parametrize('setting,value', [('ROKAI_ENGINE', 'python'), ('SSGSEA_PERMUTATIONS', '100'),
+                                           ('SSGSEA_MIN_OVERLAP', '5')])
+def test_etag_depends_on_the_result_settings(tmp_path, monkeypatch, setting, value):
+    input_path = tmp_path / 'input.json'
+    input_path.write_text('[{"id": "AKT1", "Experiment01": 1.0}]')
+    etag = result_etag.get_etag('0.1.3', '/ssgsea', MultiDict(), input_path, 'application/json')
+
+    monkeypatch.setenv(setting, value)
+    assert result_etag.get_etag('0.1.3', '/ssgsea', MultiDict(), input_path, 'application/json') != etag
@@ -0,0 +1,31 @@
+from pathlib import Path
+import pandas as pd
+from modules.gct import gct
+
+COMBINED_GCT = Path('../fixtures/ptm-sea/expected_output/out-combined.gct')
+
+
+def test_read_selected_row_metadata():
+    parsed = gct.read_gct(COMBINED_GCT, row_metadata_columns=['fdr.pvalue.Experiment01', 'Signature.set.size'])
+    assert list(parsed.row_metadata_df.columns) == ['fdr.pvalue.Experiment01', 'Signature.set.size']
+    assert parsed.row_metadata_df['Signature.set.size'].dtype == 'int64'
+    assert list(parsed.data_df.columns) == ['Experiment01', 'Experiment02']
+    assert parsed.data_df.loc['KINASE-PSP_CDK1', 'Experiment02'] == -6.168
+    assert parsed.col_metadata_df.loc['Experiment02', 'pert_time'] == '24'
+
+
+def test_write_read_roundtrip(tmp_path):
+    parsed = gct.read_gct(COMBINED_GCT)
+    gct.write_gct(tmp_path / 'roundtrip.gct', parsed.data_df, parsed.row_metadata_df, parsed.col_metadata_df)
+    reparsed = gct.read_gct(tmp_path / 'roundtrip.gct')
+    pd.testing.assert_frame_equal(parsed.data_df, reparsed.data_df)
+    pd.testing.assert_frame_equal(parsed.row_metadata_df, reparsed.row_metadata_df)
+    pd.testing.assert_frame_equal(parsed.col_metadata_df, reparsed.col_metadata_df)
+
+
+def test_identifiers_are_not_missing_values(tmp_path):
+    data_df = pd.DataFrame({'Experiment 01': [1.5, None]}, index=pd.Index(['NA', 'TP53'], name='id'))
+    gct.write_gct(tmp_path / 'input.gct', data_df)
+    parsed = gct.read_gct(tmp_path / 'input.gct')
+    pd.testing.assert_frame_equal(parsed.data_df, data_df)
+    assert gct.sanitize_r_name('Experiment 01') == 'Experiment.01'
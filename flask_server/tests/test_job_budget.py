@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+import pytest
+from modules.job_budget import job_budget
+
+
+def test_child_over_cpu_budget_is_stopped():
+    budget = job_budget.JobBudget(memory_mb=1024, cpu_seconds=1, disk_mb=1024)
+    token = job_budget.CURRENT_BUDGET.set(budget)
+    try:
+        with pytest.raises(job_budget.BudgetExceeded) as error:
+            job_budget.run([sys.executable, '-c', 'while True: pass'], capture_output=True, text=True)
+    finally:
+        job_budget.CURRENT_BUDGET.reset(token)
+
+    assert error.value.resource_name == 'cpu'
+    assert len(budget.children) == 1 and budget.children[0]['cpu_time'] >= 1
+
+
+def test_child_within_budget_returns_its_output():
+    budget = job_budget.JobBudget(memory_mb=1024, cpu_seconds=10, disk_mb=1024)
+    token = job_budget.CURRENT_BUDGET.set(budget)
+    try:
+        result = job_budget.run([sys.executable, '-c', 'print("ok")'], capture_output=True, text=True)
+    finally:
+        job_budget.CURRENT_BUDGET.reset(token)
+
+    assert result.returncode == 0 and result.stdout == 'ok\n'
+    assert budget.children[0]['peak_memory_mb'] > 0
+
+
+def test_concurrent_children_share_the_memory_budget():
+    budget = job_budget.JobBudget(memory_mb=1024, cpu_seconds=10, disk_mb=1024)
+    token = job_budget.CURRENT_BUDGET.set(budget)
+    try:
+        result = job_budget.run([sys.executable, '-c',
+                                 'import resource; print(resource.getrlimit(resource.RLIMIT_AS)[0])'],
+                                memory_shares=4, capture_output=True, text=True)
+    finally:
+        job_budget.CURRENT_BUDGET.reset(token)
+
+    assert int(result.stdout) == 256 * 1024 * 1024
+
+
+def test_python_work_over_cpu_budget_is_interrupted(monkeypatch):
+    monkeypatch.setattr(job_budget, 'BUDGET_CHECK_INTERVAL', 0.05)
+    monkeypatch.setitem(job_budget.BUDGET_DEFAULTS, 'fast', (1024 * 1024, 0, 1024))
+
+    @job_budget.budgeted('fast')
+    def busy_handler():
+        deadline = time.perf_counter() + 10
+        while time.perf_counter() < deadline:
+            pass
+        return 'done'
+
+    with pytest.raises(job_budget.BudgetExceeded) as error:
+        busy_handler()
+    assert error.value.resource_name == 'cpu' and error.value.source == 'Python'
+
+
+def test_child_over_disk_budget_is_stopped(tmp_path):
+    budget = job_budget.JobBudget(memory_mb=1024, cpu_seconds=10, disk_mb=1, workspace=tmp_path)
+    token = job_budget.CURRENT_BUDGET.set(budget)
+    try:
+        with open(tmp_path / 'output', 'wb') as outfile, pytest.raises(job_budget.BudgetExceeded) as error:
+            job_budget.run(['head', '-c', str(4 * 1024 * 1024), '/dev/zero'], stdout=outfile)
+    finally:
+        job_budget.CURRENT_BUDGET.reset(token)
+
+    assert error.value.resource_name == 'disk' and error.value.to_dict()['unit'] == 'MB'
+    assert (tmp_path / 'output').stat().st_size == 1024 * 1024
+
+
+def test_workspace_over_disk_budget_is_interrupted(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_budget, 'BUDGET_CHECK_INTERVAL', 0.05)
+    monkeypatch.setitem(job_budget.BUDGET_DEFAULTS, 'fast', (1024 * 1024, 600, 1))
+
+    @job_budget.budgeted('fast')
+    def writing_handler():
+        job_budget.set_workspace(tmp_path)
+        (tmp_path / 'intermediate.csv').write_bytes(bytes(2 * 1024 * 1024))
+        deadline = time.perf_counter() + 10
+        while time.perf_counter() < deadline:
+            pass
+        return 'done'
+
+    with pytest.raises(job_budget.BudgetExceeded) as error:
+        writing_handler()
+    assert error.value.resource_name == 'disk' and error.value.usage >= 2
+
+
+def test_budget_interrupt_is_not_swallowed_by_the_analysis(monkeypatch):
+    monkeypatch.setattr(job_budget, 'BUDGET_CHECK_INTERVAL', 0.05)
+    monkeypatch.setitem(job_budget.BUDGET_DEFAULTS, 'fast', (1024 * 1024, 0, 1024))
+
+    @job_budget.budgeted('fast')
+    def handler_with_broad_except():
+        deadline = time.perf_counter() + 10
+        while time.perf_counter() < deadline:
+            try:
+                sum(range(1000))
+            except Exception:
+                pass
+        return 'done'
+
+    with pytest.raises(job_budget.BudgetExceeded):
+        handler_with_broad_except()
+
+
+def test_child_that_was_not_measured_is_recorded():
+    budget = job_budget.JobBudget(memory_mb=1024, cpu_seconds=10, disk_mb=1024)
+    budget.record_child(['Rscript', 'script.R'], None)
+    assert budget.children == [{'command': 'Rscript script.R', 'peak_memory_mb': None, 'cpu_time': None}]
+
+
+@pytest.mark.parametrize('prlimit_path', [job_budget.PRLIMIT_PATH, None])
+def test_child_runs_under_the_rlimits(monkeypatch, prlimit_path):
+    monkeypatch.setattr(job_budget, 'PRLIMIT_PATH', prlimit_path)
+    budget = job_budget.JobBudget(memory_mb=1024, cpu_seconds=10, disk_mb=64)
+    token = job_budget.CURRENT_BUDGET.set(budget)
+    try:
+        # Without prlimit the limits are set after the start, give them a moment
+        result = job_budget.run([sys.executable, '-c', 'import time, resource; time.sleep(0.2); '
+                                 'print([resource.getrlimit(limit)[0] for limit in '
+                                 '(resource.RLIMIT_AS, resource.RLIMIT_CPU, resource.RLIMIT_FSIZE)])'],
+                                capture_output=True, text=True)
+    finally:
+        job_budget.CURRENT_BUDGET.reset(token)
+
+    assert result.stdout == f'{[1024 * 1024 * 1024, 10, 64 * 1024 * 1024]}\n'
+    assert result.args[0] == sys.executable and budget.children[0]['command'].startswith(sys.executable)
+
+
+@pytest.mark.parametrize('capture_output', [False, True])
+def test_child_over_workspace_budget_is_killed(tmp_path, monkeypatch, capture_output):
+    monkeypatch.setattr(job_budget, 'BUDGET_CHECK_INTERVAL', 0.05)
+    monkeypatch.setitem(job_budget.BUDGET_DEFAULTS, 'fast', (1024 * 1024, 600, 1))
+    pid_file = tmp_path / 'pid'
+
+    @job_budget.budgeted('fast')
+    def handler_running_a_child():
+        job_budget.set_workspace(tmp_path)
+        # Each file stays below RLIMIT_FSIZE, together they are over the budget of the workspace
+        job_budget.run([sys.executable, '-c', 'import os, sys, time; open(sys.argv[1], "w").write(str(os.getpid())); '
+                        '[open(f"{sys.argv[1]}{i}", "wb").write(bytes(700 * 1024)) for i in range(2)]; time.sleep(60)',
+                        str(pid_file)], capture_output=capture_output)
+        return 'done'
+
+    start = time.perf_counter()
+    with pytest.raises(job_budget.BudgetExceeded) as error:
+        handler_running_a_child()
+
+    assert error.value.resource_name == 'disk' and error.value.source == 'Workspace'
+    assert time.perf_counter() - start < 10
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
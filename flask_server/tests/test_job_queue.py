@@ -0,0 +1,130 @@
+import os
+import time
+import sqlite3
+import threading
+import multiprocessing
+from collections import Counter
+from modules.job_queue import job_queue
+from modules.cancellation import cancellation
+
+
+def execute(job: job_queue.Job) -> job_queue.JobResult:
+    # Stands in for an analysis: Answers with the pid of the replica that ran it
+    if ('crash', '1') in job.form and job.attempts == 1:
+        os._exit(1)
+    time.sleep(0.1)
+    return job_queue.JobResult(200, {'Content-Type': 'text/plain'}, str(os.getpid()).encode())
+
+
+def run_replica(directory):
+    queue = job_queue.SQLiteJobQueue(directory, lease_seconds=0.5)
+    job_queue.work(queue, 'heavy', f'replica{os.getpid()}', execute, threading.Event())
+
+
+def test_expired_lease_is_reassigned(tmp_path):
+    queue = job_queue.SQLiteJobQueue(tmp_path, lease_seconds=0.2)
+    input_path = tmp_path / 'input.json'
+    input_path.write_text('[]')
+    job_id = queue.submit('heavy', '/kstar', [('session_id', 'TESTSESSION')], {}, input_path)
+
+    first = queue.claim('heavy', 'replica1')
+    assert queue.claim('heavy', 'replica2') is None
+    assert first.input_path.read_text() == '[]' and first.form == [('session_id', 'TESTSESSION')]
+    time.sleep(0.3)
+    second = queue.claim('heavy', 'replica2')
+
+    assert second.job_id == job_id and second.attempts == 2
+    assert not queue.heartbeat(job_id, 'replica1')
+    assert not queue.complete(job_id, 'replica1', job_queue.JobResult(200, {}, b'stale'))
+    assert queue.complete(job_id, 'replica2', job_queue.JobResult(200, {}, b'fresh'))
+    assert queue.get_result(job_id).body == b'fresh'
+    assert not second.input_path.exists()
+
+
+def test_job_that_keeps_losing_its_worker_fails(tmp_path):
+    queue = job_queue.SQLiteJobQueue(tmp_path, lease_seconds=0.01, max_attempts=2)
+    job_id = queue.submit('fast', '/kea3', [], {}, None)
+
+    for attempt in range(2):
+        assert queue.claim('fast', f'replica{attempt}') is not None
+        time.sleep(0.02)
+
+    assert queue.claim('fast', 'replica3') is None
+    result = queue.get_result(job_id)
+    assert result.status == 500 and b'never finished' in result.body
+
+
+def test_replicas_share_skewed_submissions(tmp_path):
+    queue = job_queue.SQLiteJobQueue(tmp_path, lease_seconds=0.5)
+    # All jobs arrive at one replica, the first one crashes the replica that claims it
+    crash_job = queue.submit('heavy', '/kstar', [('crash', '1')], {}, None)
+    job_ids = [queue.submit('heavy', '/kstar', [], {}, None) for _ in range(30)]
+
+    context = multiprocessing.get_context('fork')
+    replicas = [context.Process(target=run_replica, args=(tmp_path,), daemon=True) for _ in range(3)]
+    for replica in replicas:
+        replica.start()
+    try:
+        deadline = time.time() + 60
+        while queue.count('heavy')['done'] < 31 and time.time() < deadline:
+            time.sleep(0.1)
+        runs = Counter(queue.get_result(job_id).body.decode() for job_id in job_ids)
+    finally:
+        for replica in replicas:
+            replica.kill()
+
+    crashed = [replica for replica in replicas if replica.exitcode == 1]
+    assert len(crashed) == 1
+    assert queue.get(crash_job).attempts == 2 and queue.get_result(crash_job).status == 200
+    surviving_pids = {str(replica.pid) for replica in replicas} - {str(crashed[0].pid)}
+    assert set(runs) <= surviving_pids and sum(runs.values()) == 30
+    # Both surviving replicas pulled a fair share of the jobs
+    assert min(runs[pid] for pid in surviving_pids) >= 10
+
+
+def test_preview_is_served_while_the_job_is_refined(tmp_path):
+    queue = job_queue.SQLiteJobQueue(tmp_path)
+    input_path = tmp_path / 'input.json'
+    input_path.write_text('[]')
+    job_id = queue.submit('heavy', '/ssgsea', [('mode', 'preview'), ('async', '1')], {}, input_path)
+    preview = job_queue.JobResult(200, {job_queue.RESULT_STAGE_HEADER: 'preview'}, b'preview')
+
+    job = queue.claim('heavy', 'replica1')
+    assert queue.complete(job_id, 'replica1', preview, job_queue.get_refined_form(job, preview))
+    body, status, headers = job_queue.get_response(queue, job_id)
+    assert (body, status, headers[job_queue.RESULT_STAGE_HEADER]) == (b'preview', 200, 'preview')
+
+    refinement = queue.claim('heavy', 'replica2')
+    assert refinement.job_id == job_id and refinement.form == [('mode', 'full'), ('async', '1')]
+    assert refinement.input_path.read_text() == '[]'
+    full = job_queue.JobResult(200, {job_queue.RESULT_STAGE_HEADER: 'full'}, b'full')
+    assert job_queue.get_refined_form(refinement, full) is None
+    assert queue.complete(job_id, 'replica2', full)
+
+    assert job_queue.get_response(queue, job_id)[:2] == (b'full', 200)
+    assert len(list((tmp_path / 'results').iterdir())) == 1 and not refinement.input_path.exists()
+
+
+def test_synchronous_preview_is_not_refined():
+    job = job_queue.Job('job', 'heavy', '/ssgsea', [('mode', 'preview')], {}, None, 'running')
+    preview = job_queue.JobResult(200, {job_queue.RESULT_STAGE_HEADER: 'preview'}, b'preview')
+    assert job_queue.get_refined_form(job, preview) is None
+
+
+def test_failed_heartbeat_is_retried(tmp_path):
+    queue = job_queue.SQLiteJobQueue(tmp_path, lease_seconds=0.06)
+    job_id = queue.submit('heavy', '/kstar', [], {}, None)
+    queue.claim('heavy', 'replica1')
+    heartbeats = []
+
+    def heartbeat(job_id, worker):
+        heartbeats.append(worker)
+        if len(heartbeats) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        return len(heartbeats) < 3
+
+    queue.heartbeat = heartbeat
+    job_cancellation = cancellation.Cancellation()
+    job_queue.keep_leased(queue, job_id, 'replica1', threading.Event(), job_cancellation)
+
+    assert len(heartbeats) == 3 and job_cancellation.reason == cancellation.SUPERSEDED
@@ -0,0 +1,68 @@
+import json
+from pathlib import Path
+import pandas as pd
+import pytest
+from modules.json_records import json_records
+
+INPUT_JSONS = [Path('../fixtures/ksea/input/input.json'),
+               Path('../fixtures/motif_enrichment/input/input.json'),
+               Path('../fixtures/ssgsea/input/input.json')]
+
+
+@pytest.mark.parametrize('input_json', INPUT_JSONS)
+def test_same_result_as_json_load(input_json, monkeypatch):
+    # Small chunks and batches, so records are split across chunks and batches are concatenated
+    monkeypatch.setattr(json_records, 'READ_CHUNK_SIZE', 97)
+    monkeypatch.setattr(json_records, 'RECORD_BATCH_SIZE', 50)
+
+    expected = pd.DataFrame.from_dict(json.load(open(input_json)))
+    pd.testing.assert_frame_equal(json_records.read_records(input_json), expected)
+
+
+def test_records_with_different_keys(tmp_path, monkeypatch):
+    monkeypatch.setattr(json_records, 'RECORD_BATCH_SIZE', 2)
+    input_json = tmp_path / 'input.json'
+    input_json.write_text(json.dumps([{'id': 'A', 'Exp1': 1}, {'id': 'B', 'Exp2': 'up'}, {'id': 'C', 'Exp1': 2}]))
+
+    result = json_records.read_records(input_json)
+
+    assert list(result.columns) == ['id', 'Exp1', 'Exp2']
+    assert result['Exp1'].isna().tolist() == [False, True, False]
+    assert result['Exp2'].tolist()[1] == 'up'
+
+
+def test_truncated_input_raises(tmp_path):
+    input_json = tmp_path / 'input.json'
+    input_json.write_text('[{"id": "A", "Exp1": 1}, {"id": "B", "Ex')
+
+    with pytest.raises(json.JSONDecodeError):
+        json_records.read_records(input_json)
+
+
+def test_named_records_are_parsed_one_array_after_the_other(tmp_path, monkeypatch):
+    monkeypatch.setattr(json_records, 'READ_CHUNK_SIZE', 7)
+    monkeypatch.setattr(json_records, 'RECORD_BATCH_SIZE', 2)
+    cohort = {'patient "01"': [{'id': 'A', 'Exp1': 1.5}, {'id': 'B', 'Exp1': None}, {'id': 'C', 'Exp1': -2}],
+              'empty': [], 'patient02': [{'id': 'D', 'Exp2': 'up'}]}
+    input_json = tmp_path / 'input.json'
+    input_json.write_text(json.dumps(cohort, indent=1))
+
+    datasets = json_records.iter_named_records(input_json)
+    name, first = next(datasets)
+
+    assert name == 'patient "01"'
+    pd.testing.assert_frame_equal(first, pd.DataFrame.from_dict(cohort[name]))
+    assert [(name, len(input_df)) for name, input_df in datasets] == [('empty', 0), ('patient02', 1)]
+
+
+@pytest.mark.filterwarnings('error')
+def test_batches_with_all_na_columns(tmp_path, monkeypatch):
+    monkeypatch.setattr(json_records, 'RECORD_BATCH_SIZE', 2)
+    records = [{'id': 'A', 'Exp1': None, 'Exp2': None, 'Exp3': None},
+               {'id': 'B', 'Exp1': None, 'Exp2': None},
+               {'id': 'C', 'Exp1': 1.5, 'Exp2': None, 'Exp3': None},
+               {'id': 'D', 'Exp1': -2, 'Exp2': None, 'Exp3': None}]
+    input_json = tmp_path / 'input.json'
+    input_json.write_text(json.dumps(records))
+
+    pd.testing.assert_frame_equal(json_records.read_records(input_json), pd.DataFrame.from_dict(records))
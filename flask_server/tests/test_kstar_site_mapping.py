@@ -0,0 +1,56 @@
+import logging
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('kstar')
+from kstar import mapping
+from modules.k_star import site_mapping
+
+SEQUENCES = {'P00001': 'MSAKRRSPTEGSYDLLKTPQSGGAYKRRSAT', 'P00002': 'MTTYSSPRKSDLLERSPSYAAK'}
+COLUMNS = {'peptide': 'Sequence', 'accession_id': 'Uniprot_Accession'}
+
+
+@pytest.fixture
+def experiment():
+    return pd.DataFrame({
+        'Uniprot_Accession': ['P00001', 'P00001-2', 'P00002', 'P00002', 'Q99999', 'P00001', 'P00001'],
+        # Two modified residues, an isoform, a peptide that is not in the sequence, an unknown protein, a duplicate
+        'Sequence': ['MSAKRRsPTEGSY', 'LLKtPQSGGAY', '___MTTyssPRKS', 'KKKKsKKKK', 'AAAsAAA', 'MSAKRRsPTEGSY',
+                     'EGSyDLL'],
+        'data:A': [1.0, np.nan, 0.5, 2.0, 1.0, 1.0, 0.1],
+    })
+
+
+@pytest.fixture
+def compendia():
+    sites = ['S7', 'T18', 'Y13', 'Y4', 'S5', 'S6']
+    return pd.DataFrame({'KSTAR_ACCESSION': ['P00001', 'P00001', 'P00001', 'P00002', 'P00002', 'P00002'],
+                         'KSTAR_SITE': sites, 'KSTAR_NUM_COMPENDIA': [3, 1, 2, 4, 0, 1],
+                         'KSTAR_NUM_COMPENDIA_CLASS': [2, 0, 1, 2, 0, 1]})
+
+
+def test_matches_experiment_mapper_with_and_without_index(experiment, compendia, tmp_path):
+    logger = logging.getLogger('test_kstar_site_mapping')
+    expected = mapping.ExperimentMapper(experiment.copy(), COLUMNS, logger, sequences=SEQUENCES,
+                                        compendia=compendia).experiment
+
+    for _ in range(2):
+        mapped = site_mapping.map_experiment(experiment, COLUMNS, logger, sequences=SEQUENCES, compendia=compendia,
+                                             index_path=tmp_path / 'index.sqlite', reference='test')
+        pd.testing.assert_frame_equal(mapped, expected)
+
+
+def test_index_stores_sites_and_reasons(experiment, compendia, tmp_path):
+    logger = logging.getLogger('test_kstar_site_mapping')
+    site_mapping.map_experiment(experiment, COLUMNS, logger, sequences=SEQUENCES, compendia=compendia,
+                                index_path=tmp_path / 'index.sqlite', reference='test')
+
+    with site_mapping.open_index(tmp_path / 'index.sqlite', 'test') as connection:
+        alignments = site_mapping.lookup(connection, 'test', [('P00001', 'MSAKRRsPTEGSY'), ('Q99999', 'AAAsAAA'),
+                                                              ('P00002', 'KKKKsKKKK'), ('P00002', 'unseen')])
+
+    assert alignments[('P00001', 'MSAKRRsPTEGSY')] == ('S7', 'MSAKRRsPTEGSYD', None)
+    assert alignments[('Q99999', 'AAAsAAA')][2] == 'SEQUENCE NOT FOUND : Q99999'
+    assert alignments[('P00002', 'KKKKsKKKK')][2].startswith('SITE NOT FOUND')
+    assert ('P00002', 'unseen') not in alignments
@@ -0,0 +1,147 @@
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+import pytest
+from werkzeug.datastructures import MultiDict
+
+pytest.importorskip('psite_annotation')
+from modules.motif_enrichment import motif_enrichment
+
+KINASES = ['AKT1', 'CDK1', 'MTOR', 'PRKACA']
+SEQUENCES = ['RRRSAsPVLAE', 'AAPKTsPPKSP', 'LLSLRtPRSPE', 'GGGGGyGGGGG']
+METRIC_INDEX = {'score': 0, 'percentile': 1, 'total': 2}
+
+
+def find_upstream_kinases(sequence: str, Q, P, setting: motif_enrichment.MotifSetting) -> list[str]:
+    """
+    Reference implementation of the kinase selection of one site, one kinase after the other
+    """
+    metrics = {}
+    for kinase in Q:
+        score = 1.0
+        for i, aa in enumerate(sequence):
+            score *= P.get((kinase, i - 5, aa), 1.0)
+        if score <= 0:
+            continue
+        score = np.log2(score)
+        scores, quantiles = Q[kinase]
+        index = np.searchsorted(scores, score)
+        if index + 1 >= len(scores):
+            percentile = quantiles[-1]
+        else:
+            percentile = quantiles[index] + (score - scores[index]) * (quantiles[index + 1] - quantiles[index]) / (
+                scores[index + 1] - scores[index])
+        metrics[kinase] = (score, float(percentile), score * float(percentile))
+    ranked = sorted(metrics.items(), key=lambda item: item[1][METRIC_INDEX[setting.sort_type]], reverse=True)
+    return [kinase for kinase, values in ranked
+            if values[METRIC_INDEX[setting.threshold_type]] > setting.threshold][:setting.top_n]
+
+
+def motif_enrichment_reference(site_contexts: pd.Series, regulation: pd.Series, Q, P,
+                               setting: motif_enrichment.MotifSetting) -> pd.DataFrame:
+    """
+    Reference implementation of the enrichment of one experiment, counting one site after the other
+    """
+    input_df = pd.DataFrame({'Site sequence context': site_contexts.str.split(';'), 'Regulation': regulation})
+    input_df['Site weight'] = 1 / input_df['Site sequence context'].apply(len)
+    input_df = input_df.explode('Site sequence context').reset_index(drop=True)
+    input_df['Site weight'] = input_df['Site weight'] / input_df.groupby('Site sequence context')[
+        'Site weight'].transform('size')
+    input_df = input_df[(input_df['Site sequence context'] != '')
+                        & input_df['Regulation'].isin(motif_enrichment.REGULATION_TYPES)]
+
+    total_regulations = input_df.groupby('Regulation')['Site weight'].sum().to_dict()
+    total_regulations = pd.Series({reg: total_regulations.get(reg, 0) for reg in motif_enrichment.REGULATION_TYPES})
+    counter = defaultdict(lambda: {'down': 0, 'up': 0, 'not': 0})
+    for _, row in input_df.iterrows():
+        for kinase in find_upstream_kinases(row['Site sequence context'], Q, P, setting):
+            counter[kinase][row['Regulation']] += row['Site weight']
+    kinase_counts = pd.DataFrame(counter, dtype='float64').T
+
+    enrichment = {kinase: motif_enrichment.kinase_motif_enrichment_test(counts, total_regulations)
+                  for kinase, counts in kinase_counts.iterrows()}
+    enrichment = pd.DataFrame(enrichment, index=['-Log10 p_value', 'Log2 Enrichment']).T
+    return pd.merge(kinase_counts, enrichment, left_index=True, right_index=True)
+
+
+def get_annotation(site_contexts: pd.Series, Q, P) -> motif_enrichment.MotifAnnotation:
+    sequences = pd.Index(site_contexts.str.split(';').explode().unique())
+    sequences = sequences[sequences != '']
+    scores, percentiles = motif_enrichment.score_sites(sequences.tolist(), list(Q), Q, P)
+    return motif_enrichment.annotate_site_contexts(site_contexts, motif_enrichment.ScoredContexts(
+        sequences=sequences, kinases=list(Q), scores=scores, percentiles=percentiles))
+
+
+@pytest.fixture
+def motif_tables():
+    rng = np.random.default_rng(0)
+    odds = {(kinase, pos, aa): rng.uniform(0, 3) for kinase in KINASES for pos in range(-5, 6)
+            for aa in 'ARLSTPKEGsty'}
+    odds[('MTOR', 0, 'y')] = 0.0
+    grid = np.linspace(-20, 20, 50)
+    quantiles = {kinase: (pd.Index(grid, name='Score'), np.sort(rng.random(50))) for kinase in KINASES}
+    return quantiles, odds
+
+
+@pytest.mark.parametrize('setting', [motif_enrichment.MotifSetting(),
+                                     motif_enrichment.MotifSetting(2, 0.3, 'percentile', 'score'),
+                                     motif_enrichment.MotifSetting(3, 0.0, 'score', 'total')])
+def test_selection_matches_the_reference(motif_tables, setting):
+    quantiles, odds = motif_tables
+    scores, percentiles = motif_enrichment.score_sites(SEQUENCES, KINASES, quantiles, odds)
+    annotation = motif_enrichment.MotifAnnotation(rows=np.arange(4), site_weights=np.ones(4), site_index=np.arange(4),
+                                                  kinases=np.array(KINASES, dtype=object), scores=scores,
+                                                  percentiles=percentiles)
+
+    selected = annotation.select(setting)
+
+    for sequence, site_selected in zip(SEQUENCES, selected):
+        assert set(np.array(KINASES)[site_selected]) == set(find_upstream_kinases(sequence, quantiles, odds, setting))
+
+
+def test_parse_settings_sweeps_all_combinations():
+    settings = motif_enrichment.parse_settings(MultiDict({'top_n': '5, 10', 'threshold': '0.8,0.9'}))
+
+    assert len(settings) == 4
+    assert {setting.sort_type for setting in settings} == {'percentile'}
+    assert motif_enrichment.get_setting_label(settings[0], settings) == 'top_n=5, threshold=0.8'
+    with pytest.raises(ValueError):
+        motif_enrichment.parse_settings(MultiDict({'sort_type': 'rank'}))
+
+
+@pytest.mark.parametrize('setting', [motif_enrichment.MotifSetting(15, 0.3, 'percentile', 'percentile'),
+                                     motif_enrichment.MotifSetting(1, -np.inf, 'percentile', 'percentile'),
+                                     motif_enrichment.MotifSetting(1, 0.3, 'total', 'score')])
+def test_threshold_boundary_and_ties_match_the_reference(setting):
+    # AKT1 and CDK1 tie, their percentile is exactly 0.3, which float32 would round up past the threshold
+    odds = {('AKT1', 0, 's'): 2.0, ('CDK1', 0, 's'): 2.0, ('MTOR', 0, 's'): 1.5}
+    grid = pd.Index([0.0, 1.0, 2.0, 3.0], name='Score')
+    quantiles = {kinase: (grid, np.array([0.1, 0.3, 0.7, 0.9])) for kinase in ['AKT1', 'CDK1', 'MTOR']}
+    scores, percentiles = motif_enrichment.score_sites(['AAAAAsAAAAA'], list(quantiles), quantiles, odds)
+    annotation = motif_enrichment.MotifAnnotation(rows=np.arange(1), site_weights=np.ones(1), site_index=np.arange(1),
+                                                  kinases=np.array(list(quantiles), dtype=object), scores=scores,
+                                                  percentiles=percentiles)
+
+    selected = annotation.select(setting)
+
+    expected = find_upstream_kinases('AAAAAsAAAAA', quantiles, odds, setting)
+    assert list(annotation.kinases[selected[0]]) == expected
+    assert percentiles.dtype == np.float64
+
+
+@pytest.mark.parametrize('setting', [motif_enrichment.MotifSetting(),
+                                     motif_enrichment.MotifSetting(2, 0.3, 'percentile', 'score')])
+def test_enrichment_matches_the_reference(motif_tables, setting):
+    quantiles, odds = motif_tables
+    # Sites with several contexts and contexts in several sites have fractional weights
+    site_contexts = pd.Series(['RRRSAsPVLAE;AAPKTsPPKSP;LLSLRtPRSPE', 'GGGGGyGGGGG', 'AAPKTsPPKSP', '',
+                               'LLSLRtPRSPE;GGGGGyGGGGG', 'RRRSAsPVLAE', 'AAPKTsPPKSP;RRRSAsPVLAE'] * 3)
+    regulation = pd.Series(['up', 'down', 'not', 'up', None, 'down', 'up'] * 3)
+    annotation = get_annotation(site_contexts, quantiles, odds)
+
+    result = motif_enrichment.motif_enrichment_analysis(motif_enrichment.get_regulations(regulation, annotation),
+                                                        annotation, annotation.select(setting),
+                                                        annotation.get_order(setting.sort_type))
+
+    expected = motif_enrichment_reference(site_contexts, regulation, quantiles, odds, setting)
+    pd.testing.assert_frame_equal(result, expected, check_exact=True)
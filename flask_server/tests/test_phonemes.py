@@ -0,0 +1,44 @@
+import shutil
+from pathlib import Path
+import pytest
+
+phonemes = pytest.importorskip('modules.phonemes.phonemes')
+from modules.job_budget import job_budget
+
+INPUT_JSON = Path('../fixtures/phonemes/input/input.json')
+
+
+def get_results(output_dir: Path) -> dict[str, str]:
+    return {path.name: path.read_text() for path in sorted(output_dir.glob('*_phonemes_out.sif'))}
+
+
+@pytest.mark.skipif(shutil.which('Rscript') is None or not Path('../CPLEX/cplex').exists(),
+                    reason='Needs R with PHONEMeS and CPLEX (see Dockerfile)')
+def test_second_run_reuses_the_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(phonemes, 'PHONEMES_CACHE_DIR', tmp_path / 'cache')
+    file_prefix = phonemes.preprocess_phonemes(Path(shutil.copy(INPUT_JSON, tmp_path / 'input.json')))
+    first_results = get_results(phonemes.run_phonemes(file_prefix))
+    assert len(first_results) == 2
+    assert len(list((tmp_path / 'cache' / 'networks').glob('*_pruned_*.rds'))) == 2
+
+    # Identical inputs reuse the result without starting R
+    for sif in tmp_path.glob('*_phonemes_out.sif'):
+        sif.unlink()
+    monkeypatch.setattr(job_budget, 'run', lambda *args, **kwargs: pytest.fail('R was started'))
+    assert get_results(phonemes.run_phonemes(file_prefix)) == first_results
+
+    # Without the results, R runs again on the cached pruned networks (pruning = FALSE)
+    monkeypatch.undo()
+    monkeypatch.setattr(phonemes, 'PHONEMES_CACHE_DIR', tmp_path / 'cache')
+    shutil.rmtree(tmp_path / 'cache' / 'results')
+    outputs = []
+    run = job_budget.run
+
+    def recording_run(*args, **kwargs):
+        completed_process = run(*args, **kwargs)
+        outputs.append(completed_process.stdout)
+        return completed_process
+
+    monkeypatch.setattr(job_budget, 'run', recording_run)
+    assert get_results(phonemes.run_phonemes(file_prefix)) == first_results
+    assert len(outputs) == 2 and all('Using cached pruned network' in output for output in outputs)
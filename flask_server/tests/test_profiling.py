@@ -0,0 +1,55 @@
+import sys
+import json
+import subprocess
+from modules.profiling import profiling
+
+
+def busy_python_function():
+    deadline = profiling.time.perf_counter() + 0.2
+    while profiling.time.perf_counter() < deadline:
+        sum(range(1000))
+
+
+def test_profiler_records_python_stacks_and_children(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', tmp_path)
+    original_popen = subprocess.Popen
+
+    with profiling.RequestProfiler(interval=0.001) as profiler:
+        busy_python_function()
+        subprocess.run([sys.executable, '-c', 'bytearray(50 * 1024 * 1024)'], capture_output=True)
+
+    assert subprocess.Popen is original_popen
+    assert any('busy_python_function' in stack for stack in profiler.samples)
+    assert len(profiler.children) == 1
+    assert profiler.children[0]['peak_memory_mb'] > 50
+
+    output_dir = profiler.save('Test')
+    summary = json.load(open(output_dir / 'profile.json'))
+    assert summary['samples'] == sum(profiler.samples.values())
+    # The request thread was busy for 0.2 s, the child's CPU time is not counted
+    assert 0.1 < summary['cpu_time'] < summary['wall_time']
+    assert summary['peak_rss_growth_mb'] >= 0
+    stack, count = open(output_dir / 'stacks.collapsed').readline().rsplit(' ', 1)
+    assert int(count) > 0 and ';' in stack
+
+
+def test_cpu_time_of_other_threads_is_not_counted():
+    other_thread = profiling.threading.Thread(target=busy_python_function)
+    with profiling.RequestProfiler(interval=0.01) as profiler:
+        other_thread.start()
+        other_thread.join()
+
+    assert profiler.cpu_time < 0.1
+
+
+def test_old_profiles_are_deleted(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', tmp_path)
+    old_profile = tmp_path / 'old'
+    old_profile.mkdir()
+    for name in ['profile.json', 'stacks.collapsed']:
+        (old_profile / name).write_text('{}')
+        profiling.os.utime(old_profile / name, (0, 0))
+
+    profiling.cache_eviction.evict(tmp_path, profiling.PROFILE_MAX_MB, profiling.PROFILE_MAX_AGE_DAYS,
+                                   remove_directories=True)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,71 @@
+import pandas as pd
+import pytest
+from modules.reference_db import reference_db
+
+
+@pytest.fixture
+def compiled_adjacency(tmp_path, monkeypatch):
+    source = tmp_path / 'adjacency_matrix.csv'
+    source.write_text('### Database Version: 2024-01-01\n'
+                      'p_site,AKT1,MTOR,\n'
+                      'P12345_S15,1.0,,\n'
+                      'P12345_T20,,1.0,1.0\n'
+                      'Q99999_Y7,1.0,1.0,\n')
+    monkeypatch.setattr(reference_db, 'get_artifact_sources',
+                        lambda: {'ksea_adjacency': (reference_db.compile_ksea_adjacency, source)})
+    monkeypatch.setattr(reference_db, 'REFERENCE_DB_DIR', tmp_path / 'compiled')
+    reference_db.load_manifest.cache_clear()
+    reference_db.load_artifact.cache_clear()
+    manifest = reference_db.compile_all(tmp_path / 'compiled')
+    yield source, manifest
+    reference_db.load_manifest.cache_clear()
+    reference_db.load_artifact.cache_clear()
+
+
+def test_ksea_adjacency_round_trip(compiled_adjacency):
+    source, manifest = compiled_adjacency
+
+    adjacency_matrix = reference_db.load_ksea_adjacency()
+
+    assert manifest['artifacts']['ksea_adjacency']['source_version'] == '2024-01-01'
+    pd.testing.assert_frame_equal(adjacency_matrix, pd.read_csv(source, skiprows=1).set_index('p_site'))
+
+
+def test_changed_source_is_rejected(compiled_adjacency):
+    source, _ = compiled_adjacency
+    source.write_text(source.read_text() + 'Q11111_S1,1.0,,\n')
+
+    with pytest.raises(reference_db.ReferenceVersionError):
+        reference_db.load_ksea_adjacency()
+
+
+def test_phonemes_nodes(tmp_path, monkeypatch):
+    source = tmp_path / 'phonemes_PKN_KSN.csv'
+    source.write_text('source,interaction,target\n'
+                      'AKT1,1,P12345_S15\n'
+                      'MTOR,-1,AKT1\n')
+    monkeypatch.setattr(reference_db, 'get_artifact_sources',
+                        lambda: {'phonemes_pkn_ksn': (reference_db.compile_phonemes_nodes, source)})
+    monkeypatch.setattr(reference_db, 'REFERENCE_DB_DIR', tmp_path / 'compiled')
+    reference_db.compile_all(tmp_path / 'compiled')
+    reference_db.load_manifest.cache_clear()
+    reference_db.load_artifact.cache_clear()
+    reference_db.load_phonemes_nodes.cache_clear()
+
+    try:
+        assert reference_db.load_phonemes_nodes() == {'AKT1', 'MTOR', 'P12345_S15'}
+    finally:
+        reference_db.load_manifest.cache_clear()
+        reference_db.load_artifact.cache_clear()
+        reference_db.load_phonemes_nodes.cache_clear()
+
+
+def test_gmt_members(tmp_path):
+    gmt_file = tmp_path / 'sets.gmt'
+    gmt_file.write_text('SET_A\tdescription a\tAKT1\tMTOR\nSET_B\tdescription b\tCDK1\n')
+
+    gmt = reference_db.compile_gmt(gmt_file)
+
+    assert gmt['names'].tolist() == ['SET_A', 'SET_B']
+    members = gmt['genes'][gmt['members'][gmt['offsets'][0]:gmt['offsets'][1]]]
+    assert members.tolist() == ['AKT1', 'MTOR']
@@ -0,0 +1,86 @@
+import json
+import pandas as pd
+from modules.result_cache import result_cache
+from modules.kea3 import kea3
+
+
+def test_key_depends_on_values_and_parameters_but_not_on_the_name():
+    values = pd.Series([1.0, 2.0, None], index=['A', 'B', 'C'], name='Experiment01')
+
+    key = result_cache.get_key('test', values, threshold=1)
+
+    assert key == result_cache.get_key('test', values.rename('Experiment02'), threshold=1)
+    assert key != result_cache.get_key('test', values, threshold=2)
+    assert key != result_cache.get_key('test', values.replace(2.0, 3.0), threshold=1)
+
+
+def test_kea3_only_sends_new_experiments(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_DIR', tmp_path / 'cache')
+    sent_experiments = []
+
+    class Response:
+        ok = True
+
+        def __init__(self, payload):
+            self.text = json.dumps({'Integrated--meanRank': [payload['query_name']], 'Integrated--topRank': []})
+
+    def post(url, data):
+        payload = json.loads(data)
+        sent_experiments.append(payload['query_name'])
+        return Response(payload)
+
+    monkeypatch.setattr(kea3.requests, 'post', post)
+    input_json = tmp_path / 'input.json'
+    input_json.write_text(json.dumps({'Exp1': ['AKT1', 'MTOR'], 'Exp2': ['CDK1']}))
+    kea3.run_kea3_api(input_json)
+    input_json.write_text(json.dumps({'Exp1': ['AKT1', 'MTOR'], 'Exp2': ['CDK1', 'CDK2'], 'Exp3': ['ATM']}))
+    result = json.load(open(kea3.run_kea3_api(input_json)))
+
+    assert sent_experiments == ['Exp1', 'Exp2', 'Exp2', 'Exp3']
+    assert list(result) == ['Exp1', 'Exp2', 'Exp3']
+    assert result['Exp1']['MeanRank'] == ['Exp1']
+
+
+def test_unreadable_entry_is_a_miss(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_DIR', tmp_path)
+    result_cache.store('test', 'abcd', {'score': 1})
+    path = result_cache.get_path('test', 'abcd')
+    path.write_bytes(path.read_bytes()[:5])
+
+    assert result_cache.load('test', 'abcd') is None
+    result_cache.store('test', 'abcd', {'score': 2})
+    assert result_cache.load('test', 'abcd') == {'score': 2}
+
+
+def test_key_depends_on_the_library_versions(monkeypatch):
+    values = pd.Series([1.0, 2.0], index=['A', 'B'])
+    key = result_cache.get_key('test', values)
+    result_cache.get_library_versions.cache_clear()
+    monkeypatch.setattr(result_cache.importlib.metadata, 'version', lambda library: '0.0.1')
+    try:
+        assert key != result_cache.get_key('test', values)
+    finally:
+        result_cache.get_library_versions.cache_clear()
+
+
+def test_kea3_asks_again_after_the_ttl(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_DIR', tmp_path / 'cache')
+    sent_experiments = []
+
+    class Response:
+        ok = True
+        text = json.dumps({'Integrated--meanRank': [], 'Integrated--topRank': []})
+
+    def post(url, data):
+        sent_experiments.append(json.loads(data)['query_name'])
+        return Response()
+
+    monkeypatch.setattr(kea3.requests, 'post', post)
+    input_json = tmp_path / 'input.json'
+    input_json.write_text(json.dumps({'Exp1': ['AKT1', 'MTOR']}))
+    kea3.run_kea3_api(input_json)
+    kea3.run_kea3_api(input_json)
+    monkeypatch.setattr(kea3, 'KEA3_CACHE_TTL_DAYS', 0)
+    kea3.run_kea3_api(input_json)
+
+    assert sent_experiments == ['Exp1', 'Exp1']
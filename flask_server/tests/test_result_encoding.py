@@ -0,0 +1,80 @@
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from modules.result_encoding import result_encoding
+
+LOG = {'Version': 'test'}
+
+
+@pytest.fixture
+def result():
+    return pd.DataFrame({'Gene': ['AKT1', 'CDK1'], 'Score (Experiment01)': [1.5, np.nan],
+                         'Set Size (Experiment01)': [12, 4]})
+
+
+def negotiate(accept: str) -> str:
+    return result_encoding.negotiate(parse_accept_header(accept, MIMEAccept))
+
+
+@pytest.mark.parametrize('accept', ['', '*/*', 'text/html,application/xhtml+xml,*/*;q=0.8', 'application/json'])
+def test_json_records_stay_the_default(accept, result, tmp_path):
+    assert negotiate(accept) == result_encoding.RECORDS
+    assert not result_encoding.keep_result(tmp_path / 'result.json', result)
+    assert result_encoding.encode_result(tmp_path / 'result.json', LOG) is None
+
+
+def test_records_json_of_several_tables(result):
+    records = json.loads(result_encoding.to_records_json({'patient01': result, 'patient02': pd.DataFrame()}))
+
+    assert records == {'patient01': json.loads(result.to_json(orient='records')), 'patient02': []}
+
+
+def test_split_json_has_the_columns_once(result, tmp_path):
+    negotiate(result_encoding.SPLIT_JSON)
+    assert result_encoding.keep_result(tmp_path / 'result.json', {'ST': result, 'Y': pd.DataFrame()})
+
+    encoded_path, media_type = result_encoding.encode_result(tmp_path / 'result.json', LOG)
+
+    encoded = json.loads(encoded_path.read_text())
+    assert media_type == result_encoding.SPLIT_JSON and encoded['Log'] == LOG
+    assert [field['name'] for field in encoded['Result']['ST']['schema']['fields']] == list(result.columns)
+    assert encoded['Result']['ST']['data'] == [['AKT1', 1.5, 12], ['CDK1', None, 4]]
+    assert encoded['Result']['Y']['data'] == []
+
+
+def test_arrow_concatenates_tables(result, tmp_path):
+    negotiate(f'{result_encoding.ARROW}, application/json;q=0.5')
+    tables = {'ST': result, 'Y': result.iloc[:1], 'T': pd.DataFrame()}
+    assert result_encoding.keep_result(tmp_path / 'result.json', tables)
+
+    encoded_path, _ = result_encoding.encode_result(tmp_path / 'result.json', LOG)
+
+    table = pa.ipc.open_stream(encoded_path.read_bytes()).read_all()
+    assert json.loads(table.schema.metadata[b'Log']) == LOG
+    decoded = table.to_pandas()
+    assert decoded['Result'].tolist() == ['ST', 'ST', 'Y']
+    pd.testing.assert_frame_equal(decoded.drop(columns='Result'), pd.concat([result, result.iloc[:1]],
+                                                                               ignore_index=True))
+
+
+def test_msgpack_is_column_oriented(result, tmp_path):
+    msgpack = pytest.importorskip('msgpack')
+    negotiate(result_encoding.MSGPACK)
+    assert result_encoding.keep_result(tmp_path / 'result.json', result)
+
+    encoded_path, _ = result_encoding.encode_result(tmp_path / 'result.json', LOG)
+
+    columns = msgpack.unpackb(encoded_path.read_bytes())['Result']['columns']
+    assert columns[0] == ['AKT1', 'CDK1'] and columns[2] == [12, 4] and np.isnan(columns[1][1])
+
+
+def test_json_only_results_fall_back(tmp_path):
+    # E.g. the pathway skeletons of PHONEMeS, which are written as JSON by the module
+    (tmp_path / 'result.json').write_text('[{"nodes": [], "edges": []}]')
+    negotiate(result_encoding.ARROW)
+
+    assert result_encoding.encode_result(tmp_path / 'result.json', LOG) is None
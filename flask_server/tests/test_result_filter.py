@@ -0,0 +1,55 @@
+import json
+import pandas as pd
+import pytest
+from werkzeug.datastructures import MultiDict
+from modules.result_filter import result_filter
+
+KSEA_OUTPUT = '../fixtures/ksea/expected_output/output_ksea.json'
+
+
+@pytest.fixture
+def ksea_result():
+    return pd.DataFrame.from_dict(json.load(open(KSEA_OUTPUT))['Result'])
+
+
+def test_empty_filter_keeps_the_result(ksea_result):
+    filtered = result_filter.parse_filter(MultiDict()).apply(ksea_result, 'Gene', 'Score', 'adj p-val')
+
+    assert filtered is ksea_result
+
+
+def test_pvalue_cutoff_and_top_k(ksea_result):
+    output_filter = result_filter.ResultFilter(max_pvalue=0.05, top_k=3)
+
+    filtered = output_filter.apply(ksea_result, 'Gene', 'Score', 'adj p-val')
+
+    expected_genes = set()
+    for experiment in ['Experiment_1', 'Experiment_2', 'Experiment_3']:
+        significant = ksea_result[ksea_result[f'adj p-val ({experiment})'] <= 0.05]
+        expected_genes |= set(significant.loc[significant[f'Score ({experiment})'].abs().nlargest(3).index, 'Gene'])
+    assert set(filtered['Gene']) == expected_genes
+    assert list(filtered.columns) == list(ksea_result.columns)
+
+
+def test_projection_drops_overlap_lists(ksea_result):
+    output_filter = result_filter.parse_filter(MultiDict({'columns': 'Score, Overlap', 'drop_overlap': 'true'}))
+
+    filtered = output_filter.apply(ksea_result, 'Gene', 'Score', 'adj p-val')
+
+    assert list(filtered.columns) == ['Gene', 'Score (Experiment_1)', 'Score (Experiment_2)', 'Score (Experiment_3)']
+    assert len(filtered) == len(ksea_result)
+
+
+def test_signed_log_pvalues():
+    kstar_result = pd.DataFrame({'Kinase': ['AKT1', 'CDK1', 'MTOR'], 'Experiment01': [3.0, -0.5, -2.5]})
+
+    filtered = result_filter.ResultFilter(max_pvalue=0.01).apply(kstar_result, 'Kinase', neg_log_pvalues=True)
+
+    assert filtered['Kinase'].tolist() == ['AKT1', 'MTOR']
+
+
+def test_invalid_values():
+    with pytest.raises(ValueError):
+        result_filter.parse_filter(MultiDict({'max_pvalue': '5'}))
+    with pytest.raises(ValueError):
+        result_filter.parse_filter(MultiDict({'top_k': 'ten'}))
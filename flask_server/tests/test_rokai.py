@@ -0,0 +1,84 @@
+import json
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pytest
+from modules.data_exchange import data_exchange
+from modules.ksea import rokai
+
+INPUT_CSV = Path('../fixtures/ksea/input/input.csv')
+EXPECTED_KSEA_ROKAI = Path('../fixtures/ksea/expected_output/output_ksea_rokai.json')
+# The R implementation that run_rokai.R sources, checked out by the Dockerfile
+ROKAI_CORE_R = Path('../RokaiApp/rokai_core.R')
+# The sparse LU factorization and R's solver round differently, the results agree far below the precision of the
+# fixtures (5 decimals)
+RTOL = 1e-5
+ATOL = 1e-7
+
+needs_rokai_r = pytest.mark.skipif(
+    shutil.which('Rscript') is None or not ROKAI_CORE_R.exists() or not rokai.ROKAI_NETWORK_DIR.exists(),
+    reason='Needs R, RokaiApp and the exported RoKAI network (see Dockerfile)')
+
+
+@needs_rokai_r
+def test_python_engine_matches_r(tmp_path):
+    from modules.ksea import ksea
+    input_csv = Path(shutil.copy(INPUT_CSV, tmp_path / 'input.csv'))
+    r_result = data_exchange.read_matrix(ksea.run_rokai(input_csv)).set_index('Site').sort_index()
+    python_result = rokai.refine(pd.read_csv(INPUT_CSV).set_index('Site'))
+
+    assert list(python_result.index) == list(r_result.index)
+    assert list(python_result.columns) == list(r_result.columns)
+    np.testing.assert_allclose(python_result.values, r_result.values, rtol=RTOL, atol=ATOL)
+
+
+@pytest.mark.skipif(not rokai.R_PARITY_FIXTURE.exists() or not rokai.ROKAI_NETWORK_DIR.exists(),
+                    reason='Needs the run_rokai.R parity fixture (python -m modules.ksea.rokai in the Docker image) '
+                           'and the exported RoKAI network')
+def test_python_engine_matches_r_fixture():
+    r_result = pd.read_csv(rokai.R_PARITY_FIXTURE).set_index('Site')
+    python_result = rokai.refine(pd.read_csv(rokai.PARITY_INPUT).set_index('Site'))
+
+    assert list(python_result.index) == list(r_result.index)
+    assert list(python_result.columns) == list(r_result.columns)
+    np.testing.assert_allclose(python_result.values, r_result.values, rtol=RTOL, atol=ATOL)
+
+
+@needs_rokai_r
+def test_python_engine_reproduces_ksea_fixture(tmp_path, monkeypatch):
+    ksea = pytest.importorskip('modules.ksea.ksea')
+    monkeypatch.setattr(ksea, 'ROKAI_ENGINE', 'python')
+    input_csv = Path(shutil.copy(INPUT_CSV, tmp_path / 'input.csv'))
+    result = json.load(open(ksea.perform_rokai_ksea(input_csv)))
+    expected = json.load(open(EXPECTED_KSEA_ROKAI))['Result']
+
+    assert [row['Gene'] for row in result] == [row['Gene'] for row in expected]
+    for column in [f'{field} (Experiment_{i})' for field in ['Score', 'adj p-val'] for i in [1, 2, 3]]:
+        np.testing.assert_allclose([row[column] for row in result], [row[column] for row in expected],
+                                   rtol=1e-4, atol=1e-5, err_msg=column)
+
+
+def test_experiments_with_same_valid_sites_are_solved_together():
+    network = rokai.RokaiNetwork(
+        sites=pd.Index(['P1_1', 'P1_2', 'P2_5', 'P3_7']),
+        kinases=pd.DataFrame({'KinaseID': ['K1', 'K2', 'K3']}),
+        wk2s=rokai.sp.csr_matrix(np.array([[1., 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 0]])),
+        wk2k=rokai.sp.csr_matrix(np.array([[0., 1, 0], [0, 0, 0], [0, 0, 0]])) * rokai.PPI_SCALING,
+        ws2s=rokai.sp.csr_matrix(np.array([[0., 0, 0, 1], [0, 0, 0, 0], [0, 0, 0, 0], [1, 0, 0, 0]])))
+    input_df = pd.DataFrame({'Site': ['P1_S1', 'P1_T2', 'P2_Y5', 'P3_S7', 'UNMAPPED_S1'],
+                             'E1': [1, 2, 3, -1, 5],
+                             'E2': [2, 1, np.nan, 3, 1],
+                             'E3': [2, 4, 6, -2, 0]}).set_index('Site')
+
+    refined = rokai.refine(input_df, network)
+
+    assert list(refined.index) == ['P1_S1', 'P1_T2', 'P2_Y5', 'P3_S7']
+    assert np.isnan(refined.loc['P2_Y5', 'E2'])
+    # E3 is E1 scaled, which is identical after normalization
+    np.testing.assert_allclose(refined['E1'], refined['E3'])
+    # The network changes the profile, but the values stay on the normalized scale
+    mapped = input_df.loc[refined.index, 'E1']
+    normalized = (mapped - mapped.mean()) / mapped.std()
+    assert not np.allclose(refined['E1'], normalized)
+    assert refined['E1'].abs().max() < normalized.abs().max()
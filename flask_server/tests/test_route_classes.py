@@ -0,0 +1,32 @@
+import threading
+from modules.route_classes import route_classes
+
+
+def test_requests_beyond_slots_and_queue_are_rejected(monkeypatch):
+    route_class = route_classes.RouteClass('heavy', workers=1, queue_limit=1)
+    monkeypatch.setitem(route_classes.ROUTE_CLASSES, 'heavy', route_class)
+    release = threading.Event()
+
+    @route_classes.limited('heavy')
+    def handler():
+        release.wait()
+        return 'done'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(handler())) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    while route_class.running + route_class.waiting < 2:
+        pass
+
+    rejected = handler()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert rejected[1] == 503
+    assert results == ['done', 'done']
+    metrics = route_class.metrics()
+    assert metrics['completed_total'] == 2 and metrics['rejected_total'] == 1
+    assert metrics['running'] == 0 and metrics['waiting'] == 0
+    assert 'enrichment_server_route_class_rejected_total{route_class="heavy"' in route_classes.get_prometheus_metrics()
@@ -0,0 +1,48 @@
+import sys
+import json
+import logging
+import subprocess
+from modules.server_logging import server_logging
+
+
+def test_subprocess_output_is_capped_and_spilled_on_failure(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(server_logging, 'SUBPROCESS_LOG_DIR', tmp_path)
+    script = 'import sys\nfor i in range(1000): print(i)\nsys.exit(3)'
+    subprocess_output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True)
+
+    server_logging.REQUEST_CONTEXT.set({'request_id': 'abc123'})
+    server_logging.log_subprocess_output(subprocess_output, 'test')
+
+    printed = capsys.readouterr().out
+    assert '999' in printed and '500\n' not in printed
+    assert f'[... {1000 - server_logging.SUBPROCESS_LOG_HEAD_LINES - server_logging.SUBPROCESS_LOG_TAIL_LINES}' \
+           ' lines omitted ...]' in printed
+    spilled = (tmp_path / 'abc123_test.log').read_text()
+    assert '\n500\n' in spilled and 'Exit code: 3' in spilled
+
+
+def test_records_are_written_as_json_with_request_ids():
+    server_logging.REQUEST_CONTEXT.set({'request_id': 'abc123', 'session_id': 'S1', 'dataset_name': 'D1'})
+    record = logging.LogRecord('enrichment_server', logging.INFO, __file__, 1, 'hello', None, None)
+    server_logging.RequestContextFilter().filter(record)
+
+    entry = json.loads(server_logging.JsonFormatter().format(record))
+
+    assert entry['message'] == 'hello'
+    assert entry['request_id'] == 'abc123' and entry['session_id'] == 'S1' and entry['dataset_name'] == 'D1'
+
+
+def test_each_process_writes_its_own_log_file(monkeypatch):
+    monkeypatch.setattr(server_logging, 'LOG_FILE', server_logging.Path('logs/server.log'))
+    assert server_logging.get_log_file(123) == server_logging.Path('logs/server.123.log')
+    monkeypatch.setattr(server_logging, 'LOG_FILE', server_logging.Path(server_logging.os.devnull))
+    assert server_logging.get_log_file(123) == server_logging.Path(server_logging.os.devnull)
+
+
+def test_request_ids_do_not_leak_into_the_next_request():
+    server_logging.REQUEST_CONTEXT.set({'request_id': 'abc123'})
+    server_logging.reset_request_context()
+    record = logging.LogRecord('enrichment_server', logging.INFO, __file__, 1, 'hello', None, None)
+    server_logging.RequestContextFilter().filter(record)
+
+    assert 'request_id' not in json.loads(server_logging.JsonFormatter().format(record))
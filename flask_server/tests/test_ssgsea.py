@@ -0,0 +1,93 @@
+from pathlib import Path
+import pytest
+import numpy as np
+import pandas as pd
+from statsmodels.stats.multitest import multipletests
+from modules.gct import gct
+from modules.ssgsea import ssgsea
+
+COMBINED_GCT = Path('../fixtures/ptm-sea/expected_output/out-combined.gct')
+
+
+def test_prefilter_keeps_signatures_with_enough_overlap(tmp_path, monkeypatch):
+    monkeypatch.setattr(ssgsea, 'SSGSEA_MIN_OVERLAP', 2)
+    database = tmp_path / 'signatures.gmt'
+    database.write_text('SIG_A\tfirst\tAAAsPAAA-p;u\tCCCsPCCC-p;d\tDDDsPDDD-p;u\n'
+                        'SIG_B\tsecond\tAAAsPAAA-p;d\tEEEsPEEE-p;u\n'
+                        'SIG_C\tthird\tBBBsPBBB-p;u\tCCCsPCCC-p;u\n')
+    input_df = pd.DataFrame({'Experiment01': [1.0, 2.0, np.nan], 'Experiment02': [np.nan, 3.0, np.nan]},
+                            index=['AAAsPAAA-p', 'CCCsPCCC-p', 'BBBsPBBB-p'])
+
+    reduced_gmt = ssgsea.prefilter_database(input_df, str(database), tmp_path / 'reduced.gmt')
+
+    assert reduced_gmt.endswith('reduced.gmt')
+    # SIG_B has one match, SIG_C only matches an id without values
+    assert (tmp_path / 'reduced.gmt').read_text() == 'SIG_A\tfirst\tAAAsPAAA-p;u\tCCCsPCCC-p;d\tDDDsPDDD-p;u\n'
+
+
+def test_prefilter_without_matching_signature(tmp_path):
+    database = tmp_path / 'signatures.gmt'
+    database.write_text('SIG_A\tfirst\tAKT1\tMTOR\n')
+    input_df = pd.DataFrame({'Experiment01': [1.0]}, index=['CDK1'])
+
+    assert ssgsea.prefilter_database(input_df, str(database), tmp_path / 'reduced.gmt') is None
+
+
+def test_preview_mode_uses_fewer_permutations(monkeypatch):
+    monkeypatch.setattr(ssgsea, 'SSGSEA_PREVIEW_PERMUTATIONS', 100)
+    monkeypatch.setattr(ssgsea, 'SSGSEA_PERMUTATIONS', 1000)
+
+    assert ssgsea.parse_mode({}) == 'full'
+    assert ssgsea.get_permutations(ssgsea.parse_mode({'mode': 'preview'})) == 100
+    assert ssgsea.get_permutations('full') == 1000
+    with pytest.raises(ValueError):
+        ssgsea.parse_mode({'mode': 'draft'})
+
+
+def test_columns_are_split_into_balanced_shards(monkeypatch):
+    monkeypatch.setattr(ssgsea, 'SSGSEA_SHARDS', 'auto')
+    monkeypatch.setattr(ssgsea, 'SSGSEA_CORE_BUDGET', 4)
+    columns = [f'Experiment{i:02}' for i in range(1, 10)]
+
+    n_shards = ssgsea.get_shard_count(len(columns))
+    shards = ssgsea.split_columns(columns, n_shards)
+
+    assert n_shards == 4
+    assert [len(shard) for shard in shards] == [3, 2, 2, 2]
+    assert sum(shards, []) == columns
+    # A forced shard count does not create shards below MIN_COLUMNS_PER_SHARD either
+    monkeypatch.setattr(ssgsea, 'SSGSEA_SHARDS', '8')
+    assert ssgsea.get_shard_count(5) == 2
+    assert ssgsea.get_shard_count(1) == 1
+
+
+def write_shard(path, combined, experiment, signatures):
+    per_experiment = [f'{field}.{experiment}' for field in ['Signature.set.overlap.percent', 'Signature.set.overlap',
+                                                            'pvalue', 'fdr.pvalue']]
+    row_metadata_df = combined.row_metadata_df.loc[signatures, ['Signature.set.description', 'Signature.set.size']
+                                                   + per_experiment]
+    return gct.write_gct(path, combined.data_df.loc[signatures, [experiment]], row_metadata_df,
+                         combined.col_metadata_df.loc[[experiment]])
+
+
+def test_merged_shards_recompute_the_fdr(tmp_path):
+    combined = gct.read_gct(COMBINED_GCT)
+    signatures = list(combined.data_df.index)
+    shard_gcts = [write_shard(tmp_path / 'shard0.gct', combined, 'Experiment01', signatures),
+                  # The second shard did not score the last signature
+                  write_shard(tmp_path / 'shard1.gct', combined, 'Experiment02', signatures[:-1])]
+
+    merged = gct.read_gct(ssgsea.merge_combined_gcts(shard_gcts, tmp_path / 'merged.gct'))
+
+    pd.testing.assert_frame_equal(merged.data_df.loc[signatures, ['Experiment01']],
+                                  combined.data_df[['Experiment01']])
+    assert np.isnan(merged.data_df.loc[signatures[-1], 'Experiment02'])
+    assert merged.row_metadata_df.loc[signatures, 'No.columns.scored'].tolist() == [2, 2, 1]
+    # Benjamini-Hochberg over all signatures of the experiment, as ssGSEA2.0 computes it
+    np.testing.assert_allclose(merged.row_metadata_df.loc[signatures, 'fdr.pvalue.Experiment01'],
+                               combined.row_metadata_df['fdr.pvalue.Experiment01'], rtol=1e-3)
+    p_values = combined.row_metadata_df.loc[signatures[:-1], 'pvalue.Experiment02']
+    np.testing.assert_allclose(merged.row_metadata_df.loc[signatures[:-1], 'fdr.pvalue.Experiment02'],
+                               multipletests(p_values, method='fdr_bh')[1])
+    assert np.isnan(merged.row_metadata_df.loc[signatures[-1], 'fdr.pvalue.Experiment02'])
+    assert list(merged.col_metadata_df.index) == ['Experiment01', 'Experiment02']
@@ -0,0 +1,13 @@
+import os
+import sys
+import subprocess
+
+
+def test_app_starts_without_pandas():
+    # Everything that needs pandas or numpy is imported lazily (see lazy_import), a worker starts in a fraction of the
+    # time and GET / answers right away
+    check = ('import sys, enrichment_server; '
+             'sys.exit(", ".join(sorted({"pandas", "numpy"} & set(sys.modules))) or None)')
+    result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True,
+                            env={**os.environ, 'WARMUP_MODULES': '0', 'LOG_FILE': os.devnull})
+    assert result.returncode == 0, result.stderr.splitlines()[-1]
@@ -0,0 +1,69 @@
+import json
+import shutil
+from pathlib import Path
+from types import SimpleNamespace
+from werkzeug.datastructures import MultiDict
+from modules.traffic_recorder import traffic_recorder
+
+KSEA_INPUT = Path('../fixtures/ksea/input/input.json')
+KEA3_INPUT = Path('../fixtures/kea3/input/input.json')
+
+
+def make_request(path: str, form: dict) -> SimpleNamespace:
+    return SimpleNamespace(path=path, form=MultiDict(form))
+
+
+def test_recording_is_off_by_default(tmp_path, monkeypatch):
+    monkeypatch.setattr(traffic_recorder, 'TRAFFIC_LOG', '')
+
+    traffic_recorder.record(make_request('/ksea', {}), 'KSEA', KSEA_INPUT)
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_entry_is_anonymized(tmp_path, monkeypatch):
+    log_file = tmp_path / 'traffic' / 'traffic.jsonl'
+    monkeypatch.setattr(traffic_recorder, 'TRAFFIC_LOG', str(log_file))
+    monkeypatch.setattr(traffic_recorder, 'TRAFFIC_RECORD_PAYLOAD', False)
+    form = {'session_id': 'alice', 'dataset_name': 'secret_study', 'max_pvalue': '0.05'}
+
+    traffic_recorder.record(make_request('/ksea', form), 'KSEA', KSEA_INPUT)
+    traffic_recorder.record(make_request('/kea3', {'session_id': 'alice'}), 'KEA3', KEA3_INPUT)
+
+    ksea_entry, kea3_entry = [json.loads(line) for line in open(log_file)]
+    assert 'alice' not in log_file.read_text() and 'secret_study' not in log_file.read_text()
+    assert ksea_entry['session'] == kea3_entry['session']
+    assert ksea_entry['route'] == '/ksea'
+    assert ksea_entry['parameters'] == {'max_pvalue': '0.05'}
+    assert ksea_entry['rows'] == len(json.load(open(KSEA_INPUT)))
+    assert ksea_entry['input_bytes'] == KSEA_INPUT.stat().st_size
+    assert kea3_entry['columns'] == len(json.load(open(KEA3_INPUT)))
+    assert 'payload' not in ksea_entry
+
+
+def test_payload_is_stored_once_per_content(tmp_path, monkeypatch):
+    log_file = tmp_path / 'traffic.jsonl'
+    monkeypatch.setattr(traffic_recorder, 'TRAFFIC_LOG', str(log_file))
+    monkeypatch.setattr(traffic_recorder, 'TRAFFIC_RECORD_PAYLOAD', True)
+    monkeypatch.setattr(traffic_recorder, 'TRAFFIC_PAYLOAD_DIR', tmp_path / 'payloads')
+    input_copy = tmp_path / 'input.json'
+    shutil.copyfile(KSEA_INPUT, input_copy)
+
+    traffic_recorder.record(make_request('/ksea', {}), 'KSEA', KSEA_INPUT)
+    traffic_recorder.record(make_request('/ksea/rokai', {}), 'RoKAI', input_copy)
+
+    entries = [json.loads(line) for line in open(log_file)]
+    assert entries[0]['payload'] == entries[1]['payload']
+    assert Path(entries[0]['payload']).read_bytes() == KSEA_INPUT.read_bytes()
+    assert len(list((tmp_path / 'payloads').iterdir())) == 1
+
+
+def test_invalid_input_does_not_fail(tmp_path, monkeypatch):
+    log_file = tmp_path / 'traffic.jsonl'
+    monkeypatch.setattr(traffic_recorder, 'TRAFFIC_LOG', str(log_file))
+    invalid_input = tmp_path / 'input.json'
+    invalid_input.write_text('{"Experiment": [')
+
+    traffic_recorder.record(make_request('/kea3', {}), 'KEA3', invalid_input)
+
+    assert not log_file.exists()
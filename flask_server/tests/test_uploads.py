@@ -0,0 +1,79 @@
+import io
+import json
+import tarfile
+import zipfile
+import pytest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+from modules.uploads import uploads
+
+DATASETS = {'patient01': [{'Site': 'O75822_S11', 'Experiment_1': 0.5}],
+            'patient02': [{'Site': 'Q15149_S4386', 'Experiment_1': -1.0}]}
+
+
+def read_cohort(cohort_path) -> dict[str, list]:
+    return {name: input_df.to_dict('records') for name, input_df in uploads.iter_cohort(cohort_path)}
+
+
+def make_request(path: str, data: dict) -> Request:
+    return Request(EnvironBuilder(path=path, method='POST', data=data).get_environ())
+
+
+def make_zip() -> io.BytesIO:
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_archive:
+        for name, records in DATASETS.items():
+            zip_archive.writestr(f'cohort/{name}.json', json.dumps(records))
+        zip_archive.writestr('__MACOSX/cohort/._patient01.json', 'resource fork')
+        zip_archive.writestr('cohort/README.txt', 'not a dataset')
+    archive.seek(0)
+    return archive
+
+
+def make_tar() -> io.BytesIO:
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar_archive:
+        for name, records in DATASETS.items():
+            content = json.dumps(records).encode()
+            info = tarfile.TarInfo(f'{name}.json')
+            info.size = len(content)
+            tar_archive.addfile(info, io.BytesIO(content))
+    archive.seek(0)
+    return archive
+
+
+def test_dataset_parts_are_merged_into_a_cohort(tmp_path):
+    request = make_request('/batch/ksea', {'dataset': [(io.BytesIO(json.dumps(records).encode()), f'{name}.json')
+                                                       for name, records in DATASETS.items()]})
+
+    assert uploads.save_upload(request, tmp_path / 'input.json')
+    assert read_cohort(tmp_path / 'input.json') == DATASETS
+
+
+@pytest.mark.parametrize('make_archive,filename', [(make_zip, 'cohort.zip'), (make_tar, 'cohort.tar.gz')])
+def test_archives_are_merged_into_a_cohort(make_archive, filename, tmp_path):
+    request = make_request('/batch/motif_enrichment', {'archive': (make_archive(), filename)})
+
+    assert uploads.save_upload(request, tmp_path / 'input.json')
+    assert read_cohort(tmp_path / 'input.json') == DATASETS
+
+
+def test_dataset_names_must_be_unique(tmp_path):
+    request = make_request('/batch/ksea', {'dataset': [(io.BytesIO(b'[]'), 'a.json'), (io.BytesIO(b'[]'), 'b/a.json')]})
+
+    with pytest.raises(ValueError, match='Dataset a occurs more than once'):
+        uploads.save_upload(request, tmp_path / 'input.json')
+
+
+def test_single_dataset_routes_ignore_dataset_parts(tmp_path):
+    assert not uploads.save_upload(make_request('/ksea', {'dataset': (io.BytesIO(b'[]'), 'a.json')}),
+                                   tmp_path / 'input.json')
+    assert uploads.save_upload(make_request('/ksea', {'data': '[]'}), tmp_path / 'input.json')
+    assert (tmp_path / 'input.json').read_text() == '[]'
+
+
+def test_cohort_must_hold_lists_of_records(tmp_path):
+    (tmp_path / 'input.json').write_text(json.dumps({'patient01': DATASETS['patient01'], 'patient02': {'Site': []}}))
+
+    with pytest.raises(ValueError, match='list of records per dataset'):
+        read_cohort(tmp_path / 'input.json')
@@ -0,0 +1,41 @@
+import os
+import pytest
+from modules.workspace import workspace
+
+
+@pytest.fixture
+def workspace_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(workspace, 'WORKSPACE_ROOT', tmp_path)
+    return tmp_path
+
+
+def test_identical_submissions_get_separate_workspaces(workspace_root):
+    first = workspace.create('TESTSESSION', 'dataset', '/ksea/rokai')
+    second = workspace.create('TESTSESSION', 'dataset', '/ksea/rokai')
+
+    assert first != second and first.is_dir() and second.is_dir()
+    assert first.parent == second.parent == workspace_root
+    assert first.name.endswith('_TESTSESSION_dataset_ksea_rokai')
+
+
+def test_release_reports_scratch_bytes(workspace_root):
+    job_workspace = workspace.create('TESTSESSION', 'dataset', '/kea3')
+    (job_workspace / 'input.json').write_bytes(bytes(1000))
+    (job_workspace / 'RESULTS').mkdir()
+    (job_workspace / 'RESULTS' / 'result.json').write_bytes(bytes(24))
+
+    assert workspace.release(job_workspace) == 1024
+    assert not job_workspace.exists()
+    assert workspace.release(job_workspace) == 0
+
+
+def test_reaper_only_deletes_workspaces_of_dead_workers(workspace_root):
+    own_workspace = workspace.create('TESTSESSION', 'dataset', '/kea3')
+    # Same pid, but a different start time: A previous process that had the pid of this one
+    orphan = workspace_root / f'{os.getpid()}.1_0123456789ab_TESTSESSION_dataset_kea3'
+    (orphan / 'MAPPED_DATA').mkdir(parents=True)
+    unrelated = workspace_root / 'notes'
+    unrelated.mkdir()
+
+    assert workspace.reap_orphans() == [orphan]
+    assert own_workspace.exists() and unrelated.exists() and not orphan.exists()